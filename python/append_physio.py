@@ -1,16 +1,19 @@
 # date: 2025-07-17
 # Author: Georgios Soultanidis
 # Affiliation: BMEII, Icahn School of Medicine at Mount Sinai
-# version: 0.3
+# version: 0.4
 
 # The functionality of this script is to append physiological signals (e.g., ECG) to a PETSIRD file.
 # you have to provide a PETSIRD file and a CSV file with two columns: [start_time_ms, value].
 # The script will read the CSV file and create an ExternalSignalTimeBlock for each row,
 # which will be appended to the PETSIRD file.
 # The output will be a new PETSIRD file with the appended physiological signals.
-
-# TODO: Right now, the id of the physiological signal is hardcoded to 1.
-# You may want to change this if you have multiple physiological signals. 
+#
+# With --stream, the CSV file is handled by chunks, the consecutive samples falling in the same
+# --block-interval (ms) are packed in a single ExternalSignalTimeBlock, and these blocks are
+# written in time order with the time blocks of the input file (no sort needed afterwards).
+# The samples of a block are spread evenly over its time interval, so the signal is expected
+# to be regularly sampled.
 
 
 #the way to run this script is:
@@ -20,9 +23,14 @@
 
 
 import petsird
-import pandas as pd
+import numpy as np
 import argparse
 
+from kway_merge import mergeSortedStreams
+from physio_io import iter_physio_chunks, load_physio
+from telemetry import Telemetry, addProfileArguments
+from timeblock_utils import timeBlockStart
+
 # Define signal type mapping
 signal_type_map = {
     "ecg_trace": petsird.ExternalSignalTypeEnum.ECG_TRACE,
@@ -60,32 +68,35 @@ def parserCreator():
         default="other_motion_signal",
         help=f"Signal type to use. Options: {', '.join(signal_type_map.keys())}",
     )
+    parser.add_argument(
+        "--signal-id",
+        type=int,
+        default=1,
+        help="Id of the physiological signal (must be unique in the file)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the CSV by chunks, pack the samples by --block-interval and "
+        "interleave them in time with the time blocks of the input",
+    )
+    parser.add_argument(
+        "--block-interval",
+        type=int,
+        default=100,
+        help="Time interval (ms) covered by one ExternalSignalTimeBlock in --stream mode",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100000,
+        help="Number of CSV rows packed at once in --stream mode",
+    )
+    addProfileArguments(parser)
     return parser.parse_args()
 
 
-args = parserCreator()
-
-# Validate signal type
-signal_type_key = args.signal_type.lower()
-if signal_type_key not in signal_type_map:
-    raise ValueError(f"Invalid signal type: {signal_type_key}. Valid options are: {list(signal_type_map.keys())}")
-signal_enum = signal_type_map[signal_type_key]
-
-# Read CSV with two columns: [start_time_ms, value]
-df = pd.read_csv(args.physio, header=None)
-starts_ms = df.iloc[:, 0].astype(int).values
-values = df.iloc[:, 1].astype(int).values
-
-physio_id = 1  # must be unique and consistent with your data
-
-# Open reader and writer
-with petsird.BinaryPETSIRDReader(args.input) as reader, open(
-    args.output, "wb"
-) as out_file, petsird.BinaryPETSIRDWriter(out_file) as writer:
-
-    # Read and modify header
-    header = reader.read_header()
-
+def add_signal_to_header(header, signal_enum, physio_id: int):
     if not any(sig.id == physio_id for sig in header.exam.external_signals):
         physio_signal = petsird.ExternalSignal(
             type=signal_enum,
@@ -94,11 +105,64 @@ with petsird.BinaryPETSIRDReader(args.input) as reader, open(
         )
         header.exam.external_signals.append(physio_signal)
 
-    # Write modified header
-    writer.write_header(header)
+
+# CSV rows as chunks of numpy arrays (start_time_ms, value), streamed by physio_io without loading the whole CSV
+def read_physio_chunks(physio_file: str, chunk_size: int):
+    for starts_ms, values in iter_physio_chunks(physio_file, chunk_size):
+        yield starts_ms, values.astype(np.float32)
+
+
+def make_signal_block(starts_ms: np.ndarray, values: np.ndarray, physio_id: int):
+    start = int(starts_ms[0])
+    if len(starts_ms) > 1:
+        # one more sample period after the last sample, so the samples are evenly spread on the interval
+        period = (starts_ms[-1] - starts_ms[0]) / (len(starts_ms) - 1)
+        stop = int(round(starts_ms[-1] + period))
+    else:
+        stop = start + 1
+    return petsird.TimeBlock.ExternalSignalTimeBlock(
+        petsird.ExternalSignalTimeBlock(
+            time_interval=petsird.TimeInterval(start=start, stop=stop),
+            signal_id=physio_id,
+            signal_values=values.tolist(),
+        )
+    )
+
+
+# pack consecutive samples falling in the same block_interval (aligned on multiples of it) in one time block.
+# The last interval of a chunk is kept until the next chunk, as it may continue there.
+def pack_signal_blocks(physio_chunks, block_interval: int, physio_id: int):
+    pending_starts = np.empty(0, dtype=np.float64)
+    pending_values = np.empty(0, dtype=np.float32)
+    for starts_ms, values in physio_chunks:
+        starts_ms = np.concatenate((pending_starts, starts_ms))
+        values = np.concatenate((pending_values, values))
+        if len(starts_ms) == 0:
+            continue
+        interval_ids = np.floor_divide(starts_ms, block_interval).astype(np.int64)
+        nb_complete = np.searchsorted(interval_ids, interval_ids[-1], side="left")
+        boundaries = np.flatnonzero(np.diff(interval_ids[:nb_complete])) + 1
+        for block_starts, block_values in zip(
+            np.split(starts_ms[:nb_complete], boundaries),
+            np.split(values[:nb_complete], boundaries),
+        ):
+            if len(block_starts) != 0:
+                yield make_signal_block(block_starts, block_values, physio_id)
+        pending_starts = starts_ms[nb_complete:]
+        pending_values = values[nb_complete:]
+
+    if len(pending_starts) != 0:
+        yield make_signal_block(pending_starts, pending_values, physio_id)
+
+
+def append_rows(time_blocks, writer, physio_file: str, physio_id: int):
+    # Read CSV with two columns: [start_time_ms, value]
+    starts_ms, values = load_physio(physio_file)
+    starts_ms = starts_ms.astype(int)
+    values = values.astype(int)
 
     # Copy all time blocks
-    for block in reader.read_time_blocks():
+    for block in time_blocks:
         writer.write_time_blocks((block,))
 
     # Inject one ExternalSignalTimeBlock per row
@@ -112,3 +176,64 @@ with petsird.BinaryPETSIRDReader(args.input) as reader, open(
         writer.write_time_blocks(
             (petsird.TimeBlock.ExternalSignalTimeBlock(physio_block),)
         )
+
+
+# both streams are sorted in time, a merge keeps the output sorted
+def interleave_signal_blocks(time_blocks, signal_blocks):
+    for _, _, block in mergeSortedStreams(
+        [
+            ((timeBlockStart(block), block) for block in time_blocks),
+            ((timeBlockStart(block), block) for block in signal_blocks),
+        ]
+    ):
+        yield block
+
+
+def append_stream(
+    time_blocks, writer, physio_file: str, physio_id: int, block_interval: int, chunk_size: int
+):
+    signal_blocks = pack_signal_blocks(
+        read_physio_chunks(physio_file, chunk_size), block_interval, physio_id
+    )
+    for block in interleave_signal_blocks(time_blocks, signal_blocks):
+        writer.write_time_blocks((block,))
+
+
+if __name__ == "__main__":
+    args = parserCreator()
+
+    # Validate signal type
+    signal_type_key = args.signal_type.lower()
+    if signal_type_key not in signal_type_map:
+        raise ValueError(f"Invalid signal type: {signal_type_key}. Valid options are: {list(signal_type_map.keys())}")
+    signal_enum = signal_type_map[signal_type_key]
+
+    physio_id = args.signal_id  # must be unique and consistent with your data
+    telemetry = Telemetry("append_physio", args.profile)
+
+    # Open reader and writer
+    with petsird.BinaryPETSIRDReader(args.input) as reader, open(
+        args.output, "wb"
+    ) as out_file, telemetry.openWriter(out_file) as writer:
+
+        # Read and modify header
+        header = reader.read_header()
+        add_signal_to_header(header, signal_enum, physio_id)
+
+        # Write modified header
+        writer.write_header(header)
+
+        time_blocks = telemetry.timeBlocks(reader.read_time_blocks())
+        if args.stream:
+            append_stream(
+                time_blocks,
+                writer,
+                args.physio,
+                physio_id,
+                args.block_interval,
+                args.chunk_size,
+            )
+        else:
+            append_rows(time_blocks, writer, args.physio, physio_id)
+
+    telemetry.report()
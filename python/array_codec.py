@@ -0,0 +1,626 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Decode and encode the event lists of the EventTimeBlocks with numpy, without
+creating one python object per event, for the tools whose hot loops only select, split
+or concatenate events.
+
+ArrayPETSIRDReader reads the header with the standard petsird reader, then walks the
+stream of time blocks in the memory-mapped file: the prompts, delays and triples of an
+EventTimeBlock are decoded at once into numpy structured arrays whose fields are the
+fields of the event record, e.g. for coincidences:
+	[("detector_ids", np.uint32, (2,)), ("tof_idx", np.uint32), ("energy_indices", np.uint32, (2,))]
+The other time blocks are decoded by the standard petsird serializer, from the same
+position of the file. ArrayPETSIRDWriter is its counterpart: the event lists given as
+structured arrays are encoded at once, the header and the other time blocks (or event
+time blocks holding event objects) by the standard petsird writer, in the same stream.
+The files read and written are the ones of the standard petsird reader and writer.
+
+The binary encoding of the events (yardl): a list is its length then its events, an
+event is its fields in order, the integers are LEB128 varints (zigzag for the signed
+ones) and a fixed vector is its elements. The layout is taken from the petsird
+serializers of the installed model; when the event records hold anything else than
+integers and fixed vectors of integers, or for the standard input (no memory map), the
+readers and writers fall back to the standard petsird decoding and encoding.
+
+The codec relies on private yardl/petsird internals (the serializers of petsird.binary and
+petsird._binary, the coded streams of the generated reader and writer). They are checked
+once, when the codec is first used (see codecError): when they are not the expected ones,
+a warning is printed and the standard reader and writer are used.
+
+The event arrays go through the numpy helpers of event_arrays.py as the object arrays do
+(masks, indexing, concatenation, eventFieldArray...).
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import functools
+import io
+import mmap
+import os
+import sys
+from typing import BinaryIO, Iterator, List, Union
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from petsird import _binary
+from tb_index import _seek, _tell, checkInternals, timeBlockSerializer
+
+
+# Integer serializers encoded as varints: name -> (signed, maximum number of bytes)
+_VARINT_SERIALIZERS = {
+    "UInt16Serializer": (False, 3),
+    "UInt32Serializer": (False, 5),
+    "UInt64Serializer": (False, 10),
+    "SizeSerializer": (False, 10),
+    "Int16Serializer": (True, 3),
+    "Int32Serializer": (True, 5),
+    "Int64Serializer": (True, 10),
+}
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def addArrayCodecArguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--arrayCodec",
+        action="store_true",
+        default=False,
+        dest="arrayCodec",
+        help="Decode and encode the event lists as numpy structured arrays instead of "
+        "event objects (see array_codec.py).",
+    )
+
+
+def decodeVarints(data: np.ndarray, pos: int, count: int, maxBytes: int = 10):
+    """The count unsigned varints at data[pos:] (uint64 array) and the position after them."""
+    if count == 0:
+        return np.empty(0, dtype=np.uint64), pos
+    # Most values of an event list fit in 2 bytes, the full window is only a fallback
+    for cWindow in (2 * count, maxBytes * count):
+        window = data[pos : pos + cWindow]
+        ends = np.flatnonzero(window < 0x80)
+        if len(ends) >= count or len(window) < cWindow:
+            break
+    if len(ends) < count:
+        raise EOFError("Truncated event list")
+    ends = ends[:count]
+    window = window[: ends[-1] + 1]
+    if ends[-1] == count - 1:
+        return window.astype(np.uint64), pos + count
+
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = 7 * (np.arange(len(window)) - np.repeat(starts, ends - starts + 1))
+    parts = (window & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts), pos + len(window)
+
+
+def encodeVarints(values: np.ndarray) -> np.ndarray:
+    """The unsigned varints of values (uint64 array), as a uint8 array."""
+    values = values.astype(np.uint64, copy=False)
+    nbBytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbBytes += rest != 0
+        rest >>= np.uint64(7)
+
+    offsets = np.cumsum(nbBytes) - nbBytes
+    encoded = np.empty(int(nbBytes.sum()), dtype=np.uint8)
+    for cByte in range(int(nbBytes.max(initial=0))):
+        cMask = nbBytes > cByte
+        cBits = (values[cMask] >> np.uint64(7 * cByte)) & np.uint64(0x7F)
+        cBits |= np.where(nbBytes[cMask] > cByte + 1, np.uint64(0x80), np.uint64(0))
+        encoded[offsets[cMask] + cByte] = cBits
+    return encoded
+
+
+def _zigzagDecode(values: np.ndarray) -> np.ndarray:
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _zigzagEncode(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64, copy=False)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _varintBytes(value: int, signed: bool = False) -> bytes:
+    if signed:
+        value = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _readVarint(data: mmap.mmap, pos: int, signed: bool = False):
+    value = 0
+    shift = 0
+    while True:
+        cByte = data[pos]
+        pos += 1
+        value |= (cByte & 0x7F) << shift
+        if cByte < 0x80:
+            break
+        shift += 7
+    if signed:
+        value = (value >> 1) ^ -(value & 1)
+    return value, pos
+
+
+def _varintKind(serializer):
+    """(signed, maximum number of bytes) of an integer varint serializer, else None."""
+    for cClass in type(serializer).__mro__:
+        if cClass.__module__.endswith("_binary") and cClass.__name__ in _VARINT_SERIALIZERS:
+            return _VARINT_SERIALIZERS[cClass.__name__]
+    return None
+
+
+class EventLayout:
+    """Binary layout of an event record whose fields are integers or fixed vectors of them."""
+
+    def __init__(self, fields: List[tuple]):
+        # fields: (name, numpy dtype, number of values, signed, maximum number of bytes)
+        self.fields = fields
+        self.dtype = np.dtype(
+            [
+                (cName, cDtype) if cNbValues == 1 else (cName, cDtype, (cNbValues,))
+                for cName, cDtype, cNbValues, _, _ in fields
+            ]
+        )
+        self.nbValues = sum(cField[2] for cField in fields)
+        self.maxBytes = max((cField[4] for cField in fields), default=1)
+
+    @staticmethod
+    def fromSerializer(recordSerializer) -> Union["EventLayout", None]:
+        fields = []
+        for cName, cSerializer in getattr(recordSerializer, "_field_serializers", None) or []:
+            nbValues = 1
+            if isinstance(cSerializer, _binary.FixedVectorSerializer):
+                nbValues = cSerializer._length
+                cSerializer = getattr(
+                    cSerializer,
+                    "element_serializer",
+                    getattr(cSerializer, "_element_serializer", None),
+                )
+            kind = _varintKind(cSerializer)
+            if kind is None:
+                return None
+            fields.append((cName, cSerializer.overall_dtype(), nbValues) + kind)
+        if len(fields) == 0:
+            return None
+        return EventLayout(fields)
+
+    def decode(self, data: np.ndarray, pos: int, nbEvents: int):
+        values, pos = decodeVarints(data, pos, nbEvents * self.nbValues, self.maxBytes)
+        values = values.reshape(nbEvents, self.nbValues)
+        events = np.empty(nbEvents, dtype=self.dtype)
+        cColumn = 0
+        for cName, _, cNbValues, cSigned, _ in self.fields:
+            cValues = values[:, cColumn : cColumn + cNbValues]
+            if cSigned:
+                cValues = _zigzagDecode(cValues)
+            events[cName] = cValues if cNbValues != 1 else cValues[:, 0]
+            cColumn += cNbValues
+        return events, pos
+
+    def encode(self, events: np.ndarray) -> bytes:
+        values = np.empty((len(events), self.nbValues), dtype=np.uint64)
+        cColumn = 0
+        for cName, cDtype, cNbValues, cSigned, _ in self.fields:
+            cValues = np.asarray(events[cName]).reshape(len(events), cNbValues)
+            if not np.can_cast(cValues.dtype, cDtype):
+                # e.g. int64 arrays built by the tools: the values must fit in the record type
+                if not np.issubdtype(cValues.dtype, np.integer):
+                    raise ValueError(
+                        f"The {cName} of the events are not integers ({cValues.dtype})."
+                    )
+                bounds = np.iinfo(cDtype)
+                if cValues.size != 0 and (
+                    cValues.min() < bounds.min or cValues.max() > bounds.max
+                ):
+                    raise ValueError(
+                        f"The {cName} of the events are out of the range of {cDtype} "
+                        f"([{cValues.min()}, {cValues.max()}])."
+                    )
+                cValues = cValues.astype(cDtype)
+            values[:, cColumn : cColumn + cNbValues] = (
+                _zigzagEncode(cValues) if cSigned else cValues
+            )
+            cColumn += cNbValues
+        return _varintBytes(len(events)) + encodeVarints(values.reshape(-1)).tobytes()
+
+    def asEvents(self, events) -> Union[np.ndarray, None]:
+        """events as a structured array of this layout, None when they are event objects."""
+        if isinstance(events, np.ndarray) and events.dtype.names is not None:
+            if all(cField[0] in events.dtype.names for cField in self.fields):
+                return events
+            return None
+        if len(events) == 0:
+            return np.empty(0, dtype=self.dtype)
+        return None
+
+
+class EventTimeBlockLayout:
+    """
+    Binary layout of the EventTimeBlock record: integer fields (start), event lists and
+    optional event lists, or None when the installed model has anything else.
+    """
+
+    SCALAR, EVENTS, OPTIONAL_EVENTS = range(3)
+
+    def __init__(self, tag: int, caseType: type, fields: List[tuple]):
+        self.tag = tag
+        self.caseType = caseType
+        # fields: (name, kind, signed or EventLayout)
+        self.fields = fields
+
+    @staticmethod
+    def fromUnionSerializer(unionSerializer) -> Union["EventTimeBlockLayout", None]:
+        for cTag, cCase in enumerate(unionSerializer._cases):
+            if cCase is not None and cCase[0] is petsird.TimeBlock.EventTimeBlock:
+                break
+        else:
+            return None
+
+        fields = []
+        for cName, cSerializer in getattr(cCase[1], "_field_serializers", None) or []:
+            kind = EventTimeBlockLayout.EVENTS
+            if isinstance(cSerializer, _binary.OptionalSerializer):
+                kind = EventTimeBlockLayout.OPTIONAL_EVENTS
+                cSerializer = cSerializer._element_serializer
+            if isinstance(cSerializer, _binary.VectorSerializer):
+                eventLayout = EventLayout.fromSerializer(cSerializer._element_serializer)
+                if eventLayout is None:
+                    return None
+                fields.append((cName, kind, eventLayout))
+            elif kind == EventTimeBlockLayout.EVENTS and _varintKind(cSerializer) is not None:
+                fields.append((cName, EventTimeBlockLayout.SCALAR, _varintKind(cSerializer)[0]))
+            else:
+                return None
+        return EventTimeBlockLayout(cTag, cCase[0], fields)
+
+    def decode(self, data: mmap.mmap, dataArray: np.ndarray, pos: int):
+        """The EventTimeBlock whose fields start at data[pos:] and the position after it."""
+        values = {}
+        for cName, cKind, cLayout in self.fields:
+            if cKind == EventTimeBlockLayout.SCALAR:
+                values[cName], pos = _readVarint(data, pos, cLayout)
+                continue
+            if cKind == EventTimeBlockLayout.OPTIONAL_EVENTS:
+                pos += 1
+                if data[pos - 1] == 0:
+                    values[cName] = None
+                    continue
+            nbEvents, pos = _readVarint(data, pos)
+            values[cName], pos = cLayout.decode(dataArray, pos, nbEvents)
+        return self.caseType(petsird.EventTimeBlock(**values)), pos
+
+    def encode(self, timeBlock) -> Union[bytes, None]:
+        """The bytes of an EventTimeBlock holding event arrays (None when it cannot be)."""
+        if not isinstance(timeBlock, self.caseType):
+            return None
+        encoded = [bytes((self.tag,))]
+        for cName, cKind, cLayout in self.fields:
+            cValue = getattr(timeBlock.value, cName)
+            if cKind == EventTimeBlockLayout.SCALAR:
+                encoded.append(_varintBytes(int(cValue), cLayout))
+                continue
+            if cKind == EventTimeBlockLayout.OPTIONAL_EVENTS:
+                if cValue is None:
+                    encoded.append(b"\x00")
+                    continue
+                encoded.append(b"\x01")
+            if cValue is None:
+                return None
+            events = cLayout.asEvents(cValue)
+            if events is None:
+                return None
+            encoded.append(cLayout.encode(events))
+        return b"".join(encoded)
+
+
+def timeBlockLayout() -> Union[EventTimeBlockLayout, None]:
+    """Layout of the EventTimeBlocks of the installed petsird, None if not supported."""
+    return EventTimeBlockLayout.fromUnionSerializer(timeBlockSerializer())
+
+
+def checkCodec() -> Union[str, None]:
+    """
+    None when the codec works with the installed petsird, otherwise the reason it does not:
+    the internals of the time block index (see tb_index.checkInternals), the layout of the
+    EventTimeBlocks, and an EventTimeBlock of one event per list, each field holding its
+    own value, must be read back with the same values by the standard reader and by the
+    layout, once written by ArrayPETSIRDWriter in memory.
+    """
+    internalsError = checkInternals()
+    if internalsError is not None:
+        return internalsError
+    try:
+        layout = timeBlockLayout()
+        if layout is None:
+            return "the EventTimeBlocks hold anything else than integers and event lists"
+        values = {}
+        for cPos, (cName, cKind, cLayout) in enumerate(layout.fields):
+            if cKind == EventTimeBlockLayout.SCALAR:
+                values[cName] = cPos + 1
+                continue
+            values[cName] = np.zeros(1, dtype=cLayout.dtype)
+            for cField, cFieldInfo in enumerate(cLayout.fields):
+                values[cName][cFieldInfo[0]] = cPos + cField + 1
+        timeBlock = layout.caseType(petsird.EventTimeBlock(**values))
+
+        output = io.BytesIO()
+        writer = ArrayPETSIRDWriter(output, layout)
+        writer.write_header(petsird.Header())
+        writer.write_time_blocks([timeBlock])
+        writer.close()
+        data = output.getvalue()
+        reader = petsird.BinaryPETSIRDReader(io.BytesIO(data))
+        reader.read_header()
+        pos = _tell(reader)
+        readTimeBlocks = list(reader.read_time_blocks())
+        _, pos = _readVarint(data, pos)
+        if len(readTimeBlocks) != 1 or data[pos] != layout.tag:
+            return "the stream of time blocks is not written as expected"
+        decoded, _ = layout.decode(data, np.frombuffer(data, dtype=np.uint8), pos + 1)
+
+        for cName, cKind, cLayout in layout.fields:
+            readValue = getattr(readTimeBlocks[0].value, cName)
+            decodedValue = getattr(decoded.value, cName)
+            if cKind == EventTimeBlockLayout.SCALAR:
+                if readValue != values[cName] or decodedValue != values[cName]:
+                    return f"the field {cName} of the EventTimeBlocks is not encoded as expected"
+                continue
+            for cFieldName, *_ in cLayout.fields:
+                expected = np.ravel(values[cName][cFieldName])
+                if not np.array_equal(
+                    np.ravel(getattr(readValue[0], cFieldName)), expected
+                ) or not np.array_equal(np.ravel(decodedValue[cFieldName]), expected):
+                    return f"the field {cFieldName} of the {cName} is not encoded as expected"
+    except Exception as exc:
+        return f"{type(exc).__name__}: {exc}"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def codecError() -> Union[str, None]:
+    """checkCodec, run once when the codec is first used, with a warning when it fails."""
+    error = checkCodec()
+    if error is not None:
+        print(
+            f"Warning: the array codec does not support the installed petsird ({error}), "
+            "the standard reader and writer are used.",
+            file=sys.stderr,
+        )
+    return error
+
+
+def _codecLayout() -> Union[EventTimeBlockLayout, None]:
+    # Layout used by the readers and writers, None (with a warning) when not supported
+    if codecError() is not None:
+        return None
+    return timeBlockLayout()
+
+
+class ArrayPETSIRDReader:
+    """
+    BinaryPETSIRDReader of a file, whose event lists are read as structured arrays. As
+    the standard reader, closing it before all the time blocks were read raises a
+    ProtocolError (except when closed by an exception in a with block).
+    """
+
+    def __init__(self, acqPath: str):
+        self._reader = petsird.BinaryPETSIRDReader(acqPath)
+        self._acqPath = acqPath
+        self.layout = _codecLayout()
+        self._serializer = None if self.layout is None else timeBlockSerializer()
+        self._file = None
+        self._data = None
+        # None while the time blocks are not read by _arrayTimeBlocks, then whether all were
+        self._consumed = None
+
+    def read_header(self):
+        return self._reader.read_header()
+
+    def read_time_blocks(self) -> Iterator:
+        if self.layout is None:
+            return self._reader.read_time_blocks()
+        self._consumed = False
+        return self._arrayTimeBlocks()
+
+    def _arrayTimeBlocks(self) -> Iterator:
+        pos = _tell(self._reader)
+        self._file = open(self._acqPath, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._data
+        dataArray = np.frombuffer(data, dtype=np.uint8)
+        try:
+            while True:
+                chunkSize, pos = _readVarint(data, pos)
+                if chunkSize == 0:
+                    self._consumed = True
+                    return
+                for _ in range(chunkSize):
+                    if data[pos] == self.layout.tag:
+                        cTimeBlock, pos = self.layout.decode(data, dataArray, pos + 1)
+                    else:
+                        _seek(self._reader, pos)
+                        cTimeBlock = self._serializer.read(self._reader._stream)
+                        pos = _tell(self._reader)
+                    yield cTimeBlock
+        except IndexError:
+            raise EOFError(f"{self._acqPath} is truncated") from None
+        finally:
+            del dataArray
+
+    def _unmap(self):
+        if self._data is not None:
+            try:
+                self._data.close()
+            except BufferError:
+                # A suspended read_time_blocks still views the map, it is unmapped with it
+                pass
+            self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        try:
+            if self._consumed is None:
+                self._reader.close()
+            else:
+                # The standard reader did not see the time blocks, the check is done here
+                self._reader._close()
+                if not self._consumed:
+                    raise petsird.ProtocolError(
+                        "Protocol reader closed before all data was consumed. The iterable "
+                        "returned by 'read_time_blocks' was not fully consumed."
+                    )
+        finally:
+            self._unmap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # As the standard reader: the error of close is only raised without another one
+        try:
+            self.close()
+        except Exception:
+            if excValue is None:
+                raise
+
+
+class ArrayPETSIRDWriter:
+    """
+    BinaryPETSIRDWriter encoding the event lists given as structured arrays at once. The
+    layout is the one of the installed petsird unless given (see checkCodec).
+    """
+
+    def __init__(
+        self, output: Union[str, BinaryIO], layout: Union[EventTimeBlockLayout, None] = None
+    ):
+        self._writer = petsird.BinaryPETSIRDWriter(output)
+        self.layout = _codecLayout() if layout is None else layout
+        self._serializer = None if self.layout is None else timeBlockSerializer()
+        self._started = False
+
+    def write_header(self, header):
+        self._writer.write_header(header)
+
+    def write_time_blocks(self, timeBlocks):
+        timeBlocks = list(timeBlocks)
+        if self.layout is None:
+            self._writer.write_time_blocks(timeBlocks)
+            return
+        if not self._started:
+            # Checks the protocol state, an empty list writes nothing
+            self._writer.write_time_blocks([])
+            self._started = True
+        if len(timeBlocks) == 0:
+            return
+
+        # One chunk of the stream, as the standard writer does for a list
+        stream = self._writer._stream
+        stream.write_unsigned_varint(len(timeBlocks))
+        for cTimeBlock in timeBlocks:
+            encoded = self.layout.encode(cTimeBlock)
+            if encoded is None:
+                self._serializer.write(stream, cTimeBlock)
+            else:
+                stream.write_bytes(encoded)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._writer.__exit__(excType, excValue, traceback)
+
+
+def openReader(acqPath: str, arrayCodec: bool = False):
+    """Reader of acqPath (- for stdin), an ArrayPETSIRDReader if requested and possible."""
+    if acqPath == "-":
+        return petsird.BinaryPETSIRDReader(sys.stdin.buffer)
+    if arrayCodec and os.path.isfile(acqPath) and _codecLayout() is not None:
+        return ArrayPETSIRDReader(acqPath)
+    return petsird.BinaryPETSIRDReader(acqPath)
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testVarintCodec():
+    values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2**32 - 1, 2**63 + 5], dtype=np.uint64)
+    encoded = encodeVarints(values)
+    assert encoded.tobytes() == b"".join(_varintBytes(int(cValue)) for cValue in values)
+    data = np.concatenate((np.array([0xFF], dtype=np.uint8), encoded, np.zeros(3, dtype=np.uint8)))
+    decoded, pos = decodeVarints(data, 1, len(values))
+    assert np.array_equal(decoded, values) and pos == 1 + len(encoded)
+    assert decodeVarints(encodeVarints(values[:3]), 0, 3)[0].tolist() == [0, 1, 127]
+
+    signed = np.array([0, -1, 1, -64, 64, -(2**40)], dtype=np.int64)
+    assert np.array_equal(_zigzagDecode(_zigzagEncode(signed)), signed)
+    assert _zigzagEncode(signed)[:3].tolist() == [0, 1, 2]
+    assert _readVarint(_varintBytes(-(2**40), True), 0, True)[0] == -(2**40)
+
+    rng = np.random.default_rng(0)
+    layout = EventLayout(
+        [
+            ("detector_ids", np.dtype(np.uint32), 2, False, 5),
+            ("tof_idx", np.dtype(np.uint32), 1, False, 5),
+            ("offset", np.dtype(np.int32), 1, True, 5),
+        ]
+    )
+    events = np.zeros(1000, dtype=layout.dtype)
+    events["detector_ids"] = rng.integers(0, 50000, (1000, 2))
+    events["tof_idx"] = rng.integers(0, 20, 1000)
+    events["offset"] = rng.integers(-300, 300, 1000)
+    encoded = np.frombuffer(layout.encode(events), dtype=np.uint8)
+    nbEvents, pos = _readVarint(encoded.tobytes(), 0)
+    decoded, end = layout.decode(encoded, pos, nbEvents)
+    assert nbEvents == 1000 and end == len(encoded)
+    assert decoded.tobytes() == events.tobytes()
+
+    # Values not fitting in the record type are rejected, not wrapped
+    wideEvents = np.zeros(
+        2, dtype=[("detector_ids", np.int64, (2,)), ("tof_idx", np.int64), ("offset", np.int64)]
+    )
+    wideEvents["tof_idx"] = [3, 2**32]
+    try:
+        layout.encode(wideEvents)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("an out of range tof_idx must be rejected")
+    wideEvents["tof_idx"] = [3, -1]
+    try:
+        layout.encode(wideEvents)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a negative tof_idx must be rejected")
+    wideEvents["tof_idx"] = [3, 4]
+    assert layout.encode(wideEvents) == layout.encode(wideEvents.astype(layout.dtype))
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    testVarintCodec()
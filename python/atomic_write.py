@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Write the cache and sidecar files of the tools (physio .npy sidecar, time block
+index, gate cache) so that a concurrent or killed run never leaves a partial file that a
+later run would load: the file is written under a temporary name, then renamed.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import glob
+import os
+import tempfile
+from typing import BinaryIO, Callable, Union
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def saveAtomically(
+    path: str, save: Callable[[BinaryIO], None], stalePattern: Union[str, None] = None
+):
+    """
+    Write path with save(file), through a temporary file of the same directory. The
+    files matching the glob stalePattern (e.g. the sidecars of older versions of the same
+    input) are removed first. An OSError is raised as is, the temporary file removed.
+    """
+    if stalePattern is not None:
+        for stalePath in glob.glob(stalePattern):
+            os.remove(stalePath)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmpPath, "wb") as f:
+            save(f)
+        os.replace(tmpPath, path)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testSaveAtomically():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        path = os.path.join(tmpDir, "data.1_2.npy")
+        open(os.path.join(tmpDir, "data.0_1.npy"), "wb").close()
+        saveAtomically(path, lambda f: f.write(b"new"), os.path.join(tmpDir, "data.*_*.npy"))
+        assert sorted(os.listdir(tmpDir)) == ["data.1_2.npy"]
+
+        def failingSave(f):
+            f.write(b"partial")
+            raise OSError("disk full")
+
+        try:
+            saveAtomically(path, failingSave)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("the write failure was not raised")
+        # The previous file is left untouched and no temporary file remains
+        assert sorted(os.listdir(tmpDir)) == ["data.1_2.npy"]
+        with open(path, "rb") as f:
+            assert f.read() == b"new"
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    testSaveAtomically()
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Measure the tools (rnd_sampler, merger, rnd_gating_amplitude, append_physio) on
+synthetic acquisitions of several sizes, so regressions and speedups can be tracked.
+
+For each duration, synthetic inputs are generated (see synthetic_petsird.py, not
+measured), then each tool is run as its own process. The wall time, the input events
+per second and the peak resident memory (RSS) of the process are recorded.
+
+One JSON object per benchmark run (date, versions, git commit, results) is appended to
+the results file (JSON Lines), e.g.:
+	python benchmark.py --durations 5 30 --results benchmark_results.jsonl
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from synthetic_petsird import (
+    RESP_AMPLITUDE,
+    RESP_BASELINE,
+    writePhysioCsv,
+    writeSyntheticAcquisition,
+)
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Options of the write-behind cases (see write_behind.py), against the same tool without them
+WRITE_BEHIND = ["--writeBatch", "64", "--writeDepth", "4"]
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def runMeasured(argv: List[str], cwd: str):
+    """Run argv, returns (wall time in s, peak RSS in MB, return code)."""
+    tStart = time.perf_counter()
+    process = subprocess.Popen(
+        argv, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    wallTime = time.perf_counter() - tStart
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kB on Linux
+    return wallTime, usage.ru_maxrss / 1024.0, process.returncode
+
+
+def prepareInputs(workDir: str, duration: float, countRate: float, seed: int):
+    """Synthetic inputs of one size, returns their paths and their number of events."""
+    inputs = {
+        "acq": os.path.join(workDir, f"acq_{duration:g}s.petsird"),
+        "acq2": os.path.join(workDir, f"acq2_{duration:g}s.petsird"),
+        "physioMs": os.path.join(workDir, f"physio_ms_{duration:g}s.csv"),
+        "physioS": os.path.join(workDir, f"physio_s_{duration:g}s.csv"),
+    }
+    stats = writeSyntheticAcquisition(inputs["acq"], duration, countRate=countRate, seed=seed)
+    stats2 = writeSyntheticAcquisition(
+        inputs["acq2"], duration, countRate=countRate, seed=seed + 1
+    )
+    nbPhysio = writePhysioCsv(inputs["physioMs"], duration, 100.0, "ms")
+    writePhysioCsv(inputs["physioS"], duration, 100.0, "s")
+
+    nbEvents = int(stats[1] + stats[2])
+    inputs["nbEvents"] = nbEvents
+    inputs["nbEventsMerge"] = nbEvents + int(stats2[1] + stats2[2])
+    inputs["nbPhysio"] = nbPhysio
+    return inputs
+
+
+def benchmarkCases(inputs: dict, workDir: str):
+    """(tool, case, command, number of input events) of each measurement."""
+    python = sys.executable
+
+    def script(name: str):
+        return os.path.join(SCRIPT_DIR, name)
+
+    def output(name: str):
+        return os.path.join(workDir, name)
+
+    return [
+        (
+            "rnd_sampler",
+            "timeBlock",
+            [python, script("rnd_sampler.py"), "--acqFile", inputs["acq"], "-r", "0.5",
+             "-m", "timeBlock", "-s", "0", "-o", output("sampled.petsird")],
+            inputs["nbEvents"],
+        ),
+        (
+            "rnd_sampler",
+            "event",
+            [python, script("rnd_sampler.py"), "--acqFile", inputs["acq"], "-r", "0.5",
+             "-m", "event", "-s", "0", "-o", output("sampled.petsird")],
+            inputs["nbEvents"],
+        ),
+        (
+            "rnd_sampler",
+            "eventWriteBehind",
+            [python, script("rnd_sampler.py"), "--acqFile", inputs["acq"], "-r", "0.5",
+             "-m", "event", "-s", "0", "-o", output("sampled.petsird")] + WRITE_BEHIND,
+            inputs["nbEvents"],
+        ),
+        (
+            "rnd_sampler",
+            "eventArrayCodec",
+            [python, script("rnd_sampler.py"), "--acqFile", inputs["acq"], "-r", "0.5",
+             "-m", "event", "-s", "0", "-o", output("sampled.petsird"), "--arrayCodec"],
+            inputs["nbEvents"],
+        ),
+        (
+            "merger",
+            "merge",
+            [python, script("merger.py"), "--merge", inputs["acq"], inputs["acq2"],
+             "--outputFile", output("merged.petsird")],
+            inputs["nbEventsMerge"],
+        ),
+        (
+            "merger",
+            "mergeWriteBehind",
+            [python, script("merger.py"), "--merge", inputs["acq"], inputs["acq2"],
+             "--outputFile", output("merged.petsird")] + WRITE_BEHIND,
+            inputs["nbEventsMerge"],
+        ),
+        (
+            "merger",
+            "mergeArrayCodec",
+            [python, script("merger.py"), "--merge", inputs["acq"], inputs["acq2"],
+             "--outputFile", output("merged.petsird"), "--arrayCodec"],
+            inputs["nbEventsMerge"],
+        ),
+        (
+            "rnd_gating_amplitude",
+            "csv",
+            [python, script("rnd_gating_amplitude.py"), inputs["acq"], "4",
+             str(RESP_BASELINE - RESP_AMPLITUDE), str(RESP_BASELINE + RESP_AMPLITUDE),
+             "--physio", inputs["physioS"], "--write_batch", "1"],
+            inputs["nbEvents"],
+        ),
+        (
+            "rnd_gating_amplitude",
+            "csvWriteBehind",
+            [python, script("rnd_gating_amplitude.py"), inputs["acq"], "4",
+             str(RESP_BASELINE - RESP_AMPLITUDE), str(RESP_BASELINE + RESP_AMPLITUDE),
+             "--physio", inputs["physioS"], "--write_batch", "64", "--write_depth", "4"],
+            inputs["nbEvents"],
+        ),
+        (
+            "append_physio",
+            "stream",
+            [python, script("append_physio.py"), "-i", inputs["acq"], "-o",
+             output("physio.petsird"), "-p", inputs["physioMs"], "-t", "resp_trace",
+             "--stream"],
+            inputs["nbEvents"],
+        ),
+    ]
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(
+    durations: List[float], countRate: float, repeat: int, seed: int, verbose: int
+):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="petsird_bench_") as workDir:
+        for cDuration in durations:
+            inputs = prepareInputs(workDir, cDuration, countRate, seed)
+            for cTool, cCase, argv, nbEvents in benchmarkCases(inputs, workDir):
+                for cRepeat in range(repeat):
+                    wallTime, peakRss, returnCode = runMeasured(argv, workDir)
+                    cResult = {
+                        "tool": cTool,
+                        "case": cCase,
+                        "duration_s": cDuration,
+                        "count_rate": countRate,
+                        "nb_events": nbEvents,
+                        "repeat": cRepeat,
+                        "wall_s": wallTime,
+                        "events_per_s": nbEvents / wallTime,
+                        "peak_rss_mb": peakRss,
+                        "return_code": returnCode,
+                    }
+                    results.append(cResult)
+                    if verbose > 0:
+                        print(
+                            f"{cTool:>22} {cCase:>10} {cDuration:>8g} s: "
+                            f"{wallTime:8.3f} s, {nbEvents / wallTime:.3e} events/s, "
+                            f"{peakRss:8.1f} MB"
+                            + ("" if returnCode == 0 else f" (FAILED, code {returnCode})"),
+                            file=sys.stderr,
+                        )
+    return results
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tools on synthetic acquisitions of several sizes."
+    )
+
+    parser.add_argument(
+        "-d",
+        "--durations",
+        action="store",
+        type=float,
+        nargs="+",
+        default=[5.0, 30.0],
+        dest="durations",
+        help="Durations (s) of the synthetic acquisitions.",
+    )
+    parser.add_argument(
+        "-c",
+        "--countRate",
+        action="store",
+        type=float,
+        default=1e5,
+        dest="countRate",
+        help="Mean number of prompts per second of the synthetic acquisitions.",
+    )
+    parser.add_argument(
+        "--repeat",
+        action="store",
+        type=int,
+        default=1,
+        dest="repeat",
+        help="Number of runs of each measurement.",
+    )
+    parser.add_argument(
+        "-r",
+        "--results",
+        action="store",
+        type=str,
+        default="benchmark_results.jsonl",
+        dest="results",
+        help="File where the results of this run are appended (JSON Lines).",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        action="store",
+        type=int,
+        default=0,
+        dest="seed",
+        help="Seed of the synthetic acquisitions.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store",
+        type=int,
+        default=1,
+        dest="verbose",
+        help="Level of verbosity of the script.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    results = runBenchmarks(
+        args.durations, args.countRate, args.repeat, args.seed, args.verbose
+    )
+    record = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": gitCommit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "petsird": getattr(petsird, "__version__", None),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    if any(cResult["return_code"] != 0 for cResult in results):
+        sys.exit("Some of the benchmarked runs failed.")
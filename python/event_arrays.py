@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Provide the array form of the event lists of an EventTimeBlock so that the tools
+can select, drop or reorder events with NumPy instead of looping over them in python.
+
+An "event array" is a one dimension numpy array holding the events of one list
+(prompts, delays or triples) of a time block. Indexing it with a mask or with indices
+never creates new event objects, it only moves references around. It is either an
+object array of petsird events, or a structured array whose fields are the event fields
+(as read by ArrayPETSIRDReader, see array_codec.py).
+
+The index fields of the events (eventFieldArray, detectorIdArray) are a single array
+gather for a structured array only: for event objects, they are still gathered with one
+attribute lookup per event in python. The tools looking up the events by their fields
+(event_filter, region_splitter, and rnd_sampler/merger for the histograms) take
+--arrayCodec to read structured arrays.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import itertools
+from typing import List, Sequence, Union
+
+# Other module
+import numpy as np
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def asEventArray(_events: Union[Sequence, np.ndarray, None]) -> Union[np.ndarray, None]:
+    if _events is None or isinstance(_events, np.ndarray):
+        return _events
+
+    # fromiter keeps numpy from looking inside the events (requires numpy >= 1.23)
+    return np.fromiter(_events, dtype=object, count=len(_events))
+
+
+def isStructuredEventArray(_events) -> bool:
+    return isinstance(_events, np.ndarray) and _events.dtype.names is not None
+
+
+def asEventList(_events: Union[np.ndarray, None]) -> Union[list, np.ndarray, None]:
+    """Event objects as a list, structured arrays are kept (encoded as arrays)."""
+    if _events is None or isStructuredEventArray(_events):
+        return _events
+    return _events.tolist()
+
+
+def nbEvents(_events: Union[Sequence, np.ndarray, None]) -> int:
+    if _events is None:
+        return 0
+    return len(_events)
+
+
+def thinEvents(
+    _events: Union[Sequence, np.ndarray, None], _retFrac: float, _rng: np.random.Generator
+) -> Union[np.ndarray, None]:
+    """Keep each event independently with probability _retFrac (one draw per list)."""
+    if _events is None:
+        return None
+    eventArray = asEventArray(_events)
+    return eventArray[_rng.random(len(eventArray)) < _retFrac]
+
+
+def withEventArrays(_cTimeBlock):
+    """Copy of an event time block whose event lists are converted once to arrays."""
+    # Imported here so the pure array helpers do not require petsird
+    import petsird
+
+    cValue = _cTimeBlock.value
+    return petsird.TimeBlock.EventTimeBlock(
+        petsird.EventTimeBlock(
+            start=cValue.start,
+            prompt_events=asEventArray(cValue.prompt_events),
+            delayed_events=asEventArray(cValue.delayed_events),
+            triple_events=asEventArray(cValue.triple_events),
+        )
+    )
+
+
+def selectEvents(
+    _events: Union[Sequence, np.ndarray, None], _nbKept: int, _rng: np.random.Generator
+) -> Union[np.ndarray, None]:
+    """Exactly _nbKept events drawn without replacement, in their original order."""
+    if _events is None:
+        return None
+    eventArray = asEventArray(_events)
+    keep = np.zeros(len(eventArray), dtype=bool)
+    keep[_rng.choice(len(eventArray), _nbKept, replace=False)] = True
+    return eventArray[keep]
+
+
+def bootstrapEvents(
+    _events: Union[Sequence, np.ndarray, None], _lambda: float, _rng: np.random.Generator
+) -> Union[np.ndarray, None]:
+    """Repeat each event k ~ Poisson(_lambda) times (one draw per list)."""
+    if _events is None:
+        return None
+    eventArray = asEventArray(_events)
+    return np.repeat(eventArray, _rng.poisson(_lambda, len(eventArray)))
+
+
+def concatEvents(_eventLists: Sequence) -> Union[np.ndarray, None]:
+    """Concatenate event lists, None entries (absent lists) are skipped."""
+    eventArrays = [asEventArray(cEvents) for cEvents in _eventLists if cEvents is not None]
+    if len(eventArrays) == 0:
+        return None
+    if len(eventArrays) == 1:
+        return eventArrays[0]
+    return np.concatenate(eventArrays)
+
+
+def eventFieldArray(_events: Union[Sequence, np.ndarray, None], _field: str) -> np.ndarray:
+    """
+    Index field of the events (detector_ids, tof_idx, energy_indices...) as a (n, k)
+    array, k being 1 for a scalar field. One column gather for a structured array, one
+    getattr per event for event objects.
+    """
+    if nbEvents(_events) == 0:
+        return np.empty((0, 1), dtype=np.int64)
+    if isStructuredEventArray(_events):
+        return _events[_field].astype(np.int64).reshape(len(_events), -1)
+    firstValue = getattr(_events[0], _field)
+    if np.ndim(firstValue) == 0:
+        return np.fromiter(
+            (getattr(cEvent, _field) for cEvent in _events),
+            dtype=np.int64,
+            count=len(_events),
+        ).reshape(-1, 1)
+    return np.fromiter(
+        itertools.chain.from_iterable(getattr(cEvent, _field) for cEvent in _events),
+        dtype=np.int64,
+        count=len(_events) * len(firstValue),
+    ).reshape(-1, len(firstValue))
+
+
+def detectorIdArray(_events: Union[Sequence, np.ndarray, None]) -> np.ndarray:
+    """Detector ids of the events as a (n, k) array, k detectors per event (2 for coincidences)."""
+    if nbEvents(_events) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return eventFieldArray(_events, "detector_ids")
+
+
+def splitEvents(
+    _events: Union[Sequence, np.ndarray], _groups: np.ndarray, _nbGroups: int
+) -> List[np.ndarray]:
+    """
+    Event arrays of each group, _groups being the group (in [0, _nbGroups)) of each
+    event. The order of the events is kept within a group.
+    """
+    order = np.argsort(_groups, kind="stable")
+    counts = np.bincount(_groups, minlength=_nbGroups)
+    return np.split(asEventArray(_events)[order], np.cumsum(counts)[:-1])
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Re-window an acquisition, e.g. narrow the energy window or drop the outer TOF
+bins, without looping over the events in python.
+
+The TOF and energy bin edges of the header (header.scanner) are read once to build
+boolean lookup tables: bin index -> kept. A bin is kept when its centre is in the
+requested window. For each event list of an EventTimeBlock, the TOF and energy
+indices are gathered in arrays and the events are kept with one mask: all the TOF
+bins and all the energy bins of an event must be kept. Indices outside the bins of the
+header are dropped.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import sys
+from typing import Sequence, Union
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from array_codec import ArrayPETSIRDWriter, addArrayCodecArguments, openReader
+from event_arrays import asEventArray, eventFieldArray, isStructuredEventArray, nbEvents
+from rnd_sampler import buildEventTimeBlock, defineWriter, providBasicStat
+from timeblock_utils import isEventTimeBlock
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def binKeepLut(
+    binEdges: Sequence[float],
+    window: Union[Sequence[float], None] = None,
+    dropOuter: int = 0,
+) -> np.ndarray:
+    """
+    Kept bins: centre in window ([low, high], all bins if None) and not among the
+    dropOuter first or last bins.
+    """
+    binEdges = np.asarray(binEdges, dtype=np.float64)
+    centres = 0.5 * (binEdges[:-1] + binEdges[1:])
+    keep = np.ones(len(centres), dtype=bool)
+    if window is not None:
+        keep &= (centres >= window[0]) & (centres <= window[1])
+    if dropOuter > 0:
+        keep[:dropOuter] = False
+        keep[len(keep) - dropOuter :] = False
+    return keep
+
+
+def defineLuts(scanner, energyWindow=None, tofWindow=None, dropOuterTofBins: int = 0):
+    """(TOF, energy) lookup tables, None when the corresponding selection is not used."""
+    tofLut = None
+    if tofWindow is not None or dropOuterTofBins > 0:
+        tofLut = binKeepLut(scanner.tof_bin_edges, tofWindow, dropOuterTofBins)
+    energyLut = None
+    if energyWindow is not None:
+        energyLut = binKeepLut(scanner.energy_bin_edges, energyWindow)
+    return tofLut, energyLut
+
+
+def lutMask(indices: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Events whose indices ((n, k) array) are all kept by the lookup table."""
+    # One extra False entry for the indices outside the table
+    paddedLut = np.append(lut, False)
+    return np.all(paddedLut[np.clip(indices, 0, len(lut))], axis=1)
+
+
+def filterEvents(
+    _events: Union[Sequence, np.ndarray, None],
+    tofLut: Union[np.ndarray, None],
+    energyLut: Union[np.ndarray, None],
+) -> Union[np.ndarray, None]:
+    if _events is None or nbEvents(_events) == 0:
+        return asEventArray(_events)
+
+    keep = np.ones(len(_events), dtype=bool)
+    if tofLut is not None:
+        # Coincidences have one TOF index, triples may have several
+        if isStructuredEventArray(_events):
+            tofField = "tof_idx" if "tof_idx" in _events.dtype.names else "tof_indices"
+        else:
+            tofField = "tof_idx" if hasattr(_events[0], "tof_idx") else "tof_indices"
+        keep &= lutMask(eventFieldArray(_events, tofField), tofLut)
+    if energyLut is not None:
+        keep &= lutMask(eventFieldArray(_events, "energy_indices"), energyLut)
+    return asEventArray(_events)[keep]
+
+
+def filterTimeBlock(cTimeBlock, tofLut, energyLut):
+    """(filtered time block,), (prompts, delays, triples) kept. Same form as the samplers of rnd_sampler."""
+    return buildEventTimeBlock(
+        cTimeBlock,
+        filterEvents(cTimeBlock.value.prompt_events, tofLut, energyLut),
+        filterEvents(cTimeBlock.value.delayed_events, tofLut, energyLut),
+        filterEvents(cTimeBlock.value.triple_events, tofLut, energyLut),
+    )
+
+
+def filterTimeBlocks(timeBlocks, writer, tofLut, energyLut):
+    """
+    Write the filtered time blocks. Returns the totals [timeBlock, prompt, delay,
+    triple] of the input and the counts kept.
+    """
+    nbTotal = np.zeros(4, dtype=np.int64)
+    nbKept = np.zeros(4, dtype=np.int64)
+    for cTimeBlock in timeBlocks:
+        if not isEventTimeBlock(cTimeBlock):
+            writer.write_time_blocks((cTimeBlock,))
+            continue
+
+        nbTotal += (
+            1,
+            nbEvents(cTimeBlock.value.prompt_events),
+            nbEvents(cTimeBlock.value.delayed_events),
+            nbEvents(cTimeBlock.value.triple_events),
+        )
+        resTimeBlock, stats = filterTimeBlock(cTimeBlock, tofLut, energyLut)
+        writer.write_time_blocks(resTimeBlock)
+        nbKept += (1,) + stats
+    return nbTotal, nbKept
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Keep only the events in an energy window and/or TOF range."
+    )
+
+    ##################################################
+    # Basic
+    parser.add_argument(
+        "--acqFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="acq",
+        help="The acquisition, in PETSIRD format, to filter.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        default=None,
+        dest="oFile",
+        help="The path/name where to save the resulting list mode. If "
+        "it is not defined, it will be written in the std.out.",
+    )
+
+    ##################################################
+    # Feature
+    parser.add_argument(
+        "-e",
+        "--energyWindow",
+        action="store",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("LOW", "HIGH"),
+        dest="energyWindow",
+        help="Keep the energy bins whose centre is in [LOW, HIGH] (unit of the "
+        "energy bin edges of the header, keV).",
+    )
+    parser.add_argument(
+        "-t",
+        "--tofWindow",
+        action="store",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("LOW", "HIGH"),
+        dest="tofWindow",
+        help="Keep the TOF bins whose centre is in [LOW, HIGH] (unit of the TOF bin "
+        "edges of the header).",
+    )
+    parser.add_argument(
+        "--dropOuterTofBins",
+        action="store",
+        type=int,
+        default=0,
+        dest="dropOuterTofBins",
+        help="Drop this number of TOF bins at each end of the TOF range.",
+    )
+    addArrayCodecArguments(parser)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store",
+        type=int,
+        default=0,
+        dest="verbose",
+        help="Level of verbosity of the script.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testLuts():
+    energyLut = binKeepLut([400.0, 450.0, 500.0, 550.0, 600.0], (440.0, 560.0))
+    assert energyLut.tolist() == [False, True, True, False]
+    tofLut = binKeepLut(np.linspace(-5.0, 5.0, 6), dropOuter=1)
+    assert tofLut.tolist() == [False, True, True, True, False]
+
+    indices = np.array([[1, 2], [0, 1], [2, 7]])
+    assert lutMask(indices, energyLut).tolist() == [True, False, False]
+
+    # Structured arrays (array codec): the TOF field is taken from the dtype
+    triples = np.zeros(
+        3, dtype=[("detector_ids", np.uint32, (3,)), ("tof_indices", np.uint32, (2,))]
+    )
+    triples["tof_indices"] = [[1, 2], [0, 1], [3, 3]]
+    assert filterEvents(triples, tofLut, None)["tof_indices"].tolist() == [[1, 2], [3, 3]]
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    reader = openReader(args.acq, args.arrayCodec)
+    header = reader.read_header()
+    tofLut, energyLut = defineLuts(
+        header.scanner, args.energyWindow, args.tofWindow, args.dropOuterTofBins
+    )
+    if tofLut is None and energyLut is None:
+        print("Warning: no energy or TOF selection, the events are copied.", file=sys.stderr)
+    if args.verbose > 0:
+        for cName, cLut in (("TOF", tofLut), ("energy", energyLut)):
+            if cLut is not None:
+                print(
+                    f"{cName} bins kept: {np.flatnonzero(cLut).tolist()} out of {len(cLut)}",
+                    file=sys.stderr,
+                )
+
+    writerClass = ArrayPETSIRDWriter if args.arrayCodec else petsird.BinaryPETSIRDWriter
+    with writerClass(defineWriter(args.oFile, args.verbose)) as writer:
+        writer.write_header(header)
+        nbTotal, nbKept = filterTimeBlocks(reader.read_time_blocks(), writer, tofLut, energyLut)
+
+    if nbTotal[1] == 0:
+        print("Warning: the acquisition has no prompt.", file=sys.stderr)
+    else:
+        providBasicStat(
+            args.verbose,
+            "event",
+            nbTotal[0],
+            nbKept[0],
+            nbTotal[1],
+            nbKept[1],
+            nbTotal[2],
+            nbKept[2],
+            nbTotal[3],
+            nbKept[3],
+        )
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Split an acquisition in time frames (dynamic framing, e.g. "6x10s,4x60s,5x300s")
+or crop it to a single time window, writing every frame to its own PETSIRD file while
+reading the acquisition only once.
+
+Every time block goes to the frame holding its start time (ms, measured from the start
+of the acquisition time axis, shifted by --offset). The time blocks outside the schedule
+are dropped. The header is copied once into each output.
+
+When the acquisition has a time block index (see tb_index.py), only the time blocks
+spanning the schedule are decoded, the reader seeks straight to the first one.
+
+TODO:
+	Core:
+		- The time blocks are not cut: a block overlapping two frames goes to the first.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import contextlib
+import os
+import re
+import sys
+from typing import Iterable, List, Tuple
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from event_arrays import nbEvents
+from tb_index import loadIndex, readTimeBlocks
+from timeblock_utils import isEventTimeBlock, timeBlockStart
+
+
+# Duration of the time units accepted in a frame schedule, in ms
+TIME_UNITS = {"ms": 1, "s": 1000, "min": 60_000, "h": 3_600_000}
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def parseDuration(duration: str) -> int:
+    """Duration in ms of "10s", "2.5min", "500ms"... A bare number is in seconds."""
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*(ms|s|min|h)?\s*", duration)
+    if match is None:
+        raise ValueError(f"Invalid duration: {duration!r}")
+    value, unit = match.groups()
+    return int(round(float(value) * TIME_UNITS[unit or "s"]))
+
+
+def parseFrameSchedule(schedule: str, offset: int = 0) -> np.ndarray:
+    """
+    Edges (ms) of the frames of a schedule "NxDuration,...", e.g. "6x10s,4x60s". The
+    first frame starts at offset. Frame i is [edges[i], edges[i+1]).
+    """
+    durations = []
+    for cEntry in schedule.split(","):
+        nbFrame, sep, duration = cEntry.strip().rpartition("x")
+        nbFrame = int(nbFrame) if sep else 1
+        if nbFrame < 1:
+            raise ValueError(f"Invalid number of frames in {cEntry!r}")
+        durations += [parseDuration(duration)] * nbFrame
+
+    durations = np.asarray(durations, dtype=np.int64)
+    if np.any(durations <= 0):
+        raise ValueError(f"Frames must have a positive duration: {schedule!r}")
+    return offset + np.concatenate(([0], np.cumsum(durations)))
+
+
+def frameOfStarts(starts: np.ndarray, frameEdges: np.ndarray) -> np.ndarray:
+    """Frame of each start time, -1 for the ones outside the schedule."""
+    frames = np.searchsorted(frameEdges, starts, side="right") - 1
+    frames[(starts < frameEdges[0]) | (starts >= frameEdges[-1])] = -1
+    return frames
+
+
+def defineFrameOutputs(oFile: str, nbFrames: int):
+    if "{}" in oFile:
+        return [oFile.format(cFrame) for cFrame in range(nbFrames)]
+    stem, ext = os.path.splitext(oFile)
+    return [f"{stem}_frame{cFrame}{ext}" for cFrame in range(nbFrames)]
+
+
+def indexedWindow(index: np.ndarray, frameEdges: np.ndarray) -> Tuple[int, int]:
+    """
+    Bounds [first, stop) of the time blocks to decode to get all the ones starting in
+    the schedule. The blocks are not assumed sorted in time, e.g. physio blocks
+    appended at the end of the file.
+    """
+    inWindow = np.flatnonzero(frameOfStarts(index["start"], frameEdges) >= 0)
+    if len(inWindow) == 0:
+        return 0, 0
+    return int(inWindow[0]), int(inWindow[-1]) + 1
+
+
+def splitTimeBlocks(
+    timeBlocks: Iterable,
+    writers: List[petsird.BinaryPETSIRDWriter],
+    frameEdges: np.ndarray,
+):
+    """
+    Write each time block to the writer of its frame. Returns the number of time
+    blocks and of prompts written in each frame.
+    """
+    nbTimeBlock = np.zeros(len(writers), dtype=np.int64)
+    nbPrompt = np.zeros(len(writers), dtype=np.int64)
+
+    for cTimeBlock in timeBlocks:
+        start = timeBlockStart(cTimeBlock)
+        if start < frameEdges[0] or start >= frameEdges[-1]:
+            continue
+        cFrame = int(np.searchsorted(frameEdges, start, side="right")) - 1
+        writers[cFrame].write_time_blocks((cTimeBlock,))
+        nbTimeBlock[cFrame] += 1
+        if isEventTimeBlock(cTimeBlock):
+            nbPrompt[cFrame] += nbEvents(cTimeBlock.value.prompt_events)
+
+    return nbTimeBlock, nbPrompt
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Split an acquisition in time frames, or crop it to a time "
+        "window, in a single reading pass."
+    )
+
+    ##################################################
+    # Basic
+    parser.add_argument(
+        "--acqFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="acq",
+        help="The acquisition, in PETSIRD format, to split.",
+    )
+    schedule = parser.add_mutually_exclusive_group(required=True)
+    schedule.add_argument(
+        "-f",
+        "--frames",
+        action="store",
+        type=str,
+        dest="frames",
+        help='The frame schedule, e.g. "6x10s,4x60s,5x300s". Durations are in ms, '
+        "s, min or h (s if no unit is given).",
+    )
+    schedule.add_argument(
+        "-c",
+        "--crop",
+        action="store",
+        type=str,
+        nargs=2,
+        metavar=("START", "STOP"),
+        dest="crop",
+        help="Keep only the time blocks starting in [START, STOP), e.g. 60s 90s.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="oFile",
+        help="The path/name of the frames. Frame i is saved as <outputFile>_frame<i>, "
+        "or at the place of {} if the output file name contains it. A crop is saved "
+        "as the output file itself.",
+    )
+
+    ##################################################
+    # Feature
+    parser.add_argument(
+        "--offset",
+        action="store",
+        type=str,
+        default="0",
+        dest="offset",
+        help="Start time of the first frame of --frames (e.g. 30s).",
+    )
+    parser.add_argument(
+        "--useIndex",
+        action="store_true",
+        default=False,
+        dest="useIndex",
+        help="Build the time block index of the acquisition if it is missing or "
+        "stale (see tb_index.py). An existing index is always used.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store",
+        type=int,
+        default=0,
+        dest="verbose",
+        help="Level of verbosity of the script.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testParseFrameSchedule():
+    edges = parseFrameSchedule("2x10s, 1x1min,500ms", offset=1000)
+    assert edges.tolist() == [1000, 11000, 21000, 81000, 81500]
+    assert parseDuration("2.5") == 2500
+
+
+def testFrameOfStarts():
+    edges = np.array([0, 10, 30])
+    starts = np.array([-1, 0, 9, 10, 29, 30, 100])
+    assert frameOfStarts(starts, edges).tolist() == [-1, 0, 0, 1, 1, -1, -1]
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    if args.crop is not None:
+        frameEdges = np.array([parseDuration(cTime) for cTime in args.crop], dtype=np.int64)
+        if frameEdges[1] <= frameEdges[0]:
+            sys.exit("The crop window must end after its start.")
+        frameOutputs = [args.oFile]
+    else:
+        frameEdges = parseFrameSchedule(args.frames, parseDuration(args.offset))
+        frameOutputs = defineFrameOutputs(args.oFile, len(frameEdges) - 1)
+
+    reader = petsird.BinaryPETSIRDReader(args.acq)
+    header = reader.read_header()
+
+    index = loadIndex(args.acq, build=args.useIndex)
+    if index is not None:
+        first, stop = indexedWindow(index, frameEdges)
+        timeBlocks = readTimeBlocks(args.acq, index, first, stop)
+        if args.verbose > 0:
+            print(
+                f"Decoding the time blocks [{first}, {stop}) out of {len(index)}",
+                file=sys.stderr,
+            )
+    else:
+        timeBlocks = reader.read_time_blocks()
+
+    with contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(petsird.BinaryPETSIRDWriter(cOutput))
+            for cOutput in frameOutputs
+        ]
+        for writer in writers:
+            writer.write_header(header)
+
+        nbTimeBlock, nbPrompt = splitTimeBlocks(timeBlocks, writers, frameEdges)
+
+        # An empty frame is still a valid list mode
+        for cFrame in np.flatnonzero(nbTimeBlock == 0):
+            print(
+                f"Warning: No time block in frame {cFrame} "
+                f"[{frameEdges[cFrame]}, {frameEdges[cFrame + 1]}) ms",
+                file=sys.stderr,
+            )
+            writers[cFrame].write_time_blocks(
+                (
+                    petsird.TimeBlock.EventTimeBlock(
+                        petsird.EventTimeBlock(
+                            start=int(frameEdges[cFrame]),
+                            prompt_events=[],
+                        ),
+                    ),
+                )
+            )
+
+    # The reader is only partially consumed when the index is used
+    reader._close()
+
+    if args.verbose > 0:
+        for cFrame, cOutput in enumerate(frameOutputs):
+            print(
+                f"Frame {cFrame} [{frameEdges[cFrame]}, {frameEdges[cFrame + 1]}) ms: "
+                f"{nbTimeBlock[cFrame]} time blocks, {nbPrompt[cFrame]} prompts -> {cOutput}",
+                file=sys.stderr,
+            )
@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Histogram the events of the splitting tools (gating, sampling, merging) directly,
+as detector pair x TOF bin histograms for the reconstruction, instead of writing list
+modes which would be histogrammed afterwards.
+
+A HistogramWriter has the methods of a PETSIRD writer (write_header, write_time_blocks,
+close), so the tools use it in place of their writers. The number of detectors and of
+TOF bins are read from the header (header.scanner). The bin of a coincidence is
+	lor * nbTofBins + tof,
+lor = hi * (hi + 1) / 2 + lo being the index of the unordered detector pair (lo <= hi),
+and the TOF index being mirrored (nbTofBins - 1 - tof) when the detectors are swapped
+(detector_ids[0] > detector_ids[1]). Prompts and delays are histogrammed separately,
+triples are not histogrammed.
+
+The bins of the events are computed by batch with numpy and buffered, the buffer is
+added to the histogram when it holds bufferSize events. The histogram is either:
+	- chunked: dense chunks of chunkSize bins, only allocated when an event falls in
+	  them (memory: 4 bytes x chunkSize per touched chunk),
+	- sparse: the sorted non zero bins and their counts (memory: 16 bytes per non zero
+	  bin), for large scanners whose dense histogram does not fit in memory.
+It is saved in a .npz file: dense ("prompts", "delays": (nbLors, nbTofBins) arrays)
+unless the sparse storage is requested or does not fit in the dense bin budget, otherwise
+sparse ("prompts_bins", "prompts_counts", ...). The writers of a run share one
+HistogramBudget of MAX_DENSE_BINS dense bins: the first writers take their dense bins from
+it, the writers opened when it is spent are sparse, so the memory of the dense histograms
+stays bounded whatever the number of outputs (replicates, gates...).
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import os
+import sys
+import threading
+from typing import BinaryIO, Union
+
+# Other module
+import numpy as np
+
+# This project module
+from event_arrays import detectorIdArray, eventFieldArray, nbEvents
+from timeblock_utils import isEventTimeBlock
+
+
+MAX_DENSE_BINS = 1 << 28  # 1 GB of uint32, for all the histograms of a run
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def addHistogramArguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--histogram",
+        action="store_true",
+        default=False,
+        dest="histogram",
+        help="Save detector pair x TOF bin histograms (.npz) instead of list modes "
+        "(see histogrammer.py).",
+    )
+    parser.add_argument(
+        "--histogramSparse",
+        action="store_true",
+        default=False,
+        dest="histogramSparse",
+        help="Accumulate and save the histograms as sparse (bin, count) arrays.",
+    )
+
+
+def histogramOutput(output: Union[str, BinaryIO]) -> Union[str, BinaryIO]:
+    """The .npz path of a list mode output (streams are kept)."""
+    if not isinstance(output, str):
+        return output
+    return os.path.splitext(output)[0] + ".npz"
+
+
+def histogramBins(detectorIds: np.ndarray, tofIdx: np.ndarray, nbTofBins: int) -> np.ndarray:
+    """Bin of each coincidence, from its (n, 2) detector ids and (n,) TOF indices."""
+    lo = np.minimum(detectorIds[:, 0], detectorIds[:, 1])
+    hi = np.maximum(detectorIds[:, 0], detectorIds[:, 1])
+    swapped = detectorIds[:, 0] > detectorIds[:, 1]
+    tof = np.where(swapped, nbTofBins - 1 - tofIdx, tofIdx)
+    return (hi * (hi + 1) // 2 + lo) * nbTofBins + tof
+
+
+class HistogramBudget:
+    """Dense bins left to the histograms of a run, shared by their writers."""
+
+    def __init__(self, maxDenseBins: int = MAX_DENSE_BINS):
+        self.remaining = maxDenseBins
+        self.warned = False
+        # The gate writers are opened on an encoder thread
+        self._lock = threading.Lock()
+
+    def reserve(self, nbBins: int) -> bool:
+        with self._lock:
+            if nbBins > self.remaining:
+                return False
+            self.remaining -= nbBins
+            return True
+
+
+class HistogramAccumulator:
+    def __init__(
+        self,
+        nbBins: int,
+        sparse: bool = False,
+        chunkSize: int = 1 << 20,
+        bufferSize: int = 1 << 22,
+    ):
+        self.nbBins = nbBins
+        self.sparse = sparse
+        self.chunkSize = chunkSize
+        self.bufferSize = bufferSize
+        self.nbEvents = 0
+        self._buffer = []
+        self._nbBuffered = 0
+        # Chunked storage: chunk id -> dense counts, sparse storage: sorted bins/counts
+        self._chunks = {}
+        self._bins = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+
+    def add(self, bins: np.ndarray):
+        if len(bins) == 0:
+            return
+        if bins.min() < 0 or bins.max() >= self.nbBins:
+            raise ValueError("Event outside of the histogram (detector id or TOF index)")
+        self._buffer.append(bins)
+        self._nbBuffered += len(bins)
+        self.nbEvents += len(bins)
+        if self._nbBuffered >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self._nbBuffered == 0:
+            return
+        bins = np.sort(np.concatenate(self._buffer))
+        self._buffer = []
+        self._nbBuffered = 0
+
+        if self.sparse:
+            newBins, newCounts = np.unique(bins, return_counts=True)
+            allBins = np.concatenate((self._bins, newBins))
+            self._bins, inverse = np.unique(allBins, return_inverse=True)
+            # Float weights are exact up to 2**53 counts
+            self._counts = np.bincount(
+                inverse, weights=np.concatenate((self._counts, newCounts)), minlength=len(self._bins)
+            ).astype(np.int64)
+            return
+
+        # The sorted bins of each chunk are contiguous
+        chunkIds = bins // self.chunkSize
+        limits = np.flatnonzero(np.diff(chunkIds)) + 1
+        for cBins in np.split(bins, limits):
+            cChunk = int(cBins[0] // self.chunkSize)
+            if cChunk not in self._chunks:
+                self._chunks[cChunk] = np.zeros(self.chunkSize, dtype=np.uint32)
+            self._chunks[cChunk] += np.bincount(
+                cBins - cChunk * self.chunkSize, minlength=self.chunkSize
+            ).astype(np.uint32)
+
+    def sparseArrays(self) -> tuple:
+        """Sorted non zero bins and their counts."""
+        self.flush()
+        if self.sparse:
+            return self._bins, self._counts
+        binChunks, countChunks = [], []
+        for cChunk in sorted(self._chunks):
+            nonZero = np.flatnonzero(self._chunks[cChunk])
+            binChunks.append(nonZero + cChunk * self.chunkSize)
+            countChunks.append(self._chunks[cChunk][nonZero].astype(np.int64))
+        if len(binChunks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(binChunks), np.concatenate(countChunks)
+
+    def denseArray(self) -> np.ndarray:
+        self.flush()
+        dense = np.zeros(self.nbBins, dtype=np.uint32)
+        if self.sparse:
+            dense[self._bins] = self._counts
+            return dense
+        for cChunk, cCounts in self._chunks.items():
+            cStart = cChunk * self.chunkSize
+            dense[cStart : cStart + self.chunkSize] = cCounts[: self.nbBins - cStart]
+        return dense
+
+
+class HistogramWriter:
+    """Writer histogramming the prompts and delays of the time blocks written in it."""
+
+    def __init__(
+        self,
+        output: Union[str, BinaryIO],
+        sparse: bool = False,
+        budget: HistogramBudget = None,
+        **accumulatorOptions,
+    ):
+        self.output = output
+        self.sparse = sparse
+        self.budget = budget if budget is not None else HistogramBudget()
+        self._accumulatorOptions = accumulatorOptions
+        self.nbDetectors = None
+        self.nbTofBins = None
+        self.accumulators = {}
+
+    def write_header(self, header):
+        scanner = header.scanner
+        self.nbDetectors = (
+            max(cDetector.id for cDetector in scanner.detectors) + 1
+            if len(scanner.detectors) != 0
+            else 0
+        )
+        self.nbTofBins = max(len(scanner.tof_bin_edges) - 1, 1)
+        nbBins = self.nbDetectors * (self.nbDetectors + 1) // 2 * self.nbTofBins
+        # Dense bins for the prompts and the delays
+        if not self.sparse and not self.budget.reserve(2 * nbBins):
+            if not self.budget.warned:
+                self.budget.warned = True
+                print(
+                    f"Warning: {nbBins} histogram bins, over the dense bin budget of the "
+                    "outputs, the following histograms are saved sparse.",
+                    file=sys.stderr,
+                )
+            self.sparse = True
+        self.accumulators = {
+            cName: HistogramAccumulator(nbBins, self.sparse, **self._accumulatorOptions)
+            for cName in ("prompts", "delays")
+        }
+
+    def _addEvents(self, name: str, events):
+        if nbEvents(events) == 0:
+            return
+        self.accumulators[name].add(
+            histogramBins(
+                detectorIdArray(events), eventFieldArray(events, "tof_idx")[:, 0], self.nbTofBins
+            )
+        )
+
+    def write_time_blocks(self, timeBlocks):
+        for cTimeBlock in timeBlocks:
+            if isEventTimeBlock(cTimeBlock):
+                self._addEvents("prompts", cTimeBlock.value.prompt_events)
+                self._addEvents("delays", cTimeBlock.value.delayed_events)
+
+    def close(self):
+        arrays = {
+            "nbDetectors": np.int64(self.nbDetectors),
+            "nbTofBins": np.int64(self.nbTofBins),
+        }
+        for cName, cAccumulator in self.accumulators.items():
+            if self.sparse:
+                arrays[f"{cName}_bins"], arrays[f"{cName}_counts"] = cAccumulator.sparseArrays()
+            else:
+                arrays[cName] = cAccumulator.denseArray().reshape(-1, self.nbTofBins)
+        np.savez_compressed(self.output, **arrays)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+
+
+def loadHistogram(path: str, name: str = "prompts") -> np.ndarray:
+    """Dense (nbLors, nbTofBins) histogram of a .npz file saved by HistogramWriter."""
+    with np.load(path) as histograms:
+        if name in histograms:
+            return histograms[name]
+        nbDetectors = int(histograms["nbDetectors"])
+        nbTofBins = int(histograms["nbTofBins"])
+        dense = np.zeros(nbDetectors * (nbDetectors + 1) // 2 * nbTofBins, dtype=np.uint32)
+        dense[histograms[f"{name}_bins"]] = histograms[f"{name}_counts"]
+        return dense.reshape(-1, nbTofBins)
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testHistogramAccumulator():
+    # Detector pair (0, 1), TOF 0 is bin 1 * 3 + 0; the swapped pair (1, 0) mirrors TOF
+    detectorIds = np.array([[0, 1], [1, 0], [2, 2], [2, 0]])
+    tofIdx = np.array([0, 2, 1, 1])
+    bins = histogramBins(detectorIds, tofIdx, 3)
+    assert bins.tolist() == [3, 3, 16, 10]
+
+    rng = np.random.default_rng(0)
+    bins = rng.integers(0, 1000, 10000)
+    expected = np.bincount(bins, minlength=1000)
+    for sparse in (False, True):
+        accumulator = HistogramAccumulator(1000, sparse, chunkSize=64, bufferSize=3000)
+        for cBins in np.array_split(bins, 7):
+            accumulator.add(cBins)
+        assert np.array_equal(accumulator.denseArray(), expected)
+        sparseBins, sparseCounts = accumulator.sparseArrays()
+        assert np.array_equal(sparseBins, np.flatnonzero(expected))
+        assert np.array_equal(sparseCounts, expected[sparseBins])
+
+    # Two outputs of 2 x 10 bins fit in a budget of 50 bins, the third one does not
+    budget = HistogramBudget(50)
+    assert [budget.reserve(20) for _ in range(3)] == [True, True, False]
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    testHistogramAccumulator()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Merge any number of streams that are each sorted on a key into one sorted stream.
+
+The next item of every stream is kept in a binary heap, so each item costs
+O(log k) for k streams instead of a scan of all the streams. Only one item per stream
+is held in memory. Items with equal keys come out in the order of their streams.
+
+Running this file executes its self tests.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import heapq
+import itertools
+import random
+from typing import Any, Iterable, Iterator, List, Tuple
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def mergeSortedStreams(
+    streams: List[Iterable[Tuple[Any, Any]]],
+) -> Iterator[Tuple[Any, int, Any]]:
+    """
+    Merge streams of (key, item), each sorted on key. Yields (key, stream index, item).
+    """
+    iterators = [iter(cStream) for cStream in streams]
+    heap = []
+    for sourceIdx, cIter in enumerate(iterators):
+        for key, item in itertools.islice(cIter, 1):
+            heap.append((key, sourceIdx, item))
+    heapq.heapify(heap)
+
+    while len(heap) != 0:
+        key, sourceIdx, item = heap[0]
+        try:
+            nextKey, nextItem = next(iterators[sourceIdx])
+            # The stream index breaks ties, the items are never compared
+            heapq.heapreplace(heap, (nextKey, sourceIdx, nextItem))
+        except StopIteration:
+            heapq.heappop(heap)
+        yield key, sourceIdx, item
+
+
+def groupByKey(
+    merged: Iterable[Tuple[Any, int, Any]],
+) -> Iterator[Tuple[Any, List[Tuple[int, Any]]]]:
+    """Group a merged stream into (key, [(stream index, item), ...])."""
+    for key, group in itertools.groupby(merged, key=lambda cMerged: cMerged[0]):
+        yield key, [(sourceIdx, item) for _, sourceIdx, item in group]
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testMergeOrder(nbStreams: int = 300, maxLength: int = 50, seed: int = 0):
+    rng = random.Random(seed)
+    streams = [
+        sorted(rng.randrange(1000) for _ in range(rng.randrange(maxLength)))
+        for _ in range(nbStreams)
+    ]
+    merged = list(
+        mergeSortedStreams(
+            [[(key, (i, j)) for j, key in enumerate(cStream)] for i, cStream in enumerate(streams)]
+        )
+    )
+
+    expected = sorted(
+        (key, i, (i, j)) for i, cStream in enumerate(streams) for j, key in enumerate(cStream)
+    )
+    assert merged == expected
+
+
+def testGroupByKey():
+    streams = [[(0, "a0"), (2, "a2")], [], [(0, "c0"), (1, "c1"), (2, "c2")]]
+    groups = list(groupByKey(mergeSortedStreams(streams)))
+    assert groups == [
+        (0, [(0, "a0"), (2, "c0")]),
+        (1, [(2, "c1")]),
+        (2, [(0, "a2"), (2, "c2")]),
+    ]
+
+
+def testLazyConsumption():
+    # Only the head of each stream may be read before the first item is produced
+    consumed = []
+
+    def stream(name: str):
+        for key in range(3):
+            consumed.append((name, key))
+            yield key, name
+
+    merged = mergeSortedStreams([stream("a"), stream("b")])
+    next(merged)
+    assert len(consumed) <= 3
+
+
+if __name__ == "__main__":
+    testMergeOrder()
+    testGroupByKey()
+    testLazyConsumption()
+    print("kway_merge: all tests passed")
@@ -15,6 +15,9 @@ Two modes are supported: (They cannot be used at the same time right now)
 		- The start time are interpreted in absolute. If they are not provided, it is
 		  assumed to start at 0 ms.
 
+The time blocks of all the inputs are merged with a heap keyed on their start time
+(see kway_merge), which scales to hundreds of inputs.
+
 Limitations:
     - Acquisitions with variable time step are not supported.
     - It is assumed that the smallest time interval possible is 1 ms.
@@ -39,13 +42,22 @@ TODO:
 # Basic python module
 import argparse
 from argparse import Namespace
-import random
 import sys
-from typing import Union, List
+from typing import Iterable, Iterator, List, Union
+
+# Other module
+import numpy as np
 
 # This project module
 import petsird
-from petsird.types import CoincidenceEvent
+from array_codec import addArrayCodecArguments, openReader
+from event_arrays import asEventList, concatEvents, nbEvents
+from histogrammer import HistogramWriter, addHistogramArguments, histogramOutput
+from kway_merge import groupByKey, mergeSortedStreams
+from prefetch import Prefetcher
+from telemetry import Telemetry, addProfileArguments
+from timeblock_utils import isEventTimeBlock, shiftTimeBlock, timeBlockStart
+from write_behind import addWriteBehindArguments, writeBehind
 
 
 #########################################################################################
@@ -111,59 +123,132 @@ def defineWriter(oFile: Union[str, None], verbose: int):
 
 
 def setupFileIO(
-    _iFiles: List[str], _startTime: List[int], _headerProvider: Union[str, None]
+    _iFiles: List[str],
+    _startTime: List[int],
+    _headerProvider: Union[str, None],
+    _prefetchDepth: int = 0,
+    _arrayCodec: bool = False,
 ):
     fileIO = []
     allTimeInterval = []
     for i, cF in enumerate(_iFiles):
-        cFileIO = petsird.BinaryPETSIRDReader(cF)
+        cFileIO = openReader(cF, _arrayCodec)
         header = cFileIO.read_header()
         if i == 0:
             firstHeader = header
         allTimeInterval.append(header.scanner.listmode_time_block_duration)
-        fileIO.append(cFileIO.read_time_blocks())
+        fileIO.append(
+            Prefetcher(cFileIO.read_time_blocks(), _prefetchDepth, name=f"prefetch-{cF}")
+        )
 
     if len(set(allTimeInterval)) != 1:
         sys.exit(
             f"This script does not support variable time block size. The time blocks are {allTimeInterval}."
         )
-    # Convert startime from ms to ID of time interval of the files
-    startTimeBlockId = [
-        int(cStartTime * allTimeInterval[0]) for cStartTime in _startTime
-    ]
-
     if _headerProvider is not None:
         oHeader = petsird.BinaryPETSIRDReader(_headerProvider).read_header()
     else:
         oHeader = firstHeader
 
-    return fileIO, startTimeBlockId, oHeader
+    return fileIO, allTimeInterval[0], oHeader
+
+
+def keyedTimeBlocks(_timeBlocks: Iterable, _startTime: int):
+    for cTimeBlock in _timeBlocks:
+        yield timeBlockStart(cTimeBlock) + _startTime, cTimeBlock
+
+
+def fuseTimeBlocks(_fileIO: List[Iterable], _startTime: List[int]) -> Iterator:
+    """
+    Yield (start, [(file index, time block), ...]) for every start time, in order. The
+    time blocks of each file are moved by its start time (ms).
+    """
+    return groupByKey(
+        mergeSortedStreams(
+            [
+                keyedTimeBlocks(cFileIO, cStartTime)
+                for cFileIO, cStartTime in zip(_fileIO, _startTime)
+            ]
+        )
+    )
+
+
+def appendTimeBlocks(
+    _fileIO: List[Iterable], _startTime: List[int], _timeBlockDuration: int
+) -> Iterator:
+    """
+    Same output as fuseTimeBlocks, but each file starts one time block after the last
+    time block of the previous one, its own start time (ms) being a time lapse.
+    """
+    endTime = None
+    for i, (cFileIO, cStartTime) in enumerate(zip(_fileIO, _startTime)):
+        cOffset = cStartTime if endTime is None else endTime + _timeBlockDuration + cStartTime
+        for cTime, cTimeBlock in keyedTimeBlocks(cFileIO, cOffset):
+            endTime = cTime
+            yield cTime, [(i, cTimeBlock)]
 
 
 def createTimeBlock(
     _cTime: int,
-    _cPrompts: List[CoincidenceEvent],
-    _cDelays: List[CoincidenceEvent],
-    _nbMerged: int,
+    _cTimeBlocks: List,
     _shuffleEvents: bool,
+    _rng: np.random.Generator,
 ):
-    if _nbMerged > 1 and _shuffleEvents:
-        random.shuffle(_cPrompts)
+    """
+    Merge the event time blocks sharing the start _cTime. Event lists are concatenated
+    as arrays and, if requested, reordered with one random permutation per list.
+    """
+    mergedEvents = []
+    for cListName in ("prompt_events", "delayed_events", "triple_events"):
+        cEvents = concatEvents(
+            [getattr(cTimeBlock.value, cListName) for cTimeBlock in _cTimeBlocks]
+        )
+        if len(_cTimeBlocks) > 1 and _shuffleEvents and cEvents is not None:
+            cEvents = cEvents[_rng.permutation(len(cEvents))]
+        mergedEvents.append(cEvents)
+    cPrompts, cDelays, cTriples = mergedEvents
 
-    if len(_cDelays) == 0:
+    if nbEvents(cDelays) == 0:
         cDelays = None
-    else:
-        cDelays = _cDelays
-        if _nbMerged > 1 and _shuffleEvents:
-            random.shuffle(cDelays)
+    if nbEvents(cTriples) == 0:
+        cTriples = None
 
     mTimeBlock = (
-        petsird.TimeBlock(id=_cTime, prompt_events=_cPrompts, delayed_events=cDelays),
+        petsird.TimeBlock.EventTimeBlock(
+            petsird.EventTimeBlock(
+                start=_cTime,
+                prompt_events=asEventList(cPrompts) if cPrompts is not None else [],
+                delayed_events=asEventList(cDelays),
+                triple_events=asEventList(cTriples),
+            )
+        ),
     )
 
     return mTimeBlock
 
 
+def mergeTimeBlockGroups(
+    _timeBlockGroups: Iterable,
+    _shuffleEvents: bool,
+    _rng: np.random.Generator,
+) -> Iterator:
+    """
+    Merged time blocks of the groups of fuseTimeBlocks/appendTimeBlocks. Only the
+    current time block of each input is held in memory.
+    """
+    for cTime, cGroup in _timeBlockGroups:
+        cEventTimeBlocks = []
+        for _, cTimeBlock in cGroup:
+            if isEventTimeBlock(cTimeBlock):
+                cEventTimeBlocks.append(cTimeBlock)
+            else:
+                # Other time blocks (e.g. external signals) are only moved in time
+                yield shiftTimeBlock(cTimeBlock, cTime - timeBlockStart(cTimeBlock))
+
+        if len(cEventTimeBlocks) != 0:
+            yield from createTimeBlock(cTime, cEventTimeBlocks, _shuffleEvents, _rng)
+
+
 #########################################################################################
 # Scripting functionnality
 #########################################################################################
@@ -232,6 +317,27 @@ def parserCreator():
         dest="shuffleEvents",
         help="Shuffle the events in time block that are merged.",
     )
+    parser.add_argument(
+        "--shuffleSeed",
+        action="store",
+        type=int,
+        default=None,
+        dest="shuffleSeed",
+        help="Set the seed used to shuffle the events.",
+    )
+    parser.add_argument(
+        "--prefetchDepth",
+        action="store",
+        type=int,
+        default=4,
+        dest="prefetchDepth",
+        help="Number of time blocks read ahead by a background thread for each "
+        "input. 0 reads the inputs in the main loop.",
+    )
+    addProfileArguments(parser)
+    addWriteBehindArguments(parser)
+    addHistogramArguments(parser)
+    addArrayCodecArguments(parser)
 
     return parser.parse_args()
 
@@ -255,62 +361,39 @@ if __name__ == "__main__":
         relMode = False
 
     iFiles, startTime = parseAcqArguments(args)
+    telemetry = Telemetry("merger", args.profile)
     writerOutput = defineWriter(args.oFile, args.verbose)
-    fileIO, sTimeBlockId, oHeader = setupFileIO(iFiles, startTime, args.headerProvider)
-
-    mFileNextTimeBlock = []
-    timeBlockBuffer = []
-    for i, cFileIO in enumerate(fileIO):
-        fTimeBlock = next(cFileIO)
-        mFileNextTimeBlock.append(fTimeBlock.id + sTimeBlockId[i])
-        timeBlockBuffer.append(fTimeBlock)
+    fileIO, timeBlockDuration, oHeader = setupFileIO(
+        iFiles, startTime, args.headerProvider, args.prefetchDepth, args.arrayCodec
+    )
 
-    with petsird.BinaryPETSIRDWriter(writerOutput) as writer:
+    inputTimeBlocks = [telemetry.timeBlocks(cFileIO) for cFileIO in fileIO]
+    if relMode:
+        timeBlockGroups = appendTimeBlocks(inputTimeBlocks, startTime, timeBlockDuration)
+    else:
+        timeBlockGroups = fuseTimeBlocks(inputTimeBlocks, startTime)
+
+    rng = np.random.default_rng(args.shuffleSeed)
+
+    with writeBehind(
+        HistogramWriter(histogramOutput(writerOutput), args.histogramSparse)
+        if args.histogram
+        else telemetry.openWriter(writerOutput, args.arrayCodec),
+        args.writeBatch,
+        args.writeDepth,
+        telemetry,
+    ) as writer:
         writer.write_header(oHeader)
-        while True:
-            cPrompts = []
-            cDelays = []
-            nbMerged = 0
-            removeFile = []
-
-            if relMode:
-                cTime = mFileNextTimeBlock[0]
-                nbInputCandidates = 1
-            else:
-                cTime = min(mFileNextTimeBlock)
-                nbInputCandidates = len(mFileNextTimeBlock)
-
-            for i in range(nbInputCandidates):
-                if mFileNextTimeBlock[i] <= cTime:
-                    cTimeBlock = timeBlockBuffer[i]
-                    cPrompts.extend(cTimeBlock.prompt_events)
-                    if cTimeBlock.delayed_events is not None:
-                        cDelays.extend(cTimeBlock.delayed_events)
-                    nbMerged += 1
-                    # Update info
-                    try:
-                        timeBlockBuffer[i] = next(fileIO[i])
-                        mFileNextTimeBlock[i] = timeBlockBuffer[i].id + sTimeBlockId[i]
-                    except StopIteration:
-                        removeFile.append(i)
-
-            mTimeBlock = createTimeBlock(
-                cTime, cPrompts, cDelays, nbMerged, args.shuffleEvents
+        for cTimeBlock in mergeTimeBlockGroups(timeBlockGroups, args.shuffleEvents, rng):
+            writer.write_time_blocks((cTimeBlock,))
+
+    for cFile, cFileIO in zip(iFiles, fileIO):
+        cFileIO.close()
+        if args.verbose > 0:
+            print(
+                f"{cFile}: {cFileIO.nbItems} time blocks, main loop stalled "
+                f"{cFileIO.stallTime:.3f} s waiting on this input.",
+                file=sys.stderr,
             )
-            writer.write_time_blocks(mTimeBlock)
-
-            if len(removeFile) != 0:
-                # Pop in reverse order to not break anything
-                for cPos in removeFile[::-1]:
-                    fileIO.pop(cPos)
-                    endTime = mFileNextTimeBlock.pop(cPos)
-                    timeBlockBuffer.pop(cPos)
-                    sTimeBlockId.pop(cPos)
-
-                if relMode and len(sTimeBlockId) != 0:
-                    # Since the current file is finished, we now know its endtime and
-                    # can adjust the start time of the other parts in consequence
-                    sTimeBlockId = [cStartTime + endTime for cStartTime in sTimeBlockId]
-            # If any file are remaining, get the next time block ID
-            if len(fileIO) == 0:
-                break
+
+    telemetry.report()
@@ -0,0 +1,109 @@
+# Physiological signal ingest shared by rnd_gating_amplitude.py and append_physio.py.
+#
+# A physio CSV starts with the columns (time stamp, value), the other ones are ignored, it may start
+# with a BOM and may use \r\n line ends (see ecg_sample.csv). It is parsed once with numpy and the result is saved next to it as a .npy
+# sidecar whose name holds the size and modification time of the CSV:
+#     physio.csv -> physio.csv.<size>_<mtime_ns>.npy
+# Later runs memory-map the sidecar instead of parsing the CSV again. A sidecar of an older
+# version of the CSV is replaced. If the sidecar cannot be written, the CSV is simply parsed.
+# iter_physio_chunks gives the samples by chunks of rows, sliced from the sidecar when it exists,
+# otherwise parsed from the CSV chunk by chunk, so a long trace is never held in memory at once.
+
+import glob
+import itertools
+import os
+import tempfile
+import numpy as np
+
+from atomic_write import saveAtomically
+
+
+def sidecar_path(csv_file: str) -> str:
+    csv_stat = os.stat(csv_file)
+    return f"{csv_file}.{csv_stat.st_size}_{csv_stat.st_mtime_ns}.npy"
+
+
+# parse lines of a physio CSV line by line with numpy, only the first two columns are kept
+def parse_physio_lines(lines, csv_file: str) -> np.ndarray:
+    lines = [line for line in lines if line.strip()]
+    if len(lines) == 0:
+        return np.empty((0, 2), dtype=np.float64)
+    try:
+        return np.loadtxt(lines, dtype=np.float64, delimiter=",", usecols=(0, 1), ndmin=2)
+    except ValueError as exc:
+        raise ValueError(f"{csv_file}: {exc}") from None
+
+
+def parse_physio_csv(csv_file: str) -> np.ndarray:
+    with open(csv_file, "r", encoding="utf-8-sig") as f:
+        return parse_physio_lines(f, csv_file)
+
+
+def load_physio_samples(csv_file: str, use_cache: bool = True) -> np.ndarray:
+    if not use_cache:
+        return parse_physio_csv(csv_file)
+
+    cache_file = sidecar_path(csv_file)
+    if os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode="r")
+
+    samples = parse_physio_csv(csv_file)
+    try:
+        # written under a temporary name so a concurrent run never maps a partial file
+        saveAtomically(
+            cache_file, lambda f: np.save(f, samples), f"{glob.escape(csv_file)}.*_*.npy"
+        )
+    except OSError:
+        pass
+    return samples
+
+
+# time stamps (first column) and values (second column) of a physio CSV
+def load_physio(csv_file: str, use_cache: bool = True):
+    samples = load_physio_samples(csv_file, use_cache)
+    return samples[:, 0], samples[:, 1]
+
+
+# samples (time stamps, values) by chunks of chunk_size rows: slices of the memory-mapped sidecar when it exists,
+# otherwise the CSV is parsed chunk by chunk (the sidecar is then built by the next load_physio)
+def iter_physio_chunks(csv_file: str, chunk_size: int):
+    cache_file = sidecar_path(csv_file)
+    if os.path.exists(cache_file):
+        samples = np.load(cache_file, mmap_mode="r")
+        for first in range(0, len(samples), chunk_size):
+            chunk = np.asarray(samples[first : first + chunk_size])
+            yield chunk[:, 0], chunk[:, 1]
+        return
+
+    with open(csv_file, "r", encoding="utf-8-sig") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                return
+            chunk = parse_physio_lines(lines, csv_file)
+            if len(chunk) != 0:
+                yield chunk[:, 0], chunk[:, 1]
+
+
+def test_parse_physio():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, "physio.csv")
+        with open(csv_file, "w", encoding="utf-8-sig", newline="") as f:
+            f.write("0,-596,1,7\r\n6,-590,2,8\r\n\r\n12,-580,3,9\r\n")
+        time_stamps, values = load_physio(csv_file, use_cache=False)
+        assert time_stamps.tolist() == [0, 6, 12] and values.tolist() == [-596, -590, -580]
+        chunks = list(iter_physio_chunks(csv_file, 2))
+        assert np.concatenate([chunk[1] for chunk in chunks]).tolist() == values.tolist()
+
+        with open(csv_file, "w") as f:
+            f.write("0,1\n6,oops\n")
+        try:
+            load_physio(csv_file, use_cache=False)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a non-numeric value must be rejected")
+
+
+if __name__ == "__main__":
+    test_parse_physio()
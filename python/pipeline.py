@@ -0,0 +1,604 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Chain the processing of the tools (append_physio, rnd_gating_amplitude,
+rnd_sampler, frame_splitter, event_filter) in a single decoding/encoding pass, without intermediate
+files, e.g. append a physio signal, gate on it and subsample each gate.
+
+A stage transforms a stream of (route, index, time block), the route being the tuple of
+labels of the output the time block goes to, e.g. ("gate2", "rep0"), and the index the
+position of the time block in the source stream (kept through the fan-outs). The stream
+starts with the empty route; stages fanning out (gating, replicates, frames) extend it.
+Each route gets its own output, opened at its first time block:
+	- the empty route is written to the output file (stdout if there is none),
+	- the others to <output>_<labels> or at the place of {} in the output file name.
+A route receiving no time block produces no file. When no time block reaches any route,
+the empty route output still gets the header.
+
+Python API:
+	header, timeBlocks = readSource("acq.petsird")
+	runPipeline(header, timeBlocks,
+	            [AppendPhysioStage("physio_ms.csv", "resp_trace"),
+	             GatingStage(6, 200.0, 400.0, "physio_ms.csv", timeUnit="ms"),
+	             SamplingStage(0.5, "event", seed=0)],
+	            "out_{}.petsird")
+
+Command line, the stages being applied in the order given:
+	python pipeline.py -i acq.petsird -o out.petsird \\
+		--stage appendPhysio physio=physio_ms.csv signalType=resp_trace \\
+		--stage gate nbGates=6 minAmplitude=200 maxAmplitude=400 physio=physio_ms.csv timeUnit=ms \\
+		--stage sample retentionFrac=0.5 method=event seed=0
+"-" reads the acquisition from stdin. Several inputs are merged as in merger.py.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import collections
+import contextlib
+import os
+import sys
+import tempfile
+from typing import Iterable, Iterator, List, Tuple, Union
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from append_physio import (
+    add_signal_to_header,
+    interleave_signal_blocks,
+    pack_signal_blocks,
+    read_physio_chunks,
+    signal_type_map,
+)
+from event_arrays import withEventArrays
+from event_filter import defineLuts, filterTimeBlock
+from frame_splitter import parseDuration, parseFrameSchedule
+from histogrammer import (
+    HistogramBudget,
+    HistogramWriter,
+    addHistogramArguments,
+    histogramOutput,
+)
+from merger import extractMergeInfo, fuseTimeBlocks, mergeTimeBlockGroups, setupFileIO
+from rnd_gating_amplitude import gate_time_blocks, read_csv_file
+from rnd_sampler import (
+    blockRng,
+    defineSeedKey,
+    sampleByBootstrap,
+    sampleByEvent,
+    sampleByTimeBlock,
+)
+from telemetry import Telemetry, addProfileArguments
+from timeblock_utils import isEventTimeBlock, timeBlockStart
+
+
+#########################################################################################
+# Stages
+#########################################################################################
+class Stage:
+    """
+    A stage of the pipeline, transforming a stream of (route, index, time block). The
+    base stage leaves the header and the stream unchanged.
+    """
+
+    def updateHeader(self, header: petsird.Header) -> petsird.Header:
+        return header
+
+    def process(
+        self, items: Iterable[Tuple[tuple, int, object]]
+    ) -> Iterator[Tuple[tuple, int, object]]:
+        yield from items
+
+
+class AppendPhysioStage(Stage):
+    """
+    Interleave the ExternalSignalTimeBlocks of a physio CSV (ms) in the stream (see
+    append_physio.py). The time blocks are indexed again in the new stream, as
+    rnd_sampler.py would on the file written by append_physio.py.
+    """
+
+    def __init__(
+        self,
+        physio: str,
+        signalType: str = "other_motion_signal",
+        signalId: int = 1,
+        blockInterval: int = 100,
+        chunkSize: int = 100000,
+    ):
+        if signalType.lower() not in signal_type_map:
+            raise ValueError(
+                f"Invalid signal type: {signalType}. Valid options are: {list(signal_type_map.keys())}"
+            )
+        self.physio = physio
+        self.signalEnum = signal_type_map[signalType.lower()]
+        self.signalId = signalId
+        self.blockInterval = blockInterval
+        self.chunkSize = chunkSize
+
+    def updateHeader(self, header):
+        add_signal_to_header(header, self.signalEnum, self.signalId)
+        return header
+
+    @staticmethod
+    def _unrouted(items):
+        for route, _, cTimeBlock in items:
+            if route != ():
+                raise ValueError("The physio signal must be appended before any fan-out stage.")
+            yield cTimeBlock
+
+    def process(self, items):
+        signalBlocks = pack_signal_blocks(
+            read_physio_chunks(self.physio, self.chunkSize), self.blockInterval, self.signalId
+        )
+        for tbID, cTimeBlock in enumerate(
+            interleave_signal_blocks(self._unrouted(items), signalBlocks)
+        ):
+            yield (), tbID, cTimeBlock
+
+
+class GatingStage(Stage):
+    """
+    Amplitude gating (see rnd_gating_amplitude.py) on a physio CSV whose time stamps
+    are in timeUnit (s, or ms for the CSV of append_physio). Routes are extended with
+    "gate<i>"; time blocks other than events go to all the gates.
+    """
+
+    def __init__(
+        self,
+        nbGates: int,
+        minAmplitude: float,
+        maxAmplitude: float,
+        physio: str,
+        timeUnit: str = "s",
+        batchSize: int = 256,
+    ):
+        if timeUnit not in ("s", "ms"):
+            raise ValueError(f"Invalid time unit of the physio file: {timeUnit}")
+        self.nbGates = nbGates
+        self.minAmplitude = minAmplitude
+        self.maxAmplitude = maxAmplitude
+        self.timeStamps, self.amplitudes = read_csv_file(physio)
+        if timeUnit == "ms":
+            self.timeStamps = np.asarray(self.timeStamps) * 0.001
+        self.batchSize = batchSize
+
+    def process(self, items):
+        # gate_time_blocks keeps the order of the time blocks, the routes wait in a queue
+        routes = collections.deque()
+
+        def timeBlocks():
+            for route, tbID, cTimeBlock in items:
+                routes.append((route, tbID))
+                yield cTimeBlock
+
+        for gate, cTimeBlock in gate_time_blocks(
+            timeBlocks(),
+            self.timeStamps,
+            self.amplitudes,
+            self.nbGates,
+            self.minAmplitude,
+            self.maxAmplitude,
+            self.batchSize,
+        ):
+            route, tbID = routes.popleft()
+            if gate is None:
+                for cGate in range(self.nbGates):
+                    yield route + (f"gate{cGate}",), tbID, cTimeBlock
+            else:
+                yield route + (f"gate{gate}",), tbID, cTimeBlock
+
+
+class SamplingStage(Stage):
+    """
+    Random sampling (see rnd_sampler.py). The draws of a time block only depend on the
+    seed, the replicate and the index of the time block in the source stream, not on the
+    route it took, whatever the fan-outs before it. A pipeline made of this stage alone
+    writes the same file as rnd_sampler.py as long as a prompt (a time block with
+    method=timeBlock) is kept: otherwise rnd_sampler.py adds an empty EventTimeBlock
+    starting at 0, while the pipeline writes what was kept, or the header alone. With
+    more than one replicate, routes are extended with "rep<i>".
+    """
+
+    SAMPLERS = {
+        "timeBlock": sampleByTimeBlock,
+        "event": sampleByEvent,
+        "bootstrap": sampleByBootstrap,
+    }
+
+    def __init__(
+        self,
+        retentionFrac: float,
+        method: str = "timeBlock",
+        nbReplicates: int = 1,
+        seed: Union[int, None] = None,
+    ):
+        if method not in SamplingStage.SAMPLERS:
+            raise ValueError(
+                f"Invalid sampling method: {method}. Valid options are: {list(SamplingStage.SAMPLERS)}"
+            )
+        self.retentionFrac = retentionFrac
+        self.sampler = SamplingStage.SAMPLERS[method]
+        self.eventLevel = method != "timeBlock"
+        self.nbReplicates = nbReplicates
+        self.seedKey = defineSeedKey(seed)
+
+    def _replicateRoute(self, route: tuple, cRep: int) -> tuple:
+        return route + (f"rep{cRep}",) if self.nbReplicates > 1 else route
+
+    def process(self, items):
+        for route, tbID, cTimeBlock in items:
+            if not isEventTimeBlock(cTimeBlock):
+                for cRep in range(self.nbReplicates):
+                    yield self._replicateRoute(route, cRep), tbID, cTimeBlock
+                continue
+
+            if self.eventLevel and self.nbReplicates > 1:
+                cTimeBlock = withEventArrays(cTimeBlock)
+            for cRep in range(self.nbReplicates):
+                res = self.sampler(
+                    cTimeBlock, self.retentionFrac, blockRng(self.seedKey, cRep, tbID)
+                )
+                if res is not None:
+                    for cSampled in res[0]:
+                        yield self._replicateRoute(route, cRep), tbID, cSampled
+
+
+class FrameStage(Stage):
+    """Time framing (see frame_splitter.py): routes are extended with "frame<i>"."""
+
+    def __init__(self, frames: str, offset: str = "0"):
+        self.frameEdges = parseFrameSchedule(frames, parseDuration(offset))
+
+    def process(self, items):
+        for route, tbID, cTimeBlock in items:
+            start = timeBlockStart(cTimeBlock)
+            if start < self.frameEdges[0] or start >= self.frameEdges[-1]:
+                continue
+            cFrame = int(np.searchsorted(self.frameEdges, start, side="right")) - 1
+            yield route + (f"frame{cFrame}",), tbID, cTimeBlock
+
+
+class FilterStage(Stage):
+    """
+    Energy window / TOF range selection (see event_filter.py), the lookup tables are
+    built from the scanner of the header.
+    """
+
+    def __init__(
+        self,
+        energyLow: Union[float, None] = None,
+        energyHigh: Union[float, None] = None,
+        tofLow: Union[float, None] = None,
+        tofHigh: Union[float, None] = None,
+        dropOuterTofBins: int = 0,
+    ):
+        self.energyWindow = None
+        if energyLow is not None or energyHigh is not None:
+            self.energyWindow = (
+                -np.inf if energyLow is None else energyLow,
+                np.inf if energyHigh is None else energyHigh,
+            )
+        self.tofWindow = None
+        if tofLow is not None or tofHigh is not None:
+            self.tofWindow = (
+                -np.inf if tofLow is None else tofLow,
+                np.inf if tofHigh is None else tofHigh,
+            )
+        self.dropOuterTofBins = dropOuterTofBins
+        self.tofLut = None
+        self.energyLut = None
+
+    def updateHeader(self, header):
+        self.tofLut, self.energyLut = defineLuts(
+            header.scanner, self.energyWindow, self.tofWindow, self.dropOuterTofBins
+        )
+        return header
+
+    def process(self, items):
+        for route, tbID, cTimeBlock in items:
+            if isEventTimeBlock(cTimeBlock):
+                for cFiltered in filterTimeBlock(cTimeBlock, self.tofLut, self.energyLut)[0]:
+                    yield route, tbID, cFiltered
+            else:
+                yield route, tbID, cTimeBlock
+
+
+# Name of the stages on the command line, with the types of their parameters
+STAGE_TYPES = {
+    "appendPhysio": (
+        AppendPhysioStage,
+        {"physio": str, "signalType": str, "signalId": int, "blockInterval": int, "chunkSize": int},
+    ),
+    "gate": (
+        GatingStage,
+        {
+            "nbGates": int,
+            "minAmplitude": float,
+            "maxAmplitude": float,
+            "physio": str,
+            "timeUnit": str,
+            "batchSize": int,
+        },
+    ),
+    "sample": (
+        SamplingStage,
+        {"retentionFrac": float, "method": str, "nbReplicates": int, "seed": int},
+    ),
+    "frames": (FrameStage, {"frames": str, "offset": str}),
+    "filter": (
+        FilterStage,
+        {
+            "energyLow": float,
+            "energyHigh": float,
+            "tofLow": float,
+            "tofHigh": float,
+            "dropOuterTofBins": int,
+        },
+    ),
+}
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def readSource(acqPath: str):
+    """(header, time blocks) of an acquisition file, "-" being the standard input."""
+    reader = petsird.BinaryPETSIRDReader(sys.stdin.buffer if acqPath == "-" else acqPath)
+    return reader.read_header(), reader.read_time_blocks()
+
+
+def mergeSource(
+    acqPaths: List[str],
+    startTimes: List[int],
+    shuffleEvents: bool = False,
+    seed: Union[int, None] = None,
+    prefetchDepth: int = 4,
+):
+    """(header, time blocks) of the fusion of acquisitions (see merger.py)."""
+    fileIO, _, header = setupFileIO(acqPaths, startTimes, None, prefetchDepth)
+    timeBlocks = mergeTimeBlockGroups(
+        fuseTimeBlocks(fileIO, startTimes),
+        shuffleEvents,
+        np.random.default_rng(seed),
+    )
+    return header, timeBlocks
+
+
+def routeOutput(output: Union[str, None], route: tuple):
+    if route == ():
+        return sys.stdout.buffer if output is None else output
+    if output is None:
+        raise ValueError(
+            f"An output file is required when the pipeline fans out (route {route})."
+        )
+    label = "_".join(route)
+    if "{}" in output:
+        return output.format(label)
+    stem, ext = os.path.splitext(output)
+    return f"{stem}_{label}{ext}"
+
+
+def runPipeline(
+    header: petsird.Header,
+    timeBlocks: Iterable,
+    stages: List[Stage],
+    output: Union[str, None],
+    telemetry: Union[Telemetry, None] = None,
+    histogram: Union[str, None] = None,
+):
+    """
+    Apply the stages to the time blocks and write each route in its output, or save its
+    "dense"/"sparse" histogram (see histogrammer.py) with histogram. Returns
+    {route: [output, number of time blocks written]}. Without any time block written, the
+    empty route output holds the header alone, so that it is still a PETSIRD stream.
+    """
+    if telemetry is None:
+        telemetry = Telemetry("pipeline", None)
+
+    for cStage in stages:
+        header = cStage.updateHeader(header)
+
+    items = (
+        ((), tbID, cTimeBlock) for tbID, cTimeBlock in enumerate(telemetry.timeBlocks(timeBlocks))
+    )
+    for cStage in stages:
+        items = cStage.process(items)
+
+    outputs = {}
+    writers = {}
+    histogramBudget = HistogramBudget()
+    with contextlib.ExitStack() as stack:
+
+        def openRoute(route):
+            cOutput = routeOutput(output, route)
+            if histogram is not None:
+                cOutput = histogramOutput(cOutput)
+                writer = stack.enter_context(
+                    HistogramWriter(cOutput, histogram == "sparse", histogramBudget)
+                )
+            else:
+                writer = stack.enter_context(telemetry.openWriter(cOutput))
+            writer.write_header(header)
+            writers[route] = writer
+            outputs[route] = [cOutput if isinstance(cOutput, str) else "<stdout>", 0]
+            return writer
+
+        for route, _, cTimeBlock in items:
+            writer = writers.get(route)
+            if writer is None:
+                writer = openRoute(route)
+            writer.write_time_blocks((cTimeBlock,))
+            outputs[route][1] += 1
+
+        if not writers:
+            openRoute(()).write_time_blocks([])
+
+    return outputs
+
+
+def parseStage(stageArgs: List[str]) -> Stage:
+    """Stage of "name key=value ..." (see STAGE_TYPES)."""
+    name, parameters = stageArgs[0], stageArgs[1:]
+    if name not in STAGE_TYPES:
+        raise ValueError(f"Unknown stage: {name}. Valid options are: {list(STAGE_TYPES)}")
+    stageClass, parameterTypes = STAGE_TYPES[name]
+
+    kwargs = {}
+    for cParameter in parameters:
+        key, sep, value = cParameter.partition("=")
+        if not sep or key not in parameterTypes:
+            raise ValueError(
+                f"Invalid parameter {cParameter!r} of stage {name}. Valid parameters "
+                f"are: {list(parameterTypes)} given as key=value."
+            )
+        kwargs[key] = parameterTypes[key](value)
+    return stageClass(**kwargs)
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Apply a chain of stages (appendPhysio, gate, sample, frames, filter) to an "
+        "acquisition in a single pass."
+    )
+
+    ##################################################
+    # Basic
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        type=str,
+        nargs="+",
+        default=["-"],
+        dest="input",
+        help="The acquisition, in PETSIRD format (- for stdin). Several acquisitions, "
+        "given as file[,start (s)], are merged.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        default=None,
+        dest="oFile",
+        help="The output file (stdout if it is not defined and the pipeline does not "
+        "fan out). Each route is saved as <outputFile>_<route>, or at the place of {} "
+        "if the output file name contains it.",
+    )
+    parser.add_argument(
+        "--stage",
+        action="append",
+        type=str,
+        nargs="+",
+        default=[],
+        dest="stages",
+        metavar="NAME KEY=VALUE",
+        help="A stage and its parameters, e.g. --stage sample retentionFrac=0.5 "
+        f"method=event. Stages: {', '.join(STAGE_TYPES)}.",
+    )
+
+    ##################################################
+    # Feature
+    parser.add_argument(
+        "--shuffleEvents",
+        action="store_true",
+        default=False,
+        dest="shuffleEvents",
+        help="Shuffle the events of the merged time blocks (several inputs).",
+    )
+    parser.add_argument(
+        "--prefetchDepth",
+        action="store",
+        type=int,
+        default=4,
+        dest="prefetchDepth",
+        help="Number of time blocks read ahead by a background thread for each merged "
+        "input (several inputs). 0 reads the inputs in the main loop.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store",
+        type=int,
+        default=0,
+        dest="verbose",
+        help="Level of verbosity of the script.",
+    )
+    addProfileArguments(parser)
+    addHistogramArguments(parser)
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testRouteOutput():
+    assert routeOutput("out.petsird", ()) == "out.petsird"
+    assert routeOutput("out.petsird", ("gate1", "rep0")) == "out_gate1_rep0.petsird"
+    assert routeOutput("g{}.raw", ("gate1",)) == "ggate1.raw"
+    assert routeOutput(None, ()) is sys.stdout.buffer
+
+
+def testParseStage():
+    stage = parseStage(["frames", "frames=2x10s", "offset=5s"])
+    assert stage.frameEdges.tolist() == [5000, 15000, 25000]
+    try:
+        parseStage(["frames", "schedule=2x10s"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("an unknown parameter must be rejected")
+
+
+def testEmptyPipeline():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        output = os.path.join(tmpDir, "out.petsird")
+        assert runPipeline(petsird.Header(), [], [], output) == {(): [output, 0]}
+        reader = petsird.BinaryPETSIRDReader(output)
+        reader.read_header()
+        assert list(reader.read_time_blocks()) == []
+        reader.close()
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    try:
+        stages = [parseStage(cStageArgs) for cStageArgs in args.stages]
+    except ValueError as exc:
+        sys.exit(str(exc))
+
+    telemetry = Telemetry("pipeline", args.profile)
+    if len(args.input) > 1:
+        acqPaths, startTimes = extractMergeInfo(args.input)
+        header, timeBlocks = mergeSource(
+            acqPaths, startTimes, args.shuffleEvents, prefetchDepth=args.prefetchDepth
+        )
+    else:
+        header, timeBlocks = readSource(args.input[0])
+
+    histogram = None
+    if args.histogram:
+        histogram = "sparse" if args.histogramSparse else "dense"
+    outputs = runPipeline(header, timeBlocks, stages, args.oFile, telemetry, histogram)
+
+    if args.verbose > 0:
+        for route, (cOutput, nbTimeBlocks) in outputs.items():
+            print(
+                f"{'/'.join(route) or 'output'}: {nbTimeBlocks} time blocks -> {cOutput}",
+                file=sys.stderr,
+            )
+    telemetry.report()
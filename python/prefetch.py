@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Read ahead an iterator (typically read_time_blocks() of a PETSIRD reader) in a
+background thread, so the reading of several inputs overlaps.
+
+The items are handed over through a bounded queue (depth items at most), and the time
+the consumer spent waiting for an item is accumulated in stallTime. With a depth of 0,
+no thread is started and stallTime is the time spent reading the iterator itself.
+Exceptions raised while reading are raised again in the consumer.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import queue
+import threading
+import time
+from typing import Iterable
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+class Prefetcher:
+    # Markers put in the queue by the reading thread
+    _END = object()
+
+    class _Failure:
+        def __init__(self, exception: BaseException):
+            self.exception = exception
+
+    def __init__(self, iterable: Iterable, depth: int, name: str = "prefetch"):
+        self.stallTime = 0.0
+        self.nbItems = 0
+        self._iterator = iter(iterable)
+        self._done = False
+
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._fill, name=name, daemon=True)
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def _put(self, item) -> bool:
+        # Time out regularly so close() can stop a thread blocked on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self):
+        try:
+            for item in self._iterator:
+                if not self._put(item):
+                    return
+            self._put(Prefetcher._END)
+        except BaseException as exc:
+            self._put(Prefetcher._Failure(exc))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+
+        tStart = time.perf_counter()
+        if self._queue is None:
+            try:
+                item = next(self._iterator)
+            except StopIteration:
+                self._done = True
+                raise
+            finally:
+                self.stallTime += time.perf_counter() - tStart
+        else:
+            item = self._queue.get()
+            self.stallTime += time.perf_counter() - tStart
+            if item is Prefetcher._END:
+                self._done = True
+                raise StopIteration
+            if isinstance(item, Prefetcher._Failure):
+                self._done = True
+                raise item.exception
+
+        self.nbItems += 1
+        return item
+
+    def close(self):
+        self._done = True
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
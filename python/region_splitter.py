@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Split an acquisition by detector region (axial ring ranges, sectors or modules),
+e.g. for per module normalization or quality control, in a single reading pass.
+
+The regions are computed once from the detectors of the header (header.scanner):
+	- rings: the detectors are grouped in rings by their axial position (z), and the
+	  rings in nbRegions consecutive ranges,
+	- sectors: nbRegions angular sectors of the transaxial position (x, y),
+	- modules: blocks of moduleSize consecutive detector ids.
+This gives a lookup table detector id -> region, and a table region x region -> output
+where a coincidence between two regions goes to the "cross" output.
+
+For each event list of an EventTimeBlock, the detector ids are gathered in one array and
+the output of every event is looked up at once, then the events are split with a stable
+sort. Every output receives every time block (with its share of the events, possibly
+none), the time blocks other than events are copied in all the outputs.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import contextlib
+import os
+import sys
+from typing import List
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from array_codec import ArrayPETSIRDWriter, addArrayCodecArguments, openReader
+from event_arrays import asEventList, detectorIdArray, nbEvents, splitEvents
+from timeblock_utils import isEventTimeBlock
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def detectorPositions(scanner) -> tuple:
+    """Ids and (x, y, z) positions of the detectors of the scanner."""
+    ids = np.array([cDetector.id for cDetector in scanner.detectors], dtype=np.int64)
+    positions = np.array(
+        [(cDetector.x, cDetector.y, cDetector.z) for cDetector in scanner.detectors],
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    return ids, positions
+
+
+def detectorRegions(
+    ids: np.ndarray, positions: np.ndarray, mode: str, nbRegions: int, moduleSize: int = 1
+) -> tuple:
+    """Region of each detector and number of regions."""
+    if mode == "rings":
+        # Rings are the distinct axial positions (to 1e-3 mm)
+        _, ring = np.unique(np.round(positions[:, 2], 3), return_inverse=True)
+        nbRings = int(ring.max()) + 1 if len(ring) != 0 else 1
+        nbRegions = min(nbRegions, nbRings)
+        return ring * nbRegions // nbRings, nbRegions
+    if mode == "sectors":
+        angle = np.mod(np.arctan2(positions[:, 1], positions[:, 0]), 2.0 * np.pi)
+        return np.minimum((angle * nbRegions / (2.0 * np.pi)).astype(np.int64), nbRegions - 1), nbRegions
+    if mode == "modules":
+        module = ids // moduleSize
+        return module, int(module.max()) + 1 if len(module) != 0 else 1
+    raise ValueError(f"Unknown region mode: {mode}")
+
+
+def regionLookupTables(ids: np.ndarray, regions: np.ndarray, nbRegions: int) -> tuple:
+    """
+    detector id -> region (unknown ids are the cross region nbRegions), and
+    region x region -> output (nbRegions, the cross output, for two different regions).
+    """
+    detectorLut = np.full(int(ids.max()) + 1 if len(ids) != 0 else 1, nbRegions, dtype=np.int64)
+    detectorLut[ids] = regions
+    pairLut = np.full((nbRegions + 1, nbRegions + 1), nbRegions, dtype=np.int64)
+    pairLut[np.arange(nbRegions), np.arange(nbRegions)] = np.arange(nbRegions)
+    return detectorLut, pairLut
+
+
+def eventOutputs(
+    detectorIds: np.ndarray, detectorLut: np.ndarray, pairLut: np.ndarray
+) -> np.ndarray:
+    """Output of each event, from its (n, k) detector ids."""
+    nbRegions = len(pairLut) - 1
+    ids = np.clip(detectorIds, 0, len(detectorLut))
+    # Ids beyond the table (not in the header) fall in the cross region
+    regions = np.append(detectorLut, nbRegions)[ids]
+    if regions.shape[1] == 2:
+        return pairLut[regions[:, 0], regions[:, 1]]
+    # Triples: all the detectors must be in the same region
+    sameRegion = np.all(regions == regions[:, :1], axis=1)
+    return np.where(sameRegion, regions[:, 0], nbRegions)
+
+
+def splitTimeBlock(
+    cTimeBlock, detectorLut: np.ndarray, pairLut: np.ndarray
+) -> List:
+    """One time block per output (the last one being the cross output)."""
+    nbOutputs = len(pairLut)
+    splitLists = []
+    for cEvents in (
+        cTimeBlock.value.prompt_events,
+        cTimeBlock.value.delayed_events,
+        cTimeBlock.value.triple_events,
+    ):
+        if cEvents is None:
+            splitLists.append([None] * nbOutputs)
+        elif nbEvents(cEvents) == 0:
+            splitLists.append([[]] * nbOutputs)
+        else:
+            outputs = eventOutputs(detectorIdArray(cEvents), detectorLut, pairLut)
+            splitLists.append(
+                [asEventList(cSplit) for cSplit in splitEvents(cEvents, outputs, nbOutputs)]
+            )
+
+    return [
+        petsird.TimeBlock.EventTimeBlock(
+            petsird.EventTimeBlock(
+                start=cTimeBlock.value.start,
+                prompt_events=cPrompts,
+                delayed_events=cDelays,
+                triple_events=cTriples,
+            )
+        )
+        for cPrompts, cDelays, cTriples in zip(*splitLists)
+    ]
+
+
+def splitTimeBlocks(timeBlocks, writers: List, detectorLut: np.ndarray, pairLut: np.ndarray):
+    """
+    Write the time blocks split by region, writers[i] being the output i (None to
+    drop it). Returns the number of prompts of each output.
+    """
+    nbPrompt = np.zeros(len(pairLut), dtype=np.int64)
+    for cTimeBlock in timeBlocks:
+        if not isEventTimeBlock(cTimeBlock):
+            for writer in writers:
+                if writer is not None:
+                    writer.write_time_blocks((cTimeBlock,))
+            continue
+
+        for cOutput, (writer, cSplit) in enumerate(
+            zip(writers, splitTimeBlock(cTimeBlock, detectorLut, pairLut))
+        ):
+            nbPrompt[cOutput] += nbEvents(cSplit.value.prompt_events)
+            if writer is not None:
+                writer.write_time_blocks((cSplit,))
+    return nbPrompt
+
+
+def defineRegionOutputs(oFile: str, nbRegions: int) -> List[str]:
+    labels = [f"region{cRegion}" for cRegion in range(nbRegions)] + ["cross"]
+    if "{}" in oFile:
+        return [oFile.format(cLabel) for cLabel in labels]
+    stem, ext = os.path.splitext(oFile)
+    return [f"{stem}_{cLabel}{ext}" for cLabel in labels]
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Split an acquisition by detector region in a single reading pass."
+    )
+
+    ##################################################
+    # Basic
+    parser.add_argument(
+        "--acqFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="acq",
+        help="The acquisition, in PETSIRD format, to split.",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        choices=["rings", "sectors", "modules"],
+        default="rings",
+        dest="mode",
+        help="How the detectors are grouped in regions.",
+    )
+    parser.add_argument(
+        "-n",
+        "--nbRegions",
+        action="store",
+        type=int,
+        default=2,
+        dest="nbRegions",
+        help="Number of ring ranges or of sectors.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="oFile",
+        help="The path/name of the outputs, saved as <outputFile>_region<i> and "
+        "<outputFile>_cross (or at the place of {} in the output file name).",
+    )
+
+    ##################################################
+    # Feature
+    parser.add_argument(
+        "--moduleSize",
+        action="store",
+        type=int,
+        default=1,
+        dest="moduleSize",
+        help="Number of consecutive detector ids in a module (modules mode).",
+    )
+    parser.add_argument(
+        "--dropCross",
+        action="store_true",
+        default=False,
+        dest="dropCross",
+        help="Drop the coincidences between different regions instead of writing them "
+        "in the cross output.",
+    )
+    addArrayCodecArguments(parser)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store",
+        type=int,
+        default=0,
+        dest="verbose",
+        help="Level of verbosity of the script.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testRegionLookup():
+    # Two rings of four detectors
+    ids = np.arange(8)
+    angles = np.pi / 2.0 * (ids % 4) + 0.1
+    positions = np.column_stack((np.cos(angles), np.sin(angles), (ids // 4) * 4.0))
+
+    regions, nbRegions = detectorRegions(ids, positions, "rings", 2)
+    assert nbRegions == 2 and regions.tolist() == [0, 0, 0, 0, 1, 1, 1, 1]
+    regions, nbRegions = detectorRegions(ids, positions, "sectors", 4)
+    assert regions.tolist() == [0, 1, 2, 3, 0, 1, 2, 3]
+
+    detectorLut, pairLut = regionLookupTables(ids, regions, nbRegions)
+    detectorIds = np.array([[0, 4], [0, 1], [3, 7], [2, 99]])
+    assert eventOutputs(detectorIds, detectorLut, pairLut).tolist() == [0, 4, 3, 4]
+    assert eventOutputs(np.array([[1, 5, 1]]), detectorLut, pairLut).tolist() == [1]
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    reader = openReader(args.acq, args.arrayCodec)
+    header = reader.read_header()
+
+    ids, positions = detectorPositions(header.scanner)
+    if len(ids) == 0:
+        sys.exit("The header does not define any detector.")
+    regions, nbRegions = detectorRegions(
+        ids, positions, args.mode, args.nbRegions, args.moduleSize
+    )
+    detectorLut, pairLut = regionLookupTables(ids, regions, nbRegions)
+    regionOutputs = defineRegionOutputs(args.oFile, nbRegions)
+    if args.dropCross:
+        regionOutputs[-1] = None
+
+    writerClass = ArrayPETSIRDWriter if args.arrayCodec else petsird.BinaryPETSIRDWriter
+    with contextlib.ExitStack() as stack:
+        writers = [
+            None if cOutput is None else stack.enter_context(writerClass(cOutput))
+            for cOutput in regionOutputs
+        ]
+        for writer in writers:
+            if writer is not None:
+                writer.write_header(header)
+
+        nbPrompt = splitTimeBlocks(reader.read_time_blocks(), writers, detectorLut, pairLut)
+
+    if args.verbose > 0:
+        nbTotal = max(int(nbPrompt.sum()), 1)
+        for cOutput, cNbPrompt in enumerate(nbPrompt):
+            label = f"region {cOutput}" if cOutput < nbRegions else "cross"
+            print(
+                f"{label}: {cNbPrompt} prompts ({cNbPrompt / nbTotal * 100.0:.2f}%)"
+                + ("" if regionOutputs[cOutput] is None else f" -> {regionOutputs[cOutput]}"),
+                file=sys.stderr,
+            )
@@ -1,35 +1,101 @@
 # date: 2023-11-14
 # Author: Georgios Soultanidis
 # Affiliation: BMEII, Icahn School of Medicine at Mount Sinai
-# version: 0.1
+# version: 0.2
 
-# Usage: python rnd_gating_amplitude.py <input_file> <number_of_gates> <minimum_physio_1_amplitude> <maximum_physio_1_amplitude>
+# Usage: python rnd_gating_amplitude.py <input_file> <number_of_gates> <minimum_physio_1_amplitude> <maximum_physio_1_amplitude> [--physio physio.csv | --signal_id id] [--gate_cache gates.npz]
+#        python rnd_gating_amplitude.py <input_file> <number_of_gates> --equal_count [...]
 # Amplitude based physio_1 gating, where the user defines the number of gates, the minimum and maximum physio_1 amplitude
+# With --equal_count, the gate edges are instead the weighted quantiles of the amplitude at the start of the time blocks,
+# weighted by their number of prompts, so every gate gets about the same number of prompts.
+# With --cardiac_gates M (dual gating), every amplitude gate is also split in M cardiac phase gates, the phase of a time
+# block being the position of its start between the two cardiac triggers around it (trigger index of build_trigger_index).
+# The gate files are opened lazily, written by batches of time blocks and at most --max_open_files are open at once.
 # The script reads the physio data from a csv file and assigns a gate to each event based on the physio_1 amplitude
-# TODO the script will be updated to read the physio data from the raw data file, fully in sinc with the packet time stamps
+# The gates of the time blocks are computed with numpy by batch of time blocks, and can be saved in a cache file
+# so later runs only have to look up the gate of each time block.
+# With --signal_id, the physio data is read from the ExternalSignalTimeBlocks of the raw data file itself (as written by
+# append_physio.py), fully in sinc with the packet time stamps: a first pass keeps only the samples of that signal in numpy
+# arrays, a second pass routes the event time blocks to the gates.
 
 # Currently hard-wire location of generated files. This will need to change!
 import sys
 
 sys.path.append("../PETSIRD/python/")
-import math
+import argparse
+import collections
+import os
 import numpy as np
 import petsird
 
+from atomic_write import saveAtomically
+from histogrammer import HistogramBudget, HistogramWriter, addHistogramArguments
+from physio_io import load_physio
+from stats import acquisitionCounts
+from tb_index import casePositions, loadIndex, readCaseTimeBlocks
+from telemetry import Telemetry, addProfileArguments
+from timeblock_utils import isEventTimeBlock, timeBlockStart
+from write_behind import EncoderThread
+
 
 # function to open a csv file and read time stamps (first column) and physio_1_amplitude (second column) and return them into two arrays (time_stamps, physio_1_amplitude)
-# TODO: make this obsolete by reading the physio data from the raw data file
+# the parsed file is cached in a .npy sidecar by physio_io, so repeated runs do not parse the csv again
 def read_csv_file(csv_file: str):
-    time_stamps = []
-    physio_amplitude = []
-    with open(csv_file, "r") as f:
-        for line in f:
-            line = line.strip()
-            if len(line) == 0:
-                continue
-            time_stamps.append(float(line.split(",")[0]))
-            physio_amplitude.append(float(line.split(",")[1]))
-    return np.array(time_stamps), np.array(physio_amplitude)
+    return load_physio(csv_file)
+
+
+# first phase of the in-file gating: scan the raw data file and keep only the samples of the external signal signal_id,
+# as numpy arrays of time stamps (in seconds, like the csv) and values. When a time block holds several values, they are
+# spread evenly over its time interval. With the time block index, only the external signal blocks are decoded.
+def read_external_signal(input_file: str, signal_id: int, index=None):
+    time_chunks = []
+    value_chunks = []
+    if index is not None:
+        time_blocks = readCaseTimeBlocks(
+            input_file,
+            index,
+            casePositions(index, petsird.TimeBlock.ExternalSignalTimeBlock),
+        )
+    else:
+        reader = petsird.BinaryPETSIRDReader(input_file)
+        reader.read_header()
+        time_blocks = reader.read_time_blocks()
+    for time_block in time_blocks:
+        if not isinstance(time_block, petsird.TimeBlock.ExternalSignalTimeBlock):
+            continue
+        signal_block = time_block.value
+        if signal_block.signal_id != signal_id:
+            continue
+        values = np.asarray(signal_block.signal_values, dtype=np.float32)
+        if len(values) == 0:
+            continue
+        start = signal_block.time_interval.start
+        stop = signal_block.time_interval.stop
+        time_chunks.append(start + (stop - start) * np.arange(len(values)) / len(values))
+        value_chunks.append(values)
+
+    if len(time_chunks) == 0:
+        sys.exit(f"No samples of the external signal {signal_id} found in {input_file}")
+    time_stamps = np.concatenate(time_chunks) * 0.001  # the time intervals are in msec
+    physio_amplitude = np.concatenate(value_chunks)
+    order = np.argsort(time_stamps, kind="stable")
+    return time_stamps[order], physio_amplitude[order]
+
+
+# vectorized amplitude to gate mapping, the gates are linear between the minimum and maximum amplitude
+# and amplitudes outside of this range go to the first or last gate
+def asign_gates(
+    physio_amplitude: np.ndarray,
+    number_of_gates: int,
+    minimum_physio_amplitude: float,
+    maximum_physio_amplitude: float,
+) -> np.ndarray:
+    gates = np.floor(
+        (np.asarray(physio_amplitude) - minimum_physio_amplitude)
+        * number_of_gates
+        / (maximum_physio_amplitude - minimum_physio_amplitude)
+    )
+    return np.clip(gates, 0, number_of_gates - 1).astype(np.int64)
 
 
 def asign_gate(
@@ -38,25 +104,499 @@ def asign_gate(
     minimum_physio_amplitude: float,
     maximum_physio_amplitude: float,
 ) -> int:
-    gate = math.floor(
-        (physio_amplitude * number_of_gates)
-        / (maximum_physio_amplitude - minimum_physio_amplitude)
+    return int(
+        asign_gates(
+            physio_amplitude,
+            number_of_gates,
+            minimum_physio_amplitude,
+            maximum_physio_amplitude,
+        )
     )
-    return gate
 
 
-if __name__ == "__main__":
-    # check if the number of arguments is correct
-    if len(sys.argv) != 5:
-        print(
-            "Usage: python split_to_physio_1_gates.py <input_file> <number_of_gates> <minimum_physio_1_amplitude> <maximum_physio_1_amplitude>"
+# amplitude to gate mapping with explicit gate edges (number_of_gates - 1 inner edges, increasing),
+# an amplitude equal to an edge goes to the upper gate
+def asign_gates_by_edges(physio_amplitude: np.ndarray, gate_edges: np.ndarray) -> np.ndarray:
+    return np.searchsorted(gate_edges, np.asarray(physio_amplitude), side="right").astype(np.int64)
+
+
+# amplitude of each time block: the physio sample used is the last one at or before the start of the time block
+def block_amplitudes(
+    block_starts_ms: np.ndarray, time_stamps: np.ndarray, physio_amplitude: np.ndarray
+) -> np.ndarray:
+    # for now, we just assume that the first time block has the same time stamp with the first physio record
+    block_times = np.asarray(block_starts_ms) * 0.001  # the starts are in msec and we convert them in seconds
+    sample_index = np.searchsorted(time_stamps, block_times, side="right") - 1
+    sample_index = np.clip(sample_index, 0, len(time_stamps) - 1)
+    return physio_amplitude[sample_index]
+
+
+# inner gate edges splitting the amplitudes in number_of_gates groups of equal weight: the weighted quantiles
+# k / number_of_gates, interpolated between the sorted amplitudes (each one at the middle of its weight)
+def equal_count_edges(
+    amplitudes: np.ndarray, weights: np.ndarray, number_of_gates: int
+) -> np.ndarray:
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.sum() <= 0:
+        # no prompt at all, every time block weighs the same
+        weights = np.ones_like(amplitudes)
+    order = np.argsort(amplitudes, kind="stable")
+    sorted_amplitudes = amplitudes[order]
+    sorted_weights = weights[order]
+    cumulative = (np.cumsum(sorted_weights) - 0.5 * sorted_weights) / sorted_weights.sum()
+    quantiles = np.arange(1, number_of_gates) / number_of_gates
+    return np.interp(quantiles, cumulative, sorted_amplitudes)
+
+
+# gate of each time block: the physio sample used is the last one at or before the start of the time block
+def compute_block_gates(
+    block_starts_ms: np.ndarray,
+    time_stamps: np.ndarray,
+    physio_amplitude: np.ndarray,
+    number_of_gates: int,
+    minimum_physio_amplitude: float,
+    maximum_physio_amplitude: float,
+) -> np.ndarray:
+    return asign_gates(
+        block_amplitudes(block_starts_ms, time_stamps, physio_amplitude),
+        number_of_gates,
+        minimum_physio_amplitude,
+        maximum_physio_amplitude,
+    )
+
+
+# equal count gating: gate of each time block, from the start and number of prompts of every event time block, and the
+# inner gate edges. Only the amplitudes within [minimum, maximum] (when given) are used to compute the edges, so outliers
+# (e.g. a signal dropout) do not shift them; they still go to the first or last gate.
+def compute_equal_count_gates(
+    block_starts_ms: np.ndarray,
+    block_prompts: np.ndarray,
+    time_stamps: np.ndarray,
+    physio_amplitude: np.ndarray,
+    number_of_gates: int,
+    minimum_physio_amplitude=None,
+    maximum_physio_amplitude=None,
+):
+    amplitudes = block_amplitudes(block_starts_ms, time_stamps, physio_amplitude)
+    in_range = np.ones(len(amplitudes), dtype=bool)
+    if minimum_physio_amplitude is not None:
+        in_range &= amplitudes >= minimum_physio_amplitude
+    if maximum_physio_amplitude is not None:
+        in_range &= amplitudes <= maximum_physio_amplitude
+    if not np.any(in_range):
+        raise ValueError("No time block with a physio amplitude in the gating range")
+    gate_edges = equal_count_edges(
+        amplitudes[in_range], np.asarray(block_prompts)[in_range], number_of_gates
+    )
+    return asign_gates_by_edges(amplitudes, gate_edges), gate_edges
+
+
+# trigger index of the cardiac (second) signal: the sorted trigger time stamps (s), cycle k being [triggers[k], triggers[k + 1]),
+# and the inverse of the length of every cycle, NaN for the cycles longer than maximum_cycle (missed triggers)
+def build_trigger_index(trigger_times: np.ndarray, maximum_cycle=None):
+    triggers = np.unique(np.asarray(trigger_times, dtype=np.float64))
+    cycle_lengths = np.diff(triggers)
+    with np.errstate(divide="ignore"):
+        inverse_lengths = 1.0 / cycle_lengths
+    invalid = cycle_lengths <= 0
+    if maximum_cycle is not None:
+        invalid |= cycle_lengths > maximum_cycle
+    inverse_lengths[invalid] = np.nan
+    return triggers, inverse_lengths
+
+
+# trigger time stamps of a physio CSV or of the samples of an external signal: the samples with a non zero value
+def trigger_times_of(time_stamps: np.ndarray, values: np.ndarray) -> np.ndarray:
+    return np.asarray(time_stamps)[np.asarray(values) != 0]
+
+
+# phase gate of each time block, from the position of its start in its cardiac cycle. The time blocks
+# before the first trigger, after the last one or in an invalid cycle get -1 (no gate)
+def compute_phase_gates(block_starts_ms: np.ndarray, trigger_index, number_of_phase_gates: int) -> np.ndarray:
+    triggers, inverse_lengths = trigger_index
+    block_times = np.asarray(block_starts_ms) * 0.001
+    cycle = np.searchsorted(triggers, block_times, side="right") - 1
+    in_cycle = (cycle >= 0) & (cycle < len(inverse_lengths))
+    cycle = np.clip(cycle, 0, max(len(inverse_lengths) - 1, 0))
+    if len(inverse_lengths) == 0:
+        return np.full(len(block_times), -1, dtype=np.int64)
+    phases = (block_times - triggers[cycle]) * inverse_lengths[cycle]
+    valid = in_cycle & np.isfinite(phases)
+    gates = np.clip(np.floor(np.where(valid, phases, 0.0) * number_of_phase_gates), 0, number_of_phase_gates - 1)
+    return np.where(valid, gates, -1).astype(np.int64)
+
+
+# amplitude x phase gate of each time block: amplitude_gate * number_of_phase_gates + phase_gate, -1 without phase
+def combine_gates(amplitude_gates: np.ndarray, phase_gates: np.ndarray, number_of_phase_gates: int) -> np.ndarray:
+    return np.where(
+        phase_gates < 0, -1, np.asarray(amplitude_gates) * number_of_phase_gates + phase_gates
+    ).astype(np.int64)
+
+
+# the cache stores the gate of every event time block with what it was computed from, so it is
+# only reused when the input file, the physio file (None when the physio is in the input file), the
+# other files (e.g. the cardiac triggers) and the gating parameters did not change
+def gate_cache_key(input_file: str, physio_file, gating_parameters, other_files=()) -> np.ndarray:
+    input_stat = os.stat(input_file)
+    key = [input_stat.st_size, input_stat.st_mtime_ns]
+    for other_file in (physio_file,) + tuple(other_files):
+        if other_file is not None:
+            other_stat = os.stat(other_file)
+            key += [other_stat.st_size, other_stat.st_mtime_ns]
+    return np.array(
+        key + [float(parameter) for parameter in gating_parameters], dtype=np.float64
+    )
+
+
+def load_gate_cache(cache_file: str, key: np.ndarray):
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as cache:
+        # a missing parameter (e.g. no minimum amplitude) is stored as NaN
+        if cache["key"].shape != key.shape or not np.array_equal(
+            cache["key"], key, equal_nan=True
+        ):
+            return None
+        return cache["gates"]
+
+
+# written under a temporary name, so a concurrent or killed run never leaves a truncated cache
+def save_gate_cache(cache_file: str, key: np.ndarray, gates: np.ndarray):
+    if cache_file is not None:
+        saveAtomically(cache_file, lambda f: np.savez(f, key=key, gates=gates))
+
+
+# gate of each time block of a stream, computed by batch of batch_size event time blocks: yields (gate, time block),
+# the gate being None for the other time blocks (e.g. external signals) which belong to all the gates.
+# The gates of each batch are also appended to all_gates when it is given.
+# With phase_gating = (trigger_index, number_of_phase_gates), the gates are the amplitude x phase gates of
+# combine_gates, -1 for the time blocks without a cardiac phase.
+def gate_time_blocks(
+    time_blocks,
+    time_stamps: np.ndarray,
+    physio_amplitude: np.ndarray,
+    number_of_gates: int,
+    minimum_physio_amplitude: float,
+    maximum_physio_amplitude: float,
+    batch_size: int,
+    all_gates=None,
+    phase_gating=None,
+):
+    batch = []
+    batch_starts = []
+
+    def flush_batch():
+        block_gates = compute_block_gates(
+            np.array(batch_starts, dtype=np.int64),
+            time_stamps,
+            physio_amplitude,
+            number_of_gates,
+            minimum_physio_amplitude,
+            maximum_physio_amplitude,
         )
-        sys.exit(1)
+        if phase_gating is not None:
+            trigger_index, number_of_phase_gates = phase_gating
+            block_gates = combine_gates(
+                block_gates,
+                compute_phase_gates(batch_starts, trigger_index, number_of_phase_gates),
+                number_of_phase_gates,
+            )
+        if all_gates is not None:
+            all_gates.append(block_gates)
+        gate_position = 0
+        for time_block in batch:
+            if isEventTimeBlock(time_block):
+                yield int(block_gates[gate_position]), time_block
+                gate_position += 1
+            else:
+                yield None, time_block
+        batch.clear()
+        batch_starts.clear()
+
+    for time_block in time_blocks:
+        batch.append(time_block)
+        if isEventTimeBlock(time_block):
+            batch_starts.append(timeBlockStart(time_block))
+            if len(batch_starts) == batch_size:
+                yield from flush_batch()
+    yield from flush_batch()
+
+
+# output file of a gate, opened in append mode again when it was closed to stay under the cap of open files
+class GateFile:
+    def __init__(self, gate_writers: "GateWriters", name: str):
+        self.name = name
+        self._gate_writers = gate_writers
+        self._file = None
+        self._created = False
+
+    def write(self, data) -> int:
+        if self._file is None:
+            self._gate_writers.make_room(self)
+            self._file = open(self.name, "ab" if self._created else "wb")
+            self._created = True
+        else:
+            self._gate_writers.touch(self)
+        return self._file.write(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._gate_writers.release(self)
+
+
+# writers of the gates, opened lazily: the time blocks of a gate wait in a list until batch_size of them are written
+# in one call, the writer of a gate is only created when it gets its first batch, and at most max_open_files output
+# files are open at once (the least recently written one is closed, and reopened in append mode when needed).
+# Time blocks written in all the gates (e.g. external signals) are kept to start the gates created later, until
+# every gate got a time block, and the gates that never got any time block are written at the end with only them.
+# With write_depth > 0, the writers are created and written by an encoder thread (see write_behind.py) so the
+# encoding overlaps with the routing; all the file operations happen on that thread.
+# With histogram set ("dense" or "sparse"), the gates are histogrammed (see histogrammer.py) instead of written,
+# the dense histograms of all the gates sharing one budget of dense bins.
+class GateWriters:
+    def __init__(
+        self,
+        header,
+        output_names,
+        telemetry,
+        batch_size: int = 64,
+        max_open_files: int = 16,
+        write_depth: int = 0,
+        histogram=None,
+    ):
+        self.header = header
+        self.output_names = output_names
+        self.telemetry = telemetry
+        self.batch_size = batch_size
+        self.max_open_files = max(max_open_files, 1)
+        self.histogram = histogram
+        self.histogram_budget = HistogramBudget()
+        self.started = [False] * len(output_names)
+        self.writers = [None] * len(output_names)
+        self.files = [None] * len(output_names)
+        self.pending = [[] for _ in output_names]
+        self.shared_blocks = []
+        self.open_files = collections.OrderedDict()
+        self.encoder = EncoderThread(write_depth, name="gate-encoder", telemetry=telemetry)
+
+    def make_room(self, gate_file: GateFile):
+        while len(self.open_files) >= self.max_open_files:
+            _, oldest_file = self.open_files.popitem(last=False)
+            oldest_file.close()
+        self.open_files[id(gate_file)] = gate_file
+
+    def touch(self, gate_file: GateFile):
+        self.open_files.move_to_end(id(gate_file))
+
+    def release(self, gate_file: GateFile):
+        self.open_files.pop(id(gate_file), None)
+
+    def write(self, gate: int, time_block):
+        if not self.started[gate] and len(self.pending[gate]) == 0:
+            self.pending[gate].extend(self.shared_blocks)
+        self.pending[gate].append(time_block)
+        if len(self.pending[gate]) >= self.batch_size:
+            self.flush_gate(gate)
+
+    def write_all(self, time_block):
+        waiting = False
+        for gate in range(len(self.started)):
+            if self.started[gate] or len(self.pending[gate]) != 0:
+                self.write(gate, time_block)
+            else:
+                waiting = True
+        # the shared time blocks are only kept while some gate did not get any time block
+        if waiting:
+            self.shared_blocks.append(time_block)
+        else:
+            self.shared_blocks = []
+
+    def flush_gate(self, gate: int):
+        if not self.started[gate]:
+            self.started[gate] = True
+            self.encoder.submit(self._open_gate, gate)
+        if len(self.pending[gate]) != 0:
+            self.encoder.submit(self._write_gate, gate, self.pending[gate])
+            self.pending[gate] = []
+
+    # run by the encoder
+    def _open_gate(self, gate: int):
+        if self.histogram is not None:
+            self.writers[gate] = HistogramWriter(
+                self.output_names[gate], self.histogram == "sparse", self.histogram_budget
+            )
+        else:
+            self.files[gate] = GateFile(self, self.output_names[gate])
+            self.writers[gate] = self.telemetry.openWriter(self.files[gate])
+        self.writers[gate].write_header(self.header)
+
+    def _write_gate(self, gate: int, time_blocks):
+        self.writers[gate].write_time_blocks(time_blocks)
+
+    def _close_gate(self, gate: int):
+        self.writers[gate].close()
+        if self.files[gate] is not None:
+            self.files[gate].close()
+        self.writers[gate] = None
+
+    def close(self):
+        for gate in range(len(self.started)):
+            if not self.started[gate] and len(self.pending[gate]) == 0:
+                self.pending[gate].extend(self.shared_blocks)
+            self.flush_gate(gate)
+            self.encoder.submit(self._close_gate, gate)
+        self.encoder.close()
+
+
+# write a list of time blocks: event time blocks go to the file of their gate (none when the gate is negative),
+# the other time blocks (e.g. external signals) are written in all the gates
+def route_time_blocks(time_blocks, block_gates, gate_writers: GateWriters):
+    gate_position = 0
+    for time_block in time_blocks:
+        if isEventTimeBlock(time_block):
+            gate = block_gates[gate_position]
+            if gate >= 0:
+                gate_writers.write(gate, time_block)
+            gate_position += 1
+        else:
+            gate_writers.write_all(time_block)
+
+
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        prog="rnd_gating_amplitude",
+        description="Split a PETSIRD file in amplitude based physio_1 gates",
+    )
+    parser.add_argument("input_file", type=str, help="Input PETSIRD file")
+    parser.add_argument("number_of_gates", type=int, help="Number of gates")
+    parser.add_argument(
+        "minimum_physio_1_amplitude",
+        type=float,
+        nargs="?",
+        default=None,
+        help="Amplitude of the first gate (with --equal_count: optional, lowest amplitude "
+        "used to compute the gate edges)",
+    )
+    parser.add_argument(
+        "maximum_physio_1_amplitude",
+        type=float,
+        nargs="?",
+        default=None,
+        help="Amplitude of the end of the last gate (with --equal_count: optional, highest "
+        "amplitude used to compute the gate edges)",
+    )
+    parser.add_argument(
+        "--equal_count",
+        action="store_true",
+        help="Equal count gating: the gate edges are the quantiles of the amplitude at the "
+        "start of the time blocks weighted by their prompts (from the time block index when "
+        "there is one, otherwise from a first counting pass)",
+    )
+    parser.add_argument(
+        "--physio",
+        type=str,
+        default="physio/resp_sino.csv",
+        help="CSV file with the time stamps (s) and the physio_1 amplitude",
+    )
+    parser.add_argument(
+        "--signal_id",
+        type=int,
+        default=None,
+        help="Use the ExternalSignalTimeBlocks with this signal id in the input file "
+        "instead of the CSV file",
+    )
+    parser.add_argument(
+        "--gate_cache",
+        type=str,
+        default=None,
+        help="File (.npz) where the gate of each time block is saved, and reused by later runs",
+    )
+    parser.add_argument(
+        "--use_index",
+        action="store_true",
+        help="Use the time block index of the input (built if missing or stale, see tb_index.py): "
+        "the gates of all the time blocks are computed at once from the indexed start times",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="Number of time blocks for which the gates are computed at once",
+    )
+    parser.add_argument(
+        "--cardiac_gates",
+        type=int,
+        default=None,
+        help="Dual gating: also split every amplitude gate in this number of cardiac phase gates, "
+        "the phase being the position of the time block start between two triggers",
+    )
+    parser.add_argument(
+        "--cardiac_triggers",
+        type=str,
+        default=None,
+        help="CSV file with the time stamps (s) and a value, the samples with a non zero value being "
+        "the cardiac triggers",
+    )
+    parser.add_argument(
+        "--cardiac_signal_id",
+        type=int,
+        default=None,
+        help="Use the ExternalSignalTimeBlocks with this signal id in the input file as cardiac "
+        "triggers (non zero samples) instead of the CSV file",
+    )
+    parser.add_argument(
+        "--maximum_cycle",
+        type=float,
+        default=None,
+        help="Longest valid cardiac cycle (s), the time blocks of longer cycles (missed triggers) "
+        "are dropped",
+    )
+    parser.add_argument(
+        "--write_batch",
+        type=int,
+        default=64,
+        help="Number of time blocks of a gate written at once",
+    )
+    parser.add_argument(
+        "--write_depth",
+        type=int,
+        default=0,
+        help="Number of batches waiting to be written by the encoder thread of the gates "
+        "(0: written by the main loop, see write_behind.py)",
+    )
+    addHistogramArguments(parser)
+    parser.add_argument(
+        "--max_open_files",
+        type=int,
+        default=16,
+        help="Maximum number of gate files open at once",
+    )
+    addProfileArguments(parser)
+    args = parser.parse_args()
+    if not args.equal_count and args.maximum_physio_1_amplitude is None:
+        parser.error(
+            "the minimum and maximum physio_1 amplitudes are required without --equal_count"
+        )
+    if args.cardiac_gates is not None and (args.cardiac_triggers is None) == (args.cardiac_signal_id is None):
+        parser.error("--cardiac_gates needs either --cardiac_triggers or --cardiac_signal_id")
+    return args
+
+
+if __name__ == "__main__":
+    args = parserCreator()
     # asign the arguments to variables
-    input_file = sys.argv[1]
-    number_of_gates = int(sys.argv[2])
-    minimum_physio_1_amplitude = float(sys.argv[3])
-    maximum_physio_1_amplitude = float(sys.argv[4])
+    input_file = args.input_file
+    number_of_gates = args.number_of_gates
+    minimum_physio_1_amplitude = args.minimum_physio_1_amplitude
+    maximum_physio_1_amplitude = args.maximum_physio_1_amplitude
+    telemetry = Telemetry("rnd_gating_amplitude", args.profile)
     # read the input file
     reader = petsird.BinaryPETSIRDReader(input_file)
     header = reader.read_header()
@@ -66,40 +606,146 @@ if __name__ == "__main__":
     print(f"Number of TOF bins: {header.scanner.number_of_tof_bins()}")
     print(f"Number of energy bins: {header.scanner.number_of_energy_bins()}")
 
-    # load the physio signal TODO this part will be replaced with the in-packet physio data
-    time_stamps, physio_1_amplitude = read_csv_file("physio/resp_sino.csv")
-    # create acounter for the time stamps, where it starts with 0. TODO, this part will change, if physio is in-packet.
-    time_stamp_counter = 0
-    # initiallize the writer. we open the generalized "writers" as a dynamic system that can change with the number of gates provided by the user
-    writers = [
-        petsird.BinaryPETSIRDWriter(f"gate_physio_1_{i}.raw")
-        for i in range(0, number_of_gates)
-    ]
-    for writer_gate in writers:
-        writer_gate.write_header(header)
-
-    # writer = petsird.BinaryPETSIRDWriter("test.raw")
-    # writer.write_header(header)
-
-    # get all the time blocks and for each one, get the events
-    for time_block in reader.read_time_blocks():
-        # for now, we just assume that the first time block has the same time stamp with the first physio record
-        time_stamp = (
-            time_block.id * 0.001
-        )  # the id are in msec and we convert them in seconds
-        # compare the time stamp of the time block with the physio time stamp at the time_stamp_counter
-        if time_stamp >= time_stamps[time_stamp_counter + 1]:
-            # if the time stamp of the time block is bigger than the physio time stamp, increase the time_stamp_counter by 1
-            time_stamp_counter += 1
-        gate_indicator = asign_gate(
-            physio_1_amplitude[time_stamp_counter],
+    gating_parameters = (
+        number_of_gates,
+        np.nan if minimum_physio_1_amplitude is None else minimum_physio_1_amplitude,
+        np.nan if maximum_physio_1_amplitude is None else maximum_physio_1_amplitude,
+    )
+    if args.equal_count:
+        gating_parameters += (1,)
+    # dual gating: gate r * number_of_phase_gates + c for the amplitude gate r and the cardiac phase gate c
+    number_of_phase_gates = args.cardiac_gates
+    trigger_files = ()
+    if number_of_phase_gates is not None:
+        gating_parameters += (
+            number_of_phase_gates,
+            np.nan if args.maximum_cycle is None else args.maximum_cycle,
+            -1 if args.cardiac_signal_id is None else args.cardiac_signal_id,
+        )
+        trigger_files = (args.cardiac_triggers,)
+    if args.signal_id is not None:
+        cache_key = gate_cache_key(
+            input_file, None, gating_parameters + (args.signal_id,), trigger_files
+        )
+    else:
+        cache_key = gate_cache_key(input_file, args.physio, gating_parameters, trigger_files)
+    cached_gates = load_gate_cache(args.gate_cache, cache_key)
+
+    index = loadIndex(input_file) if args.use_index else None
+
+    # load the physio signal, either from the raw data file (first pass) or from the csv file.
+    # It is not needed when the gates are cached.
+    phase_gating = None
+    if cached_gates is None:
+        with telemetry.stage("physio"):
+            if args.signal_id is not None:
+                time_stamps, physio_1_amplitude = read_external_signal(
+                    input_file, args.signal_id, index
+                )
+            else:
+                time_stamps, physio_1_amplitude = read_csv_file(args.physio)
+            if number_of_phase_gates is not None:
+                if args.cardiac_signal_id is not None:
+                    trigger_times = trigger_times_of(
+                        *read_external_signal(input_file, args.cardiac_signal_id, index)
+                    )
+                else:
+                    trigger_times = trigger_times_of(*read_csv_file(args.cardiac_triggers))
+                trigger_index = build_trigger_index(trigger_times, args.maximum_cycle)
+                phase_gating = (trigger_index, number_of_phase_gates)
+                print(f"Cardiac triggers: {len(trigger_index[0])}")
+
+        block_starts = None
+        if args.equal_count:
+            # first pass: start and prompts of every event time block (read from the index when there is one),
+            # the gate edges are the weighted quantiles of their amplitudes
+            with telemetry.stage("counts"):
+                counts = acquisitionCounts(input_file, args.use_index)
+            block_starts = counts["eventStart"]
+            cached_gates, gate_edges = compute_equal_count_gates(
+                block_starts,
+                counts["nbPrompt"],
+                time_stamps,
+                physio_1_amplitude,
+                number_of_gates,
+                minimum_physio_1_amplitude,
+                maximum_physio_1_amplitude,
+            )
+            gate_prompts = np.bincount(
+                cached_gates, weights=counts["nbPrompt"], minlength=number_of_gates
+            )
+            print(f"Gate edges: {np.array2string(gate_edges, precision=4)}")
+            print(f"Prompts per gate: {gate_prompts.astype(np.int64).tolist()}")
+        elif index is not None:
+            # the start of every event time block is in the index, all the gates are computed at once
+            block_starts = index["start"][casePositions(index)]
+            cached_gates = compute_block_gates(
+                block_starts,
+                time_stamps,
+                physio_1_amplitude,
+                number_of_gates,
+                minimum_physio_1_amplitude,
+                maximum_physio_1_amplitude,
+            )
+        if cached_gates is not None:
+            if phase_gating is not None:
+                cached_gates = combine_gates(
+                    cached_gates,
+                    compute_phase_gates(block_starts, trigger_index, number_of_phase_gates),
+                    number_of_phase_gates,
+                )
+            save_gate_cache(args.gate_cache, cache_key, cached_gates.astype(np.int32))
+
+    # the writers of the gates are opened lazily, with at most max_open_files files open at once
+    histogram = None
+    if args.histogram:
+        histogram = "sparse" if args.histogramSparse else "dense"
+    output_ext = ".raw" if histogram is None else ".npz"
+    if number_of_phase_gates is None:
+        output_names = [f"gate_physio_1_{i}{output_ext}" for i in range(0, number_of_gates)]
+    else:
+        output_names = [
+            f"gate_physio_1_{i}_cardiac_{j}{output_ext}"
+            for i in range(0, number_of_gates)
+            for j in range(0, number_of_phase_gates)
+        ]
+    gate_writers = GateWriters(
+        header,
+        output_names,
+        telemetry,
+        args.write_batch,
+        args.max_open_files,
+        args.write_depth,
+        histogram,
+    )
+
+    if cached_gates is not None:
+        # the gate of every time block is known, routing is a lookup in the cached array
+        route_time_blocks(
+            telemetry.timeBlocks(reader.read_time_blocks()), cached_gates, gate_writers
+        )
+    else:
+        # get the time blocks by batch, compute the gates of the batch at once and route them
+        all_gates = []
+        for gate, time_block in gate_time_blocks(
+            telemetry.timeBlocks(reader.read_time_blocks()),
+            time_stamps,
+            physio_1_amplitude,
             number_of_gates,
             minimum_physio_1_amplitude,
             maximum_physio_1_amplitude,
+            args.batch_size,
+            all_gates,
+            phase_gating,
+        ):
+            if gate is None:
+                gate_writers.write_all(time_block)
+            elif gate >= 0:
+                gate_writers.write(gate, time_block)
+        save_gate_cache(
+            args.gate_cache, cache_key, np.concatenate(all_gates).astype(np.int32)
         )
 
-        # each gate that has been indicated will be written to a different file name
-        writers[gate_indicator].write_time_blocks([time_block])
+    gate_writers.close()
 
-    for writer_gate in writers:
-        writer_gate.close()
+    telemetry.report()
@@ -3,7 +3,8 @@
 
 """
 Goal: Enable the generation of a noisier instance of an acquisition by either dropping
-times block or events.
+times block or events, or of a bootstrap replicate by resampling the events with
+replacement (each event repeated k ~ Poisson(retentionFrac) times).
 
 
 TODO:
@@ -11,7 +12,7 @@ TODO:
 		- Singles rates is not ajusted.
 		- Dead times measurement is not dealt with.
 	Feature:
-		- Quicker algo
+		- Quicker algo (the event mode draws one numpy mask per event list)
 """
 
 #########################################################################################
@@ -19,12 +20,39 @@ TODO:
 #########################################################################################
 # Basic python module
 import argparse
-import random
+import array
+import collections
+import contextlib
+import os
 import sys
-from typing import Union
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple, Union
+
+# Other module
+import numpy as np
 
 # This project module
 import petsird
+from array_codec import addArrayCodecArguments, openReader
+from event_arrays import (
+    asEventArray,
+    asEventList,
+    bootstrapEvents,
+    nbEvents,
+    selectEvents,
+    thinEvents,
+    withEventArrays,
+)
+from tb_index import casePositions, loadIndex, readTimeBlocks, splitIndex
+from histogrammer import (
+    HistogramBudget,
+    HistogramWriter,
+    addHistogramArguments,
+    histogramOutput,
+)
+from telemetry import Telemetry, addProfileArguments
+from write_behind import addWriteBehindArguments, writeBehind
 
 # from petsird.types import TimeBlock
 from petsird.types import *
@@ -46,53 +74,460 @@ def defineWriter(oFile: Union[str, None], verbose: int):
         return oFile
 
 
-def sampleByTimeBlock(cTimeBlock: TimeBlock, retFrac: float):
-    if random.random() < retFrac:
-        return (cTimeBlock,), None
-    else:
-        return None
+def defineReplicateOutputs(oFile: Union[str, None], nbReplicates: int, verbose: int):
+    if nbReplicates == 1:
+        return [defineWriter(oFile, verbose)]
 
+    if oFile is None:
+        sys.exit("An output file is required when more than one replicate is produced.")
+    if "{}" in oFile:
+        return [oFile.format(cRep) for cRep in range(nbReplicates)]
+    stem, ext = os.path.splitext(oFile)
+    return [f"{stem}_rep{cRep}{ext}" for cRep in range(nbReplicates)]
 
-def sampleByEvent(cTimeBlock: TimeBlock, retFrac: float):
-    keptPrompt = []
-    for cPr in cTimeBlock.value.prompt_events:
-        if random.random() < retFrac:
-            keptPrompt.append(cPr)
 
-    if cTimeBlock.value.delayed_events is not None:
-        keptDelay = []
-        for cDl in cTimeBlock.value.delayed_events:
-            if random.random() < retFrac:
-                keptDelay.append(cDl)
-        nbKeptDelay = len(keptDelay)
-    else:
-        keptDelay = None
-        nbKeptDelay = 0
-
-    if cTimeBlock.value.triple_events is not None:
-        keptTriple = []
-        for cDl in cTimeBlock.value.triple_events:
-            if random.random() < retFrac:
-                keptTriple.append(cDl)
-        nbKeptTriple = len(keptTriple)
+def defineSeedKey(seed: Union[int, None]):
+    # Without a seed, fresh entropy is drawn once and shared by all the workers
+    return np.random.SeedSequence(seed).generate_state(2, dtype=np.uint64)
+
+
+def blockRng(seedKey: np.ndarray, cRep: int, tbID: int):
+    """
+    Counter-based generator of one time block of one replicate. The draws only depend
+    on (seed, replicate, time block position), not on which process samples the block.
+    """
+    return np.random.Generator(np.random.Philox(key=seedKey, counter=[0, 0, cRep, tbID]))
+
+
+def sampleByTimeBlock(cTimeBlock: TimeBlock, retFrac: float, rng: np.random.Generator):
+    if rng.random() < retFrac:
+        return (cTimeBlock,), None
     else:
-        keptTriple = None
-        nbKeptTriple = 0
+        return None
 
-    stats = (len(keptPrompt), nbKeptDelay, nbKeptTriple)
+
+def buildEventTimeBlock(cTimeBlock: TimeBlock, prompts, delays, triples):
+    stats = (nbEvents(prompts), nbEvents(delays), nbEvents(triples))
 
     return (
         petsird.TimeBlock.EventTimeBlock(
             petsird.EventTimeBlock(
-                start=time_block.value.start,
-                prompt_events=keptPrompt,
-                delayed_events=keptDelay,
-                triple_events=keptTriple,
+                start=cTimeBlock.value.start,
+                prompt_events=asEventList(prompts),
+                delayed_events=asEventList(delays),
+                triple_events=asEventList(triples),
             ),
         ),
     ), stats
 
 
+def sampleByEvent(cTimeBlock: TimeBlock, retFrac: float, rng: np.random.Generator):
+    return buildEventTimeBlock(
+        cTimeBlock,
+        thinEvents(cTimeBlock.value.prompt_events, retFrac, rng),
+        thinEvents(cTimeBlock.value.delayed_events, retFrac, rng),
+        thinEvents(cTimeBlock.value.triple_events, retFrac, rng),
+    )
+
+
+def sampleByBootstrap(cTimeBlock: TimeBlock, retFrac: float, rng: np.random.Generator):
+    # retFrac is used as the Poisson mean, 1 gives the classical Poisson bootstrap
+    return buildEventTimeBlock(
+        cTimeBlock,
+        bootstrapEvents(cTimeBlock.value.prompt_events, retFrac, rng),
+        bootstrapEvents(cTimeBlock.value.delayed_events, retFrac, rng),
+        bootstrapEvents(cTimeBlock.value.triple_events, retFrac, rng),
+    )
+
+
+def sampleTimeBlocks(
+    indexedTimeBlocks: Iterable[Tuple[int, TimeBlock]],
+    writers: List[petsird.BinaryPETSIRDWriter],
+    sampler,
+    retFrac: float,
+    seedKey: np.ndarray,
+    eventLevel: bool,
+):
+    """
+    Sample each (position, time block) once per writer (replicate) while decoding the
+    input only once. Returns the totals [timeBlock, prompt, delay, triple] of the input
+    and the same counts kept for each replicate.
+    """
+    nbTotal = np.zeros(4, dtype=np.int64)
+    nbKept = np.zeros((len(writers), 4), dtype=np.int64)
+
+    for tbID, time_block in indexedTimeBlocks:
+        if not isinstance(time_block, petsird.TimeBlock.EventTimeBlock):
+            for writer in writers:
+                writer.write_time_blocks((time_block,))
+            continue
+
+        nbTotal += (
+            1,
+            nbEvents(time_block.value.prompt_events),
+            nbEvents(time_block.value.delayed_events),
+            nbEvents(time_block.value.triple_events),
+        )
+        if eventLevel and len(writers) > 1:
+            # Convert the event lists once, not once per replicate
+            time_block = withEventArrays(time_block)
+
+        for cRep, writer in enumerate(writers):
+            res = sampler(time_block, retFrac, blockRng(seedKey, cRep, tbID))
+            if res is not None:
+                resTimeBlock, stats = res
+                writer.write_time_blocks(resTimeBlock)
+                nbKept[cRep, 0] += 1
+                if stats is not None:
+                    nbKept[cRep, 1:] += stats
+
+    return nbTotal, nbKept
+
+
+def packTimeBlock(cTimeBlock: TimeBlock):
+    # The union case classes of petsird cannot be pickled, their payload can
+    return type(cTimeBlock).__name__.rsplit(".", 1)[-1], cTimeBlock.value
+
+
+def unpackTimeBlock(packedTimeBlock):
+    caseName, value = packedTimeBlock
+    return getattr(petsird.TimeBlock, caseName)(value)
+
+
+class TimeBlockCollector:
+    """Stand-in for a writer that keeps the time blocks to send them back to the parent."""
+
+    def __init__(self):
+        self.timeBlocks = []
+
+    def write_time_blocks(self, timeBlocks: Iterable[TimeBlock]):
+        self.timeBlocks.extend(timeBlocks)
+
+
+def sampleToPacked(
+    indexedTimeBlocks: Iterable[Tuple[int, TimeBlock]],
+    sampler,
+    retFrac: float,
+    seedKey: np.ndarray,
+    eventLevel: bool,
+    nbReplicates: int,
+):
+    collectors = [TimeBlockCollector() for _ in range(nbReplicates)]
+    nbTotal, nbKept = sampleTimeBlocks(
+        indexedTimeBlocks, collectors, sampler, retFrac, seedKey, eventLevel
+    )
+    packedOut = [
+        [packTimeBlock(cTimeBlock) for cTimeBlock in cCollector.timeBlocks]
+        for cCollector in collectors
+    ]
+    return packedOut, nbTotal, nbKept
+
+
+def sampleShard(packedShard: List[Tuple[int, tuple]], *samplingArgs):
+    return sampleToPacked(
+        ((tbID, unpackTimeBlock(cPacked)) for tbID, cPacked in packedShard),
+        *samplingArgs,
+    )
+
+
+def sampleIndexedShard(acqPath: str, shardIndex: np.ndarray, first: int, *samplingArgs):
+    # The worker decodes its own shard, seeking with the index records of the shard
+    return sampleToPacked(
+        enumerate(readTimeBlocks(acqPath, shardIndex), first), *samplingArgs
+    )
+
+
+def shardTimeBlocks(indexedTimeBlocks: Iterable[Tuple[int, TimeBlock]], shardSize: int):
+    shard = []
+    for tbID, cTimeBlock in indexedTimeBlocks:
+        shard.append((tbID, packTimeBlock(cTimeBlock)))
+        if len(shard) == shardSize:
+            yield shard
+            shard = []
+    if len(shard) != 0:
+        yield shard
+
+
+def defineShardTasks(
+    acqPath: str,
+    index: Union[np.ndarray, None],
+    timeBlocks: Union[Iterable[TimeBlock], None],
+    shardSize: int,
+    samplingArgs: tuple,
+):
+    """
+    (function, arguments) sampling each shard. With an index, a shard is only its index
+    records, the len(index) / shardSize shards holding about the same number of events;
+    otherwise the time blocks decoded here are sent to the workers.
+    """
+    if index is not None:
+        nbShards = -(-len(index) // shardSize)
+        for first, stop in splitIndex(index, nbShards):
+            yield sampleIndexedShard, (acqPath, np.array(index[first:stop]), first) + samplingArgs
+    else:
+        for shard in shardTimeBlocks(enumerate(timeBlocks), shardSize):
+            yield sampleShard, (shard,) + samplingArgs
+
+
+def sampleTimeBlocksParallel(
+    shardTasks: Iterable[tuple],
+    writers: List[petsird.BinaryPETSIRDWriter],
+    nbWorkers: int,
+):
+    """
+    Same as sampleTimeBlocks, but contiguous shards of time blocks are sampled in a
+    process pool. Shards are written back in their original order, one time block per
+    write so the output is byte for byte the one of a serial run.
+    """
+    nbTotal = np.zeros(4, dtype=np.int64)
+    nbKept = np.zeros((len(writers), 4), dtype=np.int64)
+    pending = collections.deque()
+
+    def writeOldestShard():
+        packedOut, shardTotal, shardKept = pending.popleft().result()
+        for writer, cPackedTimeBlocks in zip(writers, packedOut):
+            for cPacked in cPackedTimeBlocks:
+                writer.write_time_blocks((unpackTimeBlock(cPacked),))
+        nbTotal[:] += shardTotal
+        nbKept[:] += shardKept
+
+    with ProcessPoolExecutor(max_workers=nbWorkers) as pool:
+        for shardFunction, shardArgs in shardTasks:
+            pending.append(pool.submit(shardFunction, *shardArgs))
+            # Bound the number of shards held in memory
+            if len(pending) >= 2 * nbWorkers:
+                writeOldestShard()
+        while len(pending) != 0:
+            writeOldestShard()
+
+    return nbTotal, nbKept
+
+
+def allocationRng(seedKey: np.ndarray, cRep: int):
+    """Generator of the exact count selection of one replicate (not tied to a time block)."""
+    return np.random.Generator(np.random.Philox(key=seedKey, counter=[0, 1, cRep, 0]))
+
+
+def allocateTargetCounts(
+    nbPrompts: np.ndarray, nbTarget: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Number of prompts kept in each time block so that exactly nbTarget prompts, drawn
+    uniformly among all the prompts, are kept (multivariate hypergeometric).
+    """
+    nbPrompts = np.asarray(nbPrompts, dtype=np.int64)
+    if nbTarget >= nbPrompts.sum():
+        return nbPrompts.copy()
+    return rng.multivariate_hypergeometric(nbPrompts, nbTarget)
+
+
+def sampleTargetCounts(
+    indexedTimeBlocks: Iterable[Tuple[int, TimeBlock]],
+    writers: List[petsird.BinaryPETSIRDWriter],
+    allocations: np.ndarray,
+    otherFrac: float,
+    seedKey: np.ndarray,
+):
+    """
+    Keep allocations[cRep, k] prompts of the k-th event time block in replicate cRep,
+    and the delays and triples with the probability otherFrac. Same returns as
+    sampleTimeBlocks.
+    """
+    nbTotal = np.zeros(4, dtype=np.int64)
+    nbKept = np.zeros((len(writers), 4), dtype=np.int64)
+
+    eventBlockPos = 0
+    for tbID, time_block in indexedTimeBlocks:
+        if not isinstance(time_block, petsird.TimeBlock.EventTimeBlock):
+            for writer in writers:
+                writer.write_time_blocks((time_block,))
+            continue
+
+        nbTotal += (
+            1,
+            nbEvents(time_block.value.prompt_events),
+            nbEvents(time_block.value.delayed_events),
+            nbEvents(time_block.value.triple_events),
+        )
+        if len(writers) > 1:
+            time_block = withEventArrays(time_block)
+
+        for cRep, writer in enumerate(writers):
+            rng = blockRng(seedKey, cRep, tbID)
+            resTimeBlock, stats = buildEventTimeBlock(
+                time_block,
+                selectEvents(
+                    time_block.value.prompt_events, allocations[cRep, eventBlockPos], rng
+                ),
+                thinEvents(time_block.value.delayed_events, otherFrac, rng),
+                thinEvents(time_block.value.triple_events, otherFrac, rng),
+            )
+            writer.write_time_blocks(resTimeBlock)
+            nbKept[cRep] += (1,) + stats
+        eventBlockPos += 1
+
+    return nbTotal, nbKept
+
+
+class EventReservoir:
+    """
+    Streaming selection of exactly nbTarget prompts among an unknown number of them:
+    every prompt gets a uniform random key and the nbTarget smallest keys are kept. The
+    candidates above the nbTarget-th smallest key are pruned each time nbTarget more
+    have been accepted, so the events held stay O(nbTarget). The delays and triples are
+    kept with the same key threshold, i.e. with the probability of a prompt.
+    """
+
+    LISTS = ("prompt_events", "delayed_events", "triple_events")
+
+    def __init__(self, nbTarget: int, rng: np.random.Generator):
+        self.nbTarget = nbTarget
+        self.rng = rng
+        self.threshold = np.inf
+        self.nbPromptCandidates = 0
+        # For each list: chunks of (keys, block positions, positions in the block, events)
+        self.chunks = {cList: [] for cList in EventReservoir.LISTS}
+
+    def add(self, blockPos: int, cTimeBlock: TimeBlock):
+        for cList in EventReservoir.LISTS:
+            cEvents = getattr(cTimeBlock.value, cList)
+            if nbEvents(cEvents) == 0:
+                continue
+            keys = self.rng.random(len(cEvents))
+            accepted = np.flatnonzero(keys < self.threshold)
+            self.chunks[cList].append(
+                (
+                    keys[accepted],
+                    np.full(len(accepted), blockPos, dtype=np.int64),
+                    accepted,
+                    asEventArray(cEvents)[accepted],
+                )
+            )
+            if cList == "prompt_events":
+                self.nbPromptCandidates += len(accepted)
+
+        if self.nbPromptCandidates >= 2 * self.nbTarget:
+            self._prune()
+
+    def _merged(self, cList: str):
+        if len(self.chunks[cList]) == 0:
+            return (
+                np.empty(0),
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=object),
+            )
+        return tuple(np.concatenate(cColumn) for cColumn in zip(*self.chunks[cList]))
+
+    def _prune(self):
+        promptKeys = self._merged("prompt_events")[0]
+        if len(promptKeys) > self.nbTarget:
+            self.threshold = np.partition(promptKeys, self.nbTarget - 1)[self.nbTarget - 1]
+        for cList in EventReservoir.LISTS:
+            keys, blockPos, positions, events = self._merged(cList)
+            kept = keys <= self.threshold
+            self.chunks[cList] = [
+                (keys[kept], blockPos[kept], positions[kept], events[kept])
+            ]
+        self.nbPromptCandidates = len(self.chunks["prompt_events"][0][0])
+
+    def selection(self, nbBlocks: int):
+        """
+        For each list, (events, bounds): the events kept, in their original order, those
+        of the k-th of the nbBlocks blocks being events[bounds[k]:bounds[k + 1]].
+        """
+        self._prune()
+        selection = {}
+        for cList in EventReservoir.LISTS:
+            _, blockPos, positions, events = self._merged(cList)
+            order = np.lexsort((positions, blockPos))
+            bounds = np.searchsorted(blockPos[order], np.arange(nbBlocks + 1))
+            selection[cList] = (events[order], bounds)
+        return selection
+
+
+# Kinds of the time blocks held by sampleTargetCountsReservoir: an event time block is the
+# sum of the flags of its defined lists (the prompts always are), the others are OTHER
+OTHER = -1
+LIST_FLAGS = {"prompt_events": 1, "delayed_events": 2, "triple_events": 4}
+
+
+def sampleTargetCountsReservoir(
+    indexedTimeBlocks: Iterable[Tuple[int, TimeBlock]],
+    writers: List[petsird.BinaryPETSIRDWriter],
+    nbTarget: int,
+    seedKey: np.ndarray,
+):
+    """
+    Exact count selection in a single pass, without knowing the counts beforehand. The
+    outputs are written at the end of the pass. The memory holds the kept events
+    (O(nbTarget)), plus O(number of time blocks): the start and the defined lists of
+    each event time block, and the other time blocks as they are (e.g. the values of the
+    external signals). Same returns as sampleTimeBlocks.
+    """
+    nbTotal = np.zeros(4, dtype=np.int64)
+    nbKept = np.zeros((len(writers), 4), dtype=np.int64)
+    reservoirs = [
+        EventReservoir(nbTarget, allocationRng(seedKey, cRep)) for cRep in range(len(writers))
+    ]
+
+    # The time blocks to write: the kind of each one (OTHER, or the lists defined in an
+    # event time block, see LIST_FLAGS), the start of the event time blocks and the other
+    # time blocks as they are
+    kinds = array.array("b")
+    starts = array.array("q")
+    otherBlocks = []
+    for _, time_block in indexedTimeBlocks:
+        if not isinstance(time_block, petsird.TimeBlock.EventTimeBlock):
+            kinds.append(OTHER)
+            otherBlocks.append(time_block)
+            continue
+
+        nbTotal += (
+            1,
+            nbEvents(time_block.value.prompt_events),
+            nbEvents(time_block.value.delayed_events),
+            nbEvents(time_block.value.triple_events),
+        )
+        for reservoir in reservoirs:
+            reservoir.add(len(starts), time_block)
+        kinds.append(
+            sum(
+                cFlag
+                for cList, cFlag in LIST_FLAGS.items()
+                if getattr(time_block.value, cList) is not None
+            )
+        )
+        starts.append(time_block.value.start)
+
+    for reservoir, writer, cKept in zip(reservoirs, writers, nbKept):
+        selection = reservoir.selection(len(starts))
+        eventBlockPos = 0
+        otherPos = 0
+        for cKind in kinds:
+            if cKind == OTHER:
+                writer.write_time_blocks((otherBlocks[otherPos],))
+                otherPos += 1
+                continue
+            lists = []
+            for cList, cFlag in LIST_FLAGS.items():
+                events, bounds = selection[cList]
+                lists.append(
+                    events[bounds[eventBlockPos] : bounds[eventBlockPos + 1]]
+                    if cKind & cFlag
+                    else None
+                )
+            cTimeBlock = petsird.TimeBlock.EventTimeBlock(
+                petsird.EventTimeBlock(start=starts[eventBlockPos], prompt_events=[])
+            )
+            resTimeBlock, stats = buildEventTimeBlock(cTimeBlock, *lists)
+            writer.write_time_blocks(resTimeBlock)
+            cKept += (1,) + stats
+            eventBlockPos += 1
+
+    return nbTotal, nbKept
+
+
 def providBasicStat(
     verbose: int,
     randoMethod: str,
@@ -106,13 +541,13 @@ def providBasicStat(
     npTripleKept: int,
 ):
 
-    if verbose > 0 and randoMethod == "TimeBlock":
+    if verbose > 0 and randoMethod == "timeBlock":
         print(
             f"Number of time block kept {nbEventTimeBlockKept} out of {nbEventTimeBlock}. "
             + f"In percent: {(nbEventTimeBlockKept / nbEventTimeBlock) * 100.0}%"
         )
 
-    if verbose > 0 and randoMethod == "event":
+    if verbose > 0 and randoMethod in ("event", "bootstrap"):
         print(
             f"Number of prompt kept {nbPromptKept} out of {nbPrompt}. "
             + f"In percent: {(nbPromptKept / nbPrompt) * 100.0}%"
@@ -153,18 +588,33 @@ def parserCreator():
         "--retentionFrac",
         action="store",
         type=float,
-        required=True,
+        default=None,
         dest="retFrac",
-        help="The expected fraction of retend events/time blocks.",
+        help="The expected fraction of retend events/time blocks. In bootstrap "
+        "mode, the mean of the Poisson number of copies of each event (1 for a "
+        "classical bootstrap).",
+    )
+    parser.add_argument(
+        "--targetCounts",
+        action="store",
+        type=int,
+        default=None,
+        dest="targetCounts",
+        help="Keep exactly this number of prompts, drawn uniformly across the "
+        "acquisition, instead of a retention fraction. The delays and triples are kept "
+        "with the resulting fraction. With --useIndex, the prompts are allocated to the "
+        "time blocks from the index (hypergeometric), otherwise a reservoir is used and "
+        "the output is written at the end of the reading.",
     )
     parser.add_argument(
         "-m",
         "--randoMethod",
         action="store",
-        choices=["event", "timeBlock"],
-        default="timeBlock",
+        choices=["event", "timeBlock", "bootstrap"],
+        default=None,
         dest="randoMethod",
-        help="The method used for retention of events.",
+        help="The method used for retention of events (default: timeBlock, event with "
+        "--targetCounts). bootstrap resamples the events with replacement.",
     )
     parser.add_argument(
         "-o",
@@ -188,6 +638,49 @@ def parserCreator():
         dest="seed",
         help="Set the seed used for retention method.",
     )
+    parser.add_argument(
+        "-n",
+        "--nbReplicates",
+        action="store",
+        type=int,
+        default=1,
+        dest="nbReplicates",
+        help="Number of independent realizations produced while reading the "
+        "acquisition only once. With more than one, the output file is required and "
+        "each replicate is saved as <outputFile>_rep<i>, or at the place of {} if "
+        "the output file name contains it.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        dest="workers",
+        help="Number of processes used to sample the time blocks. The output does "
+        "not depend on it for a given seed.",
+    )
+    parser.add_argument(
+        "--shardSize",
+        action="store",
+        type=int,
+        default=64,
+        dest="shardSize",
+        help="Number of consecutive time blocks sent at once to a worker (on average "
+        "with --useIndex, where the shards hold about the same number of events).",
+    )
+    parser.add_argument(
+        "--useIndex",
+        action="store_true",
+        default=False,
+        dest="useIndex",
+        help="Use the time block index of the acquisition (built if missing or "
+        "stale, see tb_index.py) so each worker decodes its own shard.",
+    )
+    addProfileArguments(parser)
+    addWriteBehindArguments(parser)
+    addHistogramArguments(parser)
+    addArrayCodecArguments(parser)
     parser.add_argument(
         "-v",
         "--verbose",
@@ -204,7 +697,213 @@ def parserCreator():
 #########################################################################################
 # Test functions
 #########################################################################################
-# n/a
+def benchmarkSampleByEvent(nbEvent: int = 2_000_000, retFrac: float = 0.5, seed: int = 0):
+    # The same event object is repeated since only the selection is measured here, the
+    # rate is reported, not checked: benchmark.py tracks the throughput on decoded streams.
+    events = [petsird.CoincidenceEvent()] * nbEvent
+    cTimeBlock = petsird.TimeBlock.EventTimeBlock(
+        petsird.EventTimeBlock(
+            start=0, prompt_events=events, delayed_events=events[: nbEvent // 10]
+        )
+    )
+    rng = np.random.default_rng(seed)
+
+    tStart = time.perf_counter()
+    _, stats = sampleByEvent(cTimeBlock, retFrac, rng)
+    elapsed = time.perf_counter() - tStart
+
+    nbProcessed = nbEvent + nbEvent // 10
+    eventRate = nbProcessed / elapsed
+    print(
+        f"sampleByEvent: {nbProcessed} events in {elapsed:.3f} s ({eventRate:.3e} events/s)",
+        file=sys.stderr,
+    )
+    # Statistical behaviour: kept fraction within 5 sigma of the binomial expectation
+    sigma = (nbEvent * retFrac * (1.0 - retFrac)) ** 0.5
+    assert abs(stats[0] - nbEvent * retFrac) < 5.0 * sigma
+
+    return eventRate
+
+
+def _testTimeBlocks(nbBlocks: int = 40, maxPrompts: int = 60, seed: int = 0):
+    """Event time blocks whose events are told apart by their tof_idx, one signal block in 5."""
+    rng = np.random.default_rng(seed)
+    timeBlocks = []
+    eventID = 0
+    for cBlock in range(nbBlocks):
+        if cBlock % 5 == 4:
+            timeBlocks.append(
+                petsird.TimeBlock.ExternalSignalTimeBlock(
+                    petsird.ExternalSignalTimeBlock(
+                        time_interval=petsird.TimeInterval(start=cBlock, stop=cBlock + 1),
+                        signal_id=1,
+                        signal_values=[float(cBlock)],
+                    )
+                )
+            )
+            continue
+        lists = []
+        for nbList in (rng.integers(0, maxPrompts), rng.integers(0, maxPrompts // 4)):
+            lists.append(
+                [
+                    petsird.CoincidenceEvent(
+                        detector_ids=[0, 1], tof_idx=eventID + k, energy_indices=[0, 0]
+                    )
+                    for k in range(nbList)
+                ]
+            )
+            eventID += nbList
+        timeBlocks.append(
+            petsird.TimeBlock.EventTimeBlock(
+                petsird.EventTimeBlock(
+                    start=cBlock, prompt_events=lists[0], delayed_events=lists[1]
+                )
+            )
+        )
+    return timeBlocks
+
+
+def _timeBlockKey(cTimeBlock: TimeBlock):
+    """Comparable content of a time block written by the samplers of _testTimeBlocks."""
+    if not isinstance(cTimeBlock, petsird.TimeBlock.EventTimeBlock):
+        return type(cTimeBlock).__name__, cTimeBlock.value.time_interval.start
+    return (
+        "EventTimeBlock",
+        cTimeBlock.value.start,
+        tuple(
+            None
+            if getattr(cTimeBlock.value, cList) is None
+            else tuple(cEvent.tof_idx for cEvent in getattr(cTimeBlock.value, cList))
+            for cList in LIST_FLAGS
+        ),
+    )
+
+
+def testTargetCounts(nbTarget: int = 300):
+    allocations = allocateTargetCounts([5, 0, 7, 3], 10, np.random.default_rng(0))
+    assert allocations.sum() == 10 and np.all(allocations <= [5, 0, 7, 3])
+    assert allocateTargetCounts([5, 0, 7, 3], 20, np.random.default_rng(0)).tolist() == [5, 0, 7, 3]
+
+    timeBlocks = _testTimeBlocks()
+    seedKey = defineSeedKey(0)
+    runs = []
+    for _ in range(2):
+        collectors = [TimeBlockCollector(), TimeBlockCollector()]
+        nbTotal, nbKept = sampleTargetCountsReservoir(
+            enumerate(timeBlocks), collectors, nbTarget, seedKey
+        )
+        runs.append(
+            [[_timeBlockKey(cTimeBlock) for cTimeBlock in c.timeBlocks] for c in collectors]
+        )
+    assert runs[0] == runs[1], "the selection must only depend on the seed"
+    assert runs[0][0] != runs[0][1], "the replicates must differ"
+
+    for cRep, cKeys in enumerate(runs[0]):
+        # Exactly nbTarget prompts, the time blocks and the events in their original order
+        assert nbKept[cRep, 1] == nbTarget
+        assert [cKey[:2] for cKey in cKeys] == [
+            _timeBlockKey(cTimeBlock)[:2] for cTimeBlock in timeBlocks
+        ]
+        prompts = [cID for cKey in cKeys if len(cKey) == 3 for cID in cKey[2][0]]
+        assert len(prompts) == nbTarget and prompts == sorted(set(prompts))
+
+    # With the allocations of the index, the counts of each time block are exact
+    nbPrompts = [
+        nbEvents(cTimeBlock.value.prompt_events)
+        for cTimeBlock in timeBlocks
+        if isinstance(cTimeBlock, petsird.TimeBlock.EventTimeBlock)
+    ]
+    allocations = allocateTargetCounts(nbPrompts, nbTarget, allocationRng(seedKey, 0))[None, :]
+    collector = TimeBlockCollector()
+    sampleTargetCounts(enumerate(timeBlocks), [collector], allocations, 0.5, seedKey)
+    kept = [
+        nbEvents(cTimeBlock.value.prompt_events)
+        for cTimeBlock in collector.timeBlocks
+        if isinstance(cTimeBlock, petsird.TimeBlock.EventTimeBlock)
+    ]
+    assert kept == allocations[0].tolist()
+
+
+def _sampledKeys(timeBlocks, nbReplicates, sampler, retFrac, seed, eventLevel=True):
+    collectors = [TimeBlockCollector() for _ in range(nbReplicates)]
+    sampleTimeBlocks(
+        enumerate(timeBlocks), collectors, sampler, retFrac, defineSeedKey(seed), eventLevel
+    )
+    return [[_timeBlockKey(cTimeBlock) for cTimeBlock in c.timeBlocks] for c in collectors]
+
+
+def testReplicates():
+    timeBlocks = _testTimeBlocks()
+    for sampler, eventLevel in ((sampleByEvent, True), (sampleByTimeBlock, False)):
+        replicates = _sampledKeys(timeBlocks, 3, sampler, 0.5, 7, eventLevel)
+        assert replicates == _sampledKeys(timeBlocks, 3, sampler, 0.5, 7, eventLevel)
+        assert len(set(map(tuple, replicates))) == 3, "the replicates must differ"
+        # A replicate only depends on its own stream, not on the number of replicates
+        assert replicates[0] == _sampledKeys(timeBlocks, 1, sampler, 0.5, 7, eventLevel)[0]
+        assert replicates != _sampledKeys(timeBlocks, 3, sampler, 0.5, 8, eventLevel)
+
+
+def testBootstrap(nbEvent: int = 20000, seed: int = 0):
+    events = [
+        petsird.CoincidenceEvent(detector_ids=[0, 1], tof_idx=k, energy_indices=[0, 0])
+        for k in range(nbEvent)
+    ]
+    cTimeBlock = petsird.TimeBlock.EventTimeBlock(
+        petsird.EventTimeBlock(start=0, prompt_events=events)
+    )
+    for retFrac in (1.0, 0.5):
+        (resTimeBlock,), stats = sampleByBootstrap(
+            cTimeBlock, retFrac, np.random.default_rng(seed)
+        )
+        ids = [cEvent.tof_idx for cEvent in resTimeBlock.value.prompt_events]
+        multiplicity = np.bincount(ids, minlength=nbEvent)
+        # Poisson(retFrac) multiplicities: mean and variance retFrac, within 5 sigma
+        assert stats[0] == len(ids) and resTimeBlock.value.delayed_events is None
+        assert abs(multiplicity.mean() - retFrac) < 5.0 * (retFrac / nbEvent) ** 0.5
+        varSigma = ((retFrac + 2.0 * retFrac**2) / nbEvent) ** 0.5
+        assert abs(multiplicity.var() - retFrac) < 5.0 * varSigma
+        # The copies of an event are contiguous and the events keep their order
+        assert ids == sorted(ids)
+
+
+class _CallWriter:
+    """In-memory writer keeping the time blocks of each write_time_blocks call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def write_header(self, header):
+        self.calls.append("header")
+
+    def write_time_blocks(self, timeBlocks: Iterable[TimeBlock]):
+        self.calls.append([_timeBlockKey(cTimeBlock) for cTimeBlock in timeBlocks])
+
+    def close(self):
+        pass
+
+
+def testParallelSampling(nbWorkers: int = 2, shardSize: int = 3):
+    # Serial and parallel runs write the same calls for a given --writeBatch and seed
+    timeBlocks = _testTimeBlocks()
+    samplingArgs = (sampleByEvent, 0.5, defineSeedKey(3), True, 2)
+    for writeBatch in (1, 4):
+        runs = []
+        for cWorkers in (1, nbWorkers):
+            callWriters = [_CallWriter() for _ in range(samplingArgs[-1])]
+            writers = [writeBehind(cWriter, writeBatch, 0) for cWriter in callWriters]
+            if cWorkers == 1:
+                nbTotal, nbKept = sampleTimeBlocks(
+                    enumerate(timeBlocks), writers, *samplingArgs[:-1]
+                )
+            else:
+                shardTasks = defineShardTasks(None, None, timeBlocks, shardSize, samplingArgs)
+                nbTotal, nbKept = sampleTimeBlocksParallel(shardTasks, writers, cWorkers)
+            for writer in writers:
+                writer.close()
+            runs.append(
+                ([cWriter.calls for cWriter in callWriters], nbTotal.tolist(), nbKept.tolist())
+            )
+        assert runs[0] == runs[1], f"serial and parallel runs differ (writeBatch {writeBatch})"
 
 
 #########################################################################################
@@ -213,78 +912,150 @@ def parserCreator():
 if __name__ == "__main__":
     args = parserCreator()
 
-    if args.seed is not None:
-        random.seed(args.seed)
-
-    writerOutput = defineWriter(args.oFile, args.verbose)
+    if args.nbReplicates < 1:
+        sys.exit("The number of replicates must be at least 1.")
+    writerOutputs = defineReplicateOutputs(args.oFile, args.nbReplicates, args.verbose)
+    if args.workers < 1 or args.shardSize < 1:
+        sys.exit("The number of workers and the shard size must be at least 1.")
+    if (args.retFrac is None) == (args.targetCounts is None):
+        sys.exit("One of --retentionFrac and --targetCounts is required.")
+    if args.targetCounts is not None:
+        if args.targetCounts < 1:
+            sys.exit("The target counts must be at least 1.")
+        # The exact count selection is done event by event
+        if args.randoMethod not in (None, "event"):
+            sys.exit(
+                f"--targetCounts selects events, it cannot be used with -m {args.randoMethod}."
+            )
+        args.randoMethod = "event"
+        if args.workers > 1:
+            print("Warning: --targetCounts runs in a single process.", file=sys.stderr)
+            args.workers = 1
+    elif args.randoMethod is None:
+        args.randoMethod = "timeBlock"
+    if args.useIndex and args.targetCounts is None and args.workers == 1:
+        print(
+            "Warning: --useIndex is only used with --targetCounts or several workers (-w).",
+            file=sys.stderr,
+        )
+    seedKey = defineSeedKey(args.seed)
 
-    if args.randoMethod == "timeBlock":
-        sampler = lambda TimeBlock: sampleByTimeBlock(TimeBlock, args.retFrac)
+    eventLevel = args.randoMethod != "timeBlock"
+    if args.randoMethod == "bootstrap":
+        sampler = sampleByBootstrap
+    elif args.randoMethod == "event":
+        sampler = sampleByEvent
     else:
-        sampler = lambda TimeBlock: sampleByEvent(TimeBlock, args.retFrac)
-
-    with petsird.BinaryPETSIRDWriter(writerOutput) as writer:
-        reader = petsird.BinaryPETSIRDReader(args.acq)
-        header = reader.read_header()
-        writer.write_header(header)
-
-        # Variable for basic static
-        nbTimeBlock = 0
-        nbTimeBlockKept = 0
-        nbPrompt = 0
-        nbPromptKept = 0
-        nbDelay = 0
-        nbDelayKept = 0
-        nbTriple = 0
-        npTripleKept = 0
-
-        for tbID, time_block in enumerate(reader.read_time_blocks()):
-            # print(type(time_block))
-            if isinstance(time_block, petsird.TimeBlock.EventTimeBlock):
-                # 	print("IS_A_TIMEBLOCK")
-                nbTimeBlock += 1
-                nbPrompt += len(time_block.value.prompt_events)
-                if time_block.value.delayed_events is not None:
-                    nbDelay += len(time_block.value.delayed_events)
-                if time_block.value.triple_events is not None:
-                    nbTriple += len(time_block.value.triple_events)
-
-                res = sampler(time_block)
-                if res is not None:
-                    resTimeBlock, stats = res
-                    writer.write_time_blocks(resTimeBlock)
-                    if args.randoMethod == "timeBlock":
-                        nbTimeBlockKept += 1
-                    elif args.randoMethod == "event":
-                        nbPromptKept += stats[0]
-                        nbDelayKept += stats[1]
-                        npTripleKept += stats[2]
+        sampler = sampleByTimeBlock
+
+    telemetry = Telemetry("rnd_sampler", args.profile)
+    reader = openReader(args.acq, args.arrayCodec)
+    header = reader.read_header()
+
+    # The histograms of all the replicates share the dense bins
+    histogramBudget = HistogramBudget()
+    with contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(
+                writeBehind(
+                    HistogramWriter(
+                        histogramOutput(cOutput), args.histogramSparse, histogramBudget
+                    )
+                    if args.histogram
+                    else telemetry.openWriter(cOutput, args.arrayCodec),
+                    args.writeBatch,
+                    args.writeDepth,
+                    telemetry,
+                )
+            )
+            for cOutput in writerOutputs
+        ]
+        for writer in writers:
+            writer.write_header(header)
+
+        if args.targetCounts is not None:
+            index = loadIndex(args.acq) if args.useIndex else None
+            timeBlocks = enumerate(telemetry.timeBlocks(reader.read_time_blocks()))
+            if index is not None:
+                nbPrompts = index["nbPrompt"][casePositions(index)]
+                allocations = np.stack(
+                    [
+                        allocateTargetCounts(
+                            nbPrompts, args.targetCounts, allocationRng(seedKey, cRep)
+                        )
+                        for cRep in range(len(writers))
+                    ]
+                )
+                otherFrac = min(args.targetCounts / max(int(nbPrompts.sum()), 1), 1.0)
+                nbTotal, nbKept = sampleTargetCounts(
+                    timeBlocks, writers, allocations, otherFrac, seedKey
+                )
             else:
-                writer.write_time_blocks(time_block)
-
-    providBasicStat(
-        args.verbose,
-        args.randoMethod,
-        nbTimeBlock,
-        nbTimeBlockKept,
-        nbPrompt,
-        nbPromptKept,
-        nbDelay,
-        nbDelayKept,
-        nbTriple,
-        npTripleKept,
-    )
+                nbTotal, nbKept = sampleTargetCountsReservoir(
+                    timeBlocks, writers, args.targetCounts, seedKey
+                )
+            if nbTotal[1] < args.targetCounts:
+                print(
+                    f"Warning: the acquisition only has {nbTotal[1]} prompts, all of "
+                    "them are kept.",
+                    file=sys.stderr,
+                )
+        elif args.workers > 1:
+            index = loadIndex(args.acq) if args.useIndex else None
+            shardTasks = defineShardTasks(
+                args.acq,
+                index,
+                telemetry.timeBlocks(reader.read_time_blocks()) if index is None else None,
+                args.shardSize,
+                (sampler, args.retFrac, seedKey, eventLevel, len(writers)),
+            )
+            nbTotal, nbKept = sampleTimeBlocksParallel(shardTasks, writers, args.workers)
+            if index is not None:
+                # The input was only decoded by the workers
+                telemetry.nbTimeBlocks = len(index)
+                telemetry.nbEvents = int(nbTotal[1:].sum())
+        else:
+            nbTotal, nbKept = sampleTimeBlocks(
+                enumerate(telemetry.timeBlocks(reader.read_time_blocks())),
+                writers,
+                sampler,
+                args.retFrac,
+                seedKey,
+                eventLevel,
+            )
 
-    # If the list mode is empty, we still create a valid list mode
-    if (nbTimeBlockKept == 0) and (nbPromptKept == 0):
-        print("Warning: No prompt or time block were preserved")
-        # 		tmp = (petsird.EventTimeBlock(id=0, prompt_events=[]), )
-        tmp = (
-            petsird.TimeBlock.EventTimeBlock(
-                petsird.EventTimeBlock(
-                    start=0,
-                    prompt_events=[],
-                ),
-            ),
+        # If the list mode is empty, we still create a valid list mode
+        for cRep, writer in enumerate(writers):
+            if nbKept[cRep, 1 if eventLevel else 0] == 0:
+                print(
+                    f"Warning: No prompt or time block were preserved (replicate {cRep})",
+                    file=sys.stderr,
+                )
+                writer.write_time_blocks(
+                    (
+                        petsird.TimeBlock.EventTimeBlock(
+                            petsird.EventTimeBlock(
+                                start=0,
+                                prompt_events=[],
+                            ),
+                        ),
+                    )
+                )
+
+    for cRep in range(args.nbReplicates):
+        if args.verbose > 0 and args.nbReplicates > 1:
+            print(f"Replicate {cRep} ({writerOutputs[cRep]}):")
+        providBasicStat(
+            args.verbose,
+            args.randoMethod,
+            nbTotal[0],
+            nbKept[cRep, 0],
+            nbTotal[1],
+            nbKept[cRep, 1],
+            nbTotal[2],
+            nbKept[cRep, 2],
+            nbTotal[3],
+            nbKept[cRep, 3],
         )
-        writer.write_time_blocks(tmp)
+
+    telemetry.report()
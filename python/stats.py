@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Scan an acquisition for its count-rate curves (prompts, delays and triples per
+time block, samples per external signal time block) without writing any list mode, to
+choose frames, gate thresholds or retention fractions before splitting.
+
+When the acquisition has a time block index (see tb_index.py), the event counts are
+read from it and only the external signal time blocks are decoded. Otherwise the
+acquisition is decoded once and only the lengths of the event lists are looked at.
+
+The counts are returned/saved (.npz) as numpy arrays:
+	- eventStart, nbPrompt, nbDelay, nbTriple: one entry per EventTimeBlock,
+	- signalStart, signalId, nbSignalSamples: one entry per ExternalSignalTimeBlock.
+With --binSize, the count rates (counts per second) binned in time are added:
+binStart, promptRate, delayRate, tripleRate.
+
+Usage: python stats.py --acqFile acq.petsird -o acq_stats.npz --binSize 1s
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import sys
+from typing import Dict, Iterable
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from event_arrays import nbEvents
+from frame_splitter import parseDuration
+from tb_index import casePositions, loadIndex, readCaseTimeBlocks
+from timeblock_utils import isEventTimeBlock, timeBlockStart
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def signalCounts(signalTimeBlocks: Iterable) -> Dict[str, np.ndarray]:
+    starts, ids, nbSamples = [], [], []
+    for cTimeBlock in signalTimeBlocks:
+        starts.append(timeBlockStart(cTimeBlock))
+        ids.append(cTimeBlock.value.signal_id)
+        nbSamples.append(len(cTimeBlock.value.signal_values))
+    return {
+        "signalStart": np.array(starts, dtype=np.int64),
+        "signalId": np.array(ids, dtype=np.int64),
+        "nbSignalSamples": np.array(nbSamples, dtype=np.int64),
+    }
+
+
+def countsFromIndex(acqPath: str, index: np.ndarray) -> Dict[str, np.ndarray]:
+    eventIndex = index[casePositions(index)]
+    counts = {
+        "eventStart": eventIndex["start"].astype(np.int64),
+        "nbPrompt": eventIndex["nbPrompt"].astype(np.int64),
+        "nbDelay": eventIndex["nbDelay"].astype(np.int64),
+        "nbTriple": eventIndex["nbTriple"].astype(np.int64),
+    }
+    counts.update(
+        signalCounts(
+            readCaseTimeBlocks(
+                acqPath,
+                index,
+                casePositions(index, petsird.TimeBlock.ExternalSignalTimeBlock),
+            )
+        )
+    )
+    return counts
+
+
+def countsFromTimeBlocks(timeBlocks: Iterable) -> Dict[str, np.ndarray]:
+    eventCounts = []
+    signalTimeBlocks = []
+    for cTimeBlock in timeBlocks:
+        if isEventTimeBlock(cTimeBlock):
+            eventCounts.append(
+                (
+                    timeBlockStart(cTimeBlock),
+                    nbEvents(cTimeBlock.value.prompt_events),
+                    nbEvents(cTimeBlock.value.delayed_events),
+                    nbEvents(cTimeBlock.value.triple_events),
+                )
+            )
+        elif isinstance(cTimeBlock, petsird.TimeBlock.ExternalSignalTimeBlock):
+            signalTimeBlocks.append(cTimeBlock)
+
+    eventCounts = np.array(eventCounts, dtype=np.int64).reshape(-1, 4)
+    counts = {
+        "eventStart": eventCounts[:, 0],
+        "nbPrompt": eventCounts[:, 1],
+        "nbDelay": eventCounts[:, 2],
+        "nbTriple": eventCounts[:, 3],
+    }
+    counts.update(signalCounts(signalTimeBlocks))
+    return counts
+
+
+def acquisitionCounts(acqPath: str, useIndex: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Per time block counts of an acquisition. An existing index is always used, it is
+    built first if useIndex is True.
+    """
+    index = loadIndex(acqPath, build=useIndex)
+    if index is not None:
+        return countsFromIndex(acqPath, index)
+
+    reader = petsird.BinaryPETSIRDReader(sys.stdin.buffer if acqPath == "-" else acqPath)
+    reader.read_header()
+    return countsFromTimeBlocks(reader.read_time_blocks())
+
+
+def countRates(counts: Dict[str, np.ndarray], binSize: int) -> Dict[str, np.ndarray]:
+    """Counts per second in bins of binSize ms, starting at the first time block."""
+    if len(counts["eventStart"]) == 0:
+        return {"binStart": np.empty(0, dtype=np.int64)}
+    origin = counts["eventStart"].min()
+    binIdx = (counts["eventStart"] - origin) // binSize
+    nbBins = int(binIdx.max()) + 1
+    rates = {"binStart": origin + binSize * np.arange(nbBins, dtype=np.int64)}
+    for cName, cRate in (
+        ("nbPrompt", "promptRate"),
+        ("nbDelay", "delayRate"),
+        ("nbTriple", "tripleRate"),
+    ):
+        rates[cRate] = np.bincount(binIdx, weights=counts[cName], minlength=nbBins) * (
+            1000.0 / binSize
+        )
+    return rates
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Count the events of each time block of an acquisition, without "
+        "writing any list mode."
+    )
+
+    parser.add_argument(
+        "--acqFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="acq",
+        help="The acquisition, in PETSIRD format (- for stdin).",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        default=None,
+        dest="oFile",
+        help="The .npz file where the counts are saved.",
+    )
+    parser.add_argument(
+        "-b",
+        "--binSize",
+        action="store",
+        type=str,
+        default=None,
+        dest="binSize",
+        help="Also compute the count rates in bins of this duration (e.g. 1s, 500ms).",
+    )
+    parser.add_argument(
+        "--useIndex",
+        action="store_true",
+        default=False,
+        dest="useIndex",
+        help="Build the time block index of the acquisition if it is missing or "
+        "stale (see tb_index.py). An existing index is always used.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testCountRates():
+    counts = {
+        "eventStart": np.array([0, 500, 1000, 2500]),
+        "nbPrompt": np.array([1, 2, 3, 4]),
+        "nbDelay": np.array([0, 1, 0, 1]),
+        "nbTriple": np.zeros(4, dtype=np.int64),
+    }
+    rates = countRates(counts, 1000)
+    assert rates["binStart"].tolist() == [0, 1000, 2000]
+    assert rates["promptRate"].tolist() == [3.0, 3.0, 4.0]
+    assert rates["delayRate"].tolist() == [1.0, 0.0, 1.0]
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    counts = acquisitionCounts(args.acq, args.useIndex)
+    if args.binSize is not None:
+        counts.update(countRates(counts, parseDuration(args.binSize)))
+
+    if len(counts["eventStart"]) != 0:
+        duration = (counts["eventStart"].max() - counts["eventStart"].min()) / 1000.0
+        print(
+            f"{len(counts['eventStart'])} event time blocks over {duration:g} s: "
+            f"{counts['nbPrompt'].sum()} prompts, {counts['nbDelay'].sum()} delays, "
+            f"{counts['nbTriple'].sum()} triples"
+        )
+    for cSignalId in np.unique(counts["signalId"]):
+        cMask = counts["signalId"] == cSignalId
+        print(
+            f"Signal {cSignalId}: {np.count_nonzero(cMask)} time blocks, "
+            f"{counts['nbSignalSamples'][cMask].sum()} samples"
+        )
+
+    if args.oFile is not None:
+        np.savez(args.oFile, **counts)
@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Generate synthetic PETSIRD acquisitions (and matching physio CSV files) to test
+and benchmark the tools without real data.
+
+The acquisition has one EventTimeBlock every --blockDuration ms over --duration s.
+The number of prompts of each block is Poisson distributed around --countRate (prompts
+per second), the delays are a --delayFraction of the prompts. Detector ids, TOF bins
+and energy bins are uniformly drawn for the scanner of the header. With --signalRate,
+a respiratory like trace sampled at that rate (Hz) is added as one
+ExternalSignalTimeBlock per event time block, in time order.
+
+The draws are done with numpy by time block, only the creation of the event objects
+is done in python.
+
+Usage: python synthetic_petsird.py -o acq.petsird --duration 60 --countRate 1e5
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import sys
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+from append_physio import add_signal_to_header
+
+
+# Default respiratory like trace of the synthetic signal
+RESP_PERIOD = 4.0  # s
+RESP_AMPLITUDE = 100.0
+RESP_BASELINE = 300.0
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def createScanner(
+    nbDetectors: int, nbTofBins: int, nbEnergyBins: int, blockDuration: int
+) -> petsird.ScannerInformation:
+    # The detectors are spread on a single ring
+    angles = 2.0 * np.pi * np.arange(nbDetectors) / nbDetectors
+    detectors = [
+        petsird.Detector(id=cId, x=400.0 * np.cos(cAngle), y=400.0 * np.sin(cAngle), z=0.0)
+        for cId, cAngle in enumerate(angles)
+    ]
+    return petsird.ScannerInformation(
+        model_name="PETSIRD_SYNTHETIC",
+        detectors=detectors,
+        tof_bin_edges=np.linspace(-500.0, 500.0, nbTofBins + 1, dtype=np.float32),
+        tof_resolution=9.4,
+        energy_bin_edges=np.linspace(430.0, 650.0, nbEnergyBins + 1, dtype=np.float32),
+        energy_resolution_at_511=0.11,
+        listmode_time_block_duration=blockDuration,
+    )
+
+
+def createHeader(scanner: petsird.ScannerInformation) -> petsird.Header:
+    exam = petsird.ExamInformation(
+        subject=petsird.Subject(id="synthetic"),
+        institution=petsird.Institution(name="Synthetic data", address="None"),
+    )
+    return petsird.Header(exam=exam, scanner=scanner)
+
+
+def respTrace(timesMs: np.ndarray) -> np.ndarray:
+    return RESP_BASELINE + RESP_AMPLITUDE * np.sin(
+        2.0 * np.pi * timesMs / (1000.0 * RESP_PERIOD)
+    )
+
+
+def createEvents(
+    nbEvent: int,
+    nbDetectors: int,
+    nbTofBins: int,
+    nbEnergyBins: int,
+    rng: np.random.Generator,
+):
+    detectorIds = rng.integers(0, nbDetectors, size=(nbEvent, 2)).tolist()
+    tofIdx = rng.integers(0, nbTofBins, size=nbEvent).tolist()
+    energyIdx = rng.integers(0, nbEnergyBins, size=(nbEvent, 2)).tolist()
+    return [
+        petsird.CoincidenceEvent(
+            detector_ids=cDetectorIds, tof_idx=cTofIdx, energy_indices=cEnergyIdx
+        )
+        for cDetectorIds, cTofIdx, cEnergyIdx in zip(detectorIds, tofIdx, energyIdx)
+    ]
+
+
+def generateTimeBlocks(
+    duration: float,
+    blockDuration: int,
+    countRate: float,
+    delayFraction: float,
+    signalRate: float,
+    signalId: int,
+    nbDetectors: int,
+    nbTofBins: int,
+    nbEnergyBins: int,
+    rng: np.random.Generator,
+    stats: np.ndarray,
+):
+    """
+    Time blocks of the synthetic acquisition. stats ([time blocks, prompts, delays,
+    signal samples]) is updated while the blocks are generated.
+    """
+    nbBlocks = int(round(duration * 1000.0 / blockDuration))
+    meanPrompts = countRate * blockDuration / 1000.0
+    # Samples of the external signal, on a regular grid starting at 0
+    signalTimes = (
+        np.arange(0.0, duration * 1000.0, 1000.0 / signalRate)
+        if signalRate > 0
+        else np.empty(0)
+    )
+
+    for cBlock in range(nbBlocks):
+        start = cBlock * blockDuration
+        nbPrompt = int(rng.poisson(meanPrompts))
+        nbDelay = int(rng.poisson(nbPrompt * delayFraction)) if delayFraction > 0 else 0
+        yield petsird.TimeBlock.EventTimeBlock(
+            petsird.EventTimeBlock(
+                start=start,
+                prompt_events=createEvents(
+                    nbPrompt, nbDetectors, nbTofBins, nbEnergyBins, rng
+                ),
+                delayed_events=(
+                    createEvents(nbDelay, nbDetectors, nbTofBins, nbEnergyBins, rng)
+                    if delayFraction > 0
+                    else None
+                ),
+            )
+        )
+        stats += (1, nbPrompt, nbDelay, 0)
+
+        first, stop = np.searchsorted(signalTimes, (start, start + blockDuration))
+        if stop > first:
+            yield petsird.TimeBlock.ExternalSignalTimeBlock(
+                petsird.ExternalSignalTimeBlock(
+                    time_interval=petsird.TimeInterval(start=start, stop=start + blockDuration),
+                    signal_id=signalId,
+                    signal_values=respTrace(signalTimes[first:stop]).astype(np.float32).tolist(),
+                )
+            )
+            stats[3] += stop - first
+
+
+def writePhysioCsv(csvPath: str, duration: float, sampleRate: float, timeUnit: str = "ms"):
+    """
+    Respiratory like trace (time stamp, value) sampled at sampleRate Hz. The time stamps
+    are in ms (append_physio.py) or in s (rnd_gating_amplitude.py).
+    """
+    timesMs = np.arange(0.0, duration * 1000.0, 1000.0 / sampleRate)
+    timeStamps = timesMs if timeUnit == "ms" else timesMs / 1000.0
+    np.savetxt(
+        csvPath, np.column_stack((timeStamps, respTrace(timesMs))), fmt="%.6g", delimiter=","
+    )
+    return len(timesMs)
+
+
+def writeSyntheticAcquisition(
+    oFile: str,
+    duration: float,
+    blockDuration: int = 5,
+    countRate: float = 1e5,
+    delayFraction: float = 0.1,
+    signalRate: float = 0.0,
+    signalId: int = 1,
+    nbDetectors: int = 400,
+    nbTofBins: int = 11,
+    nbEnergyBins: int = 3,
+    seed: int = 0,
+) -> np.ndarray:
+    """Write the acquisition, returns [time blocks, prompts, delays, signal samples]."""
+    rng = np.random.default_rng(seed)
+    stats = np.zeros(4, dtype=np.int64)
+
+    header = createHeader(createScanner(nbDetectors, nbTofBins, nbEnergyBins, blockDuration))
+    if signalRate > 0:
+        add_signal_to_header(header, petsird.ExternalSignalTypeEnum.RESP_TRACE, signalId)
+
+    with petsird.BinaryPETSIRDWriter(oFile) as writer:
+        writer.write_header(header)
+        for cTimeBlock in generateTimeBlocks(
+            duration,
+            blockDuration,
+            countRate,
+            delayFraction,
+            signalRate,
+            signalId,
+            nbDetectors,
+            nbTofBins,
+            nbEnergyBins,
+            rng,
+            stats,
+        ):
+            writer.write_time_blocks((cTimeBlock,))
+
+    return stats
+
+
+#########################################################################################
+# Scripting functionnality
+#########################################################################################
+def parserCreator():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic acquisition in PETSIRD format."
+    )
+
+    ##################################################
+    # Basic
+    parser.add_argument(
+        "-o",
+        "--outputFile",
+        action="store",
+        type=str,
+        required=True,
+        dest="oFile",
+        help="The path/name of the synthetic acquisition.",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        action="store",
+        type=float,
+        default=10.0,
+        dest="duration",
+        help="Duration of the acquisition (s).",
+    )
+    parser.add_argument(
+        "-b",
+        "--blockDuration",
+        action="store",
+        type=int,
+        default=5,
+        dest="blockDuration",
+        help="Duration of a time block (ms).",
+    )
+    parser.add_argument(
+        "-c",
+        "--countRate",
+        action="store",
+        type=float,
+        default=1e5,
+        dest="countRate",
+        help="Mean number of prompts per second.",
+    )
+    parser.add_argument(
+        "--delayFraction",
+        action="store",
+        type=float,
+        default=0.1,
+        dest="delayFraction",
+        help="Mean number of delays per prompt (0 for no delayed events list).",
+    )
+    parser.add_argument(
+        "--signalRate",
+        action="store",
+        type=float,
+        default=0.0,
+        dest="signalRate",
+        help="Sampling rate (Hz) of the external signal written in the acquisition "
+        "(0 for none).",
+    )
+
+    ##################################################
+    # Feature
+    parser.add_argument(
+        "--signalId",
+        action="store",
+        type=int,
+        default=1,
+        dest="signalId",
+        help="Id of the external signal.",
+    )
+    parser.add_argument(
+        "--physioCsv",
+        action="store",
+        type=str,
+        default=None,
+        dest="physioCsv",
+        help="Also write the external signal (at --signalRate, 10 Hz if 0) in a CSV file.",
+    )
+    parser.add_argument(
+        "--csvTimeUnit",
+        action="store",
+        choices=["ms", "s"],
+        default="ms",
+        dest="csvTimeUnit",
+        help="Unit of the time stamps of the CSV file: ms for append_physio.py, s "
+        "for rnd_gating_amplitude.py.",
+    )
+    parser.add_argument(
+        "--nbDetectors",
+        action="store",
+        type=int,
+        default=400,
+        dest="nbDetectors",
+        help="Number of detectors of the scanner.",
+    )
+    parser.add_argument(
+        "--nbTofBins",
+        action="store",
+        type=int,
+        default=11,
+        dest="nbTofBins",
+        help="Number of TOF bins of the scanner.",
+    )
+    parser.add_argument(
+        "--nbEnergyBins",
+        action="store",
+        type=int,
+        default=3,
+        dest="nbEnergyBins",
+        help="Number of energy bins of the scanner.",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        action="store",
+        type=int,
+        default=0,
+        dest="seed",
+        help="Seed of the generation.",
+    )
+
+    return parser.parse_args()
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    args = parserCreator()
+
+    stats = writeSyntheticAcquisition(
+        args.oFile,
+        args.duration,
+        args.blockDuration,
+        args.countRate,
+        args.delayFraction,
+        args.signalRate,
+        args.signalId,
+        args.nbDetectors,
+        args.nbTofBins,
+        args.nbEnergyBins,
+        args.seed,
+    )
+    print(
+        f"{args.oFile}: {stats[0]} event time blocks, {stats[1]} prompts, "
+        f"{stats[2]} delays, {stats[3]} signal samples",
+        file=sys.stderr,
+    )
+
+    if args.physioCsv is not None:
+        writePhysioCsv(
+            args.physioCsv,
+            args.duration,
+            args.signalRate if args.signalRate > 0 else 10.0,
+            args.csvTimeUnit,
+        )
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Build and use an index of the time blocks of a PETSIRD file, so the tools can seek
+to any time block, shard a file across workers or know the event counts of every time
+block without decoding the whole file.
+
+The index holds one record per time block (see INDEX_DTYPE):
+	- offset: byte offset of the time block in the file,
+	- chunkRemaining: number of time blocks left in its stream chunk, itself included
+	  (a PETSIRD stream is a sequence of chunks "count, time blocks..."),
+	- case: index of its case in the TimeBlock union (0 is EventTimeBlock),
+	- start: its start time (ms),
+	- nbPrompt, nbDelay, nbTriple: its event counts (0 for other time blocks).
+
+It is saved as a .npy sidecar next to the file, <file>.<size>_<mtime_ns>.tbindex.npy, and
+rebuilt (one decoding pass) when the file changed.
+
+Usage: python tb_index.py file1 [file2 ...] builds/refreshes the index of the files.
+
+Note: seeking relies on the position of the generated binary reader in its input stream,
+so it is only available for files, not for the standard input. It also relies on private
+yardl/petsird internals (the TimeBlock union serializer, the position of the coded input
+stream): they are checked once, when an index is first loaded (see internalsError), and
+when they are not the expected ones the index is not used, the tools reading the whole
+file instead.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import functools
+import glob
+import inspect
+import io
+import os
+import sys
+from typing import Iterator, Union
+
+# Other module
+import numpy as np
+
+# This project module
+import petsird
+import petsird.binary
+from petsird import _binary
+from atomic_write import saveAtomically
+from event_arrays import nbEvents
+from timeblock_utils import isEventTimeBlock, timeBlockStart
+
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("offset", np.uint64),
+        ("chunkRemaining", np.uint32),
+        ("case", np.uint8),
+        ("start", np.int64),
+        ("nbPrompt", np.uint32),
+        ("nbDelay", np.uint32),
+        ("nbTriple", np.uint32),
+    ]
+)
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def indexPath(acqPath: str) -> str:
+    acqStat = os.stat(acqPath)
+    return f"{acqPath}.{acqStat.st_size}_{acqStat.st_mtime_ns}.tbindex.npy"
+
+
+@functools.lru_cache(maxsize=None)
+def timeBlockSerializer():
+    """
+    The TimeBlock union serializer, built from the union cases of petsird.TimeBlock and
+    their serializers in petsird.binary as the generated reader and writer build it.
+    """
+    cases = sorted(
+        (
+            (cValue.index, cName, cValue)
+            for cName, cValue in vars(petsird.TimeBlock).items()
+            if isinstance(cValue, type) and isinstance(getattr(cValue, "index", None), int)
+        ),
+        key=lambda cCase: cCase[0],
+    )
+    if [cCase[0] for cCase in cases] != list(range(len(cases))):
+        raise RuntimeError(
+            f"Unsupported petsird version: unexpected TimeBlock union cases {cases}."
+        )
+    caseSerializers = []
+    for _, cName, cCaseType in cases:
+        cSerializerClass = getattr(petsird.binary, f"{cName}Serializer", None)
+        if cSerializerClass is None:
+            raise RuntimeError(
+                f"Unsupported petsird version: petsird.binary has no {cName}Serializer."
+            )
+        caseSerializers.append((cCaseType, cSerializerClass()))
+    return _binary.UnionSerializer(petsird.TimeBlock, caseSerializers)
+
+
+def _tell(reader: petsird.BinaryPETSIRDReader) -> int:
+    codedStream = reader._stream
+    return codedStream._stream.tell() - (
+        codedStream._last_read_count - codedStream._offset
+    )
+
+
+def _seek(reader: petsird.BinaryPETSIRDReader, offset: int):
+    codedStream = reader._stream
+    codedStream._stream.seek(offset)
+    codedStream._offset = 0
+    codedStream._last_read_count = 0
+    codedStream._at_end = False
+
+
+def checkInternals() -> Union[str, None]:
+    """
+    None when the private yardl/petsird internals used here work as expected, otherwise
+    the reason they do not: the cases of the TimeBlock union serializer must be record
+    serializers whose fields are the ones of their records, and _tell must find the end
+    of a header followed by an empty stream, written and read back in memory.
+    """
+    try:
+        for cCase in timeBlockSerializer()._cases:
+            cRecordName = cCase[0].__name__.rpartition(".")[2]
+            if not isinstance(cCase[1], _binary.RecordSerializer):
+                return f"{cRecordName} is not serialized as a record"
+            fieldNames = [cField[0] for cField in cCase[1]._field_serializers]
+            recordFields = list(inspect.signature(getattr(petsird, cRecordName)).parameters)
+            if fieldNames != recordFields:
+                return f"the fields of {cRecordName} {recordFields} are serialized as {fieldNames}"
+
+        output = io.BytesIO()
+        writer = petsird.BinaryPETSIRDWriter(output)
+        writer.write_header(petsird.Header())
+        writer.write_time_blocks([])
+        writer.close()
+        reader = petsird.BinaryPETSIRDReader(io.BytesIO(output.getvalue()))
+        reader.read_header()
+        if _tell(reader) != len(output.getvalue()) - 1:
+            return "the position of the binary reader in its input stream is not the expected one"
+        _seek(reader, _tell(reader))
+        if reader._stream.read_unsigned_varint() != 0:
+            return "seeking the binary reader in its input stream failed"
+    except Exception as exc:
+        return f"{type(exc).__name__}: {exc}"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def internalsError() -> Union[str, None]:
+    """checkInternals, run once when first needed, with a warning when it fails."""
+    error = checkInternals()
+    if error is not None:
+        print(
+            "Warning: the time block index is not supported by the installed petsird "
+            f"({error}), the whole file is read.",
+            file=sys.stderr,
+        )
+    return error
+
+
+def buildIndex(acqPath: str) -> np.ndarray:
+    reader = petsird.BinaryPETSIRDReader(acqPath)
+    reader.read_header()
+    serializer = timeBlockSerializer()
+
+    records = []
+    while (chunkSize := reader._stream.read_unsigned_varint()) > 0:
+        for cPos in range(chunkSize):
+            offset = _tell(reader)
+            cTimeBlock = serializer.read(reader._stream)
+            if isEventTimeBlock(cTimeBlock):
+                counts = (
+                    nbEvents(cTimeBlock.value.prompt_events),
+                    nbEvents(cTimeBlock.value.delayed_events),
+                    nbEvents(cTimeBlock.value.triple_events),
+                )
+            else:
+                counts = (0, 0, 0)
+            records.append(
+                (
+                    offset,
+                    chunkSize - cPos,
+                    cTimeBlock.index,
+                    timeBlockStart(cTimeBlock),
+                )
+                + counts
+            )
+    reader._close()
+
+    return np.array(records, dtype=INDEX_DTYPE)
+
+
+def loadIndex(acqPath: str, build: bool = True) -> Union[np.ndarray, None]:
+    """
+    Index of acqPath (memory-mapped). A missing or stale index is rebuilt if build is
+    True, otherwise None is returned, as when the installed petsird is not supported.
+    """
+    if not os.path.isfile(acqPath):
+        return None
+    if internalsError() is not None:
+        return None
+    cIndexPath = indexPath(acqPath)
+    if os.path.exists(cIndexPath):
+        return np.load(cIndexPath, mmap_mode="r")
+    if not build:
+        return None
+
+    index = buildIndex(acqPath)
+    try:
+        saveAtomically(
+            cIndexPath,
+            lambda f: np.save(f, index),
+            f"{glob.escape(acqPath)}.*_*.tbindex.npy",
+        )
+    except OSError:
+        pass
+    return index
+
+
+def _readRuns(acqPath: str, index: np.ndarray, runs) -> Iterator:
+    # One reader for all the runs [first, stop), seeking to the first time block of each
+    reader = petsird.BinaryPETSIRDReader(acqPath)
+    serializer = timeBlockSerializer()
+    try:
+        for first, stop in runs:
+            _seek(reader, int(index["offset"][first]))
+            remaining = int(index["chunkRemaining"][first])
+            for _ in range(first, stop):
+                if remaining == 0:
+                    remaining = reader._stream.read_unsigned_varint()
+                yield serializer.read(reader._stream)
+                remaining -= 1
+    finally:
+        reader._close()
+
+
+def readTimeBlocks(
+    acqPath: str, index: np.ndarray, first: int = 0, stop: Union[int, None] = None
+) -> Iterator:
+    """Decode only the time blocks [first, stop) of acqPath, seeking to the first one."""
+    if stop is None:
+        stop = len(index)
+    if first >= stop:
+        return iter(())
+    return _readRuns(acqPath, index, ((first, stop),))
+
+
+def casePositions(index: np.ndarray, caseType=petsird.TimeBlock.EventTimeBlock):
+    """Positions of the time blocks of one case of the union (e.g. ExternalSignalTimeBlock)."""
+    return np.flatnonzero(index["case"] == caseType.index)
+
+
+def readCaseTimeBlocks(acqPath: str, index: np.ndarray, positions: np.ndarray) -> Iterator:
+    """
+    Decode only the time blocks at positions (sorted), with one reader seeking to each
+    contiguous run.
+    """
+    if len(positions) == 0:
+        return iter(())
+    runs = np.split(positions, np.flatnonzero(np.diff(positions) != 1) + 1)
+    return _readRuns(acqPath, index, [(int(cRun[0]), int(cRun[-1]) + 1) for cRun in runs])
+
+
+def splitIndex(index: np.ndarray, nbShards: int):
+    """
+    Bounds [first, stop) of nbShards contiguous shards holding about the same number of
+    events (time blocks count as one event so empty ones are spread too).
+    """
+    weight = (
+        index["nbPrompt"].astype(np.int64)
+        + index["nbDelay"]
+        + index["nbTriple"]
+        + 1
+    )
+    cumWeight = np.cumsum(weight)
+    if len(cumWeight) == 0:
+        return []
+    targets = cumWeight[-1] * np.arange(1, nbShards) / nbShards
+    bounds = np.concatenate(
+        ([0], np.searchsorted(cumWeight, targets, side="right"), [len(index)])
+    )
+    bounds = np.unique(bounds)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python tb_index.py file1 [file2 ...]")
+    for cAcqPath in sys.argv[1:]:
+        cIndex = loadIndex(cAcqPath)
+        print(
+            f"{cAcqPath}: {len(cIndex)} time blocks, "
+            f"{len(casePositions(cIndex))} event time blocks, "
+            f"{int(cIndex['nbPrompt'].sum())} prompts -> {indexPath(cAcqPath)}"
+        )
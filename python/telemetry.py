@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Opt-in profiling (--profile) shared by the tools, to tell whether a slow run is
+spent decoding the input, in the tool itself or encoding the outputs.
+
+The tools wrap the time blocks read from their inputs with timeBlocks() and open their
+outputs with openWriter(). When the profiling is enabled:
+	- decode: time spent waiting for the next input time block (the reader itself, or
+	  its prefetch queue),
+	- encode: time spent in write_header/write_time_blocks/close of the outputs,
+	- process: the rest of the run (sampling, merging, gating...),
+each with its wall time and the CPU time of the main thread, plus the input time blocks
+and events per second and the bytes written in each output. The tools can time other
+stages of their own with stage(), e.g. the loading of a physio signal.
+
+A progress line is printed every PROGRESS_INTERVAL seconds while the input is read.
+The report goes to stderr or to a JSON file, never to stdout which can be the data
+stream. When the profiling is disabled, the inputs and writers are left untouched.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import json
+import sys
+import threading
+import time
+from typing import BinaryIO, Iterable, Union
+
+# This project module
+import petsird
+from array_codec import ArrayPETSIRDWriter
+from event_arrays import nbEvents
+from timeblock_utils import isEventTimeBlock
+
+
+PROGRESS_INTERVAL = 10.0  # s
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def addProfileArguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        action="store",
+        type=str,
+        nargs="?",
+        const="-",
+        default=None,
+        dest="profile",
+        help="Profile the run (decode/process/encode times, events/s, bytes written). "
+        "The report is printed on stderr, or saved in the given JSON file.",
+    )
+
+
+class CountingStream:
+    """Binary output stream counting the bytes written through it."""
+
+    def __init__(self, output: Union[str, BinaryIO]):
+        if isinstance(output, str):
+            self._stream = open(output, "wb")
+            self._ownsStream = True
+        else:
+            self._stream = output
+            self._ownsStream = False
+        self.nbBytes = 0
+
+    def write(self, data) -> int:
+        self.nbBytes += len(data)
+        return self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        if self._ownsStream:
+            self._stream.close()
+        else:
+            self._stream.flush()
+
+
+class ProfiledWriter:
+    """BinaryPETSIRDWriter whose calls are timed as the encode stage."""
+
+    def __init__(
+        self, telemetry: "Telemetry", output: Union[str, BinaryIO], arrayCodec: bool = False
+    ):
+        self._telemetry = telemetry
+        self._stream = CountingStream(output)
+        self._writer = (
+            ArrayPETSIRDWriter(self._stream)
+            if arrayCodec
+            else petsird.BinaryPETSIRDWriter(self._stream)
+        )
+        self.name = output if isinstance(output, str) else getattr(output, "name", "<stream>")
+        self.nbTimeBlocks = 0
+        self._closed = False
+        telemetry.writers.append(self)
+
+    def write_header(self, header):
+        with self._telemetry.stage("encode"):
+            self._writer.write_header(header)
+
+    def write_time_blocks(self, timeBlocks):
+        with self._telemetry.stage("encode"):
+            timeBlocks = list(timeBlocks)
+            self._writer.write_time_blocks(timeBlocks)
+            self.nbTimeBlocks += len(timeBlocks)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self._telemetry.stage("encode"):
+            self._writer.close()
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self._stream.close()
+
+
+class Telemetry:
+    def __init__(self, toolName: str, profile: Union[str, None]):
+        self.toolName = toolName
+        self.enabled = profile is not None
+        self.reportPath = None if profile in (None, "-") else profile
+        self.writers = []
+        # Stages timed on other threads (e.g. the encoder threads of write_behind.py),
+        # they overlap with the main loop and are not taken out of the process stage
+        self.backgroundStages = set()
+        self.nbTimeBlocks = 0
+        self.nbEvents = 0
+        # The stage times are added by the main thread and the encoder threads
+        self._lock = threading.Lock()
+        self._wall = {}
+        self._cpu = {}
+        self._tStart = time.perf_counter()
+        self._cpuStart = time.thread_time()
+        self._nextProgress = self._tStart + PROGRESS_INTERVAL
+
+    def stage(self, name: str) -> "_Stage":
+        return _Stage(self, name)
+
+    def _add(self, name: str, wall: float, cpu: float):
+        with self._lock:
+            self._wall[name] = self._wall.get(name, 0.0) + wall
+            self._cpu[name] = self._cpu.get(name, 0.0) + cpu
+
+    def openWriter(self, output: Union[str, BinaryIO], arrayCodec: bool = False):
+        if not self.enabled:
+            if arrayCodec:
+                return ArrayPETSIRDWriter(output)
+            return petsird.BinaryPETSIRDWriter(output)
+        return ProfiledWriter(self, output, arrayCodec)
+
+    def timeBlocks(self, timeBlocks: Iterable) -> Iterable:
+        """The input time blocks, the wait for each of them timed as the decode stage."""
+        if not self.enabled:
+            return timeBlocks
+        return self._timedTimeBlocks(timeBlocks)
+
+    def _timedTimeBlocks(self, timeBlocks: Iterable):
+        iterator = iter(timeBlocks)
+        while True:
+            with self.stage("decode"):
+                cTimeBlock = next(iterator, None)
+            if cTimeBlock is None:
+                return
+            self.nbTimeBlocks += 1
+            if isEventTimeBlock(cTimeBlock):
+                self.nbEvents += (
+                    nbEvents(cTimeBlock.value.prompt_events)
+                    + nbEvents(cTimeBlock.value.delayed_events)
+                    + nbEvents(cTimeBlock.value.triple_events)
+                )
+            if time.perf_counter() >= self._nextProgress:
+                self._printProgress()
+            yield cTimeBlock
+
+    def _printProgress(self):
+        elapsed = time.perf_counter() - self._tStart
+        self._nextProgress += PROGRESS_INTERVAL
+        print(
+            f"[{self.toolName}] {elapsed:.1f} s: {self.nbTimeBlocks} time blocks, "
+            f"{self.nbEvents} events ({self.nbEvents / elapsed:.3e} events/s)",
+            file=sys.stderr,
+        )
+
+    def summary(self) -> dict:
+        wallTotal = time.perf_counter() - self._tStart
+        cpuTotal = time.thread_time() - self._cpuStart
+        with self._lock:
+            wall = dict(self._wall)
+            cpu = dict(self._cpu)
+        stages = {}
+        for cStage in ("decode", "encode") + tuple(wall.keys()):
+            stages[cStage] = {
+                "wall_s": wall.get(cStage, 0.0),
+                "cpu_s": cpu.get(cStage, 0.0),
+            }
+        mainStages = [cStage for cStage in wall if cStage not in self.backgroundStages]
+        stages["process"] = {
+            "wall_s": wallTotal - sum(wall[cStage] for cStage in mainStages),
+            "cpu_s": cpuTotal - sum(cpu[cStage] for cStage in mainStages),
+        }
+        return {
+            "tool": self.toolName,
+            "wall_s": wallTotal,
+            "process_cpu_s": time.process_time(),
+            "stages": stages,
+            "nb_time_blocks": self.nbTimeBlocks,
+            "nb_events": self.nbEvents,
+            "time_blocks_per_s": self.nbTimeBlocks / wallTotal,
+            "events_per_s": self.nbEvents / wallTotal,
+            "outputs": [
+                {
+                    "name": cWriter.name,
+                    "nb_time_blocks": cWriter.nbTimeBlocks,
+                    "bytes": cWriter._stream.nbBytes,
+                }
+                for cWriter in self.writers
+            ],
+        }
+
+    def report(self):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        if self.reportPath is not None:
+            with open(self.reportPath, "w") as f:
+                json.dump(summary, f, indent=2)
+            return
+
+        print(
+            f"[{self.toolName}] {summary['wall_s']:.3f} s wall, {summary['process_cpu_s']:.3f} s "
+            f"process CPU: {summary['nb_time_blocks']} time blocks, {summary['nb_events']} events "
+            f"({summary['events_per_s']:.3e} events/s)",
+            file=sys.stderr,
+        )
+        for cStage, cTimes in summary["stages"].items():
+            print(
+                f"[{self.toolName}]   {cStage:>7}: {cTimes['wall_s']:.3f} s wall, "
+                f"{cTimes['cpu_s']:.3f} s CPU "
+                + ("(encoder threads)" if cStage in self.backgroundStages else "(main thread)"),
+                file=sys.stderr,
+            )
+        for cOutput in summary["outputs"]:
+            print(
+                f"[{self.toolName}]   {cOutput['name']}: {cOutput['nb_time_blocks']} "
+                f"time blocks, {cOutput['bytes']} bytes",
+                file=sys.stderr,
+            )
+
+
+class _Stage:
+    # A class rather than contextlib.contextmanager: it is entered once per time block
+    __slots__ = ("_telemetry", "_name", "_wall", "_cpu")
+
+    def __init__(self, telemetry: Telemetry, name: str):
+        self._telemetry = telemetry
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+
+    def __exit__(self, excType, excValue, traceback):
+        self._telemetry._add(
+            self._name,
+            time.perf_counter() - self._wall,
+            time.thread_time() - self._cpu,
+        )
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+def testConcurrentStages(nbThreads: int = 8, nbAdds: int = 20000):
+    # The encoder threads of several outputs add to the same stage at once
+    telemetry = Telemetry("test", "-")
+
+    def addTimes():
+        for _ in range(nbAdds):
+            telemetry._add("encode", 1.0, 0.5)
+
+    threads = [threading.Thread(target=addTimes) for _ in range(nbThreads)]
+    for cThread in threads:
+        cThread.start()
+    for cThread in threads:
+        cThread.join()
+    assert telemetry.summary()["stages"]["encode"] == {
+        "wall_s": nbThreads * nbAdds * 1.0,
+        "cpu_s": nbThreads * nbAdds * 0.5,
+    }
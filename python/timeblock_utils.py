@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Small helpers to handle the TimeBlock union of PETSIRD without caring about
+which case (event, external signal, ...) is stored in it.
+
+Event time blocks store their start directly while the other cases store a time
+interval, both in ms.
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import copy
+
+# This project module
+import petsird
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def isEventTimeBlock(cTimeBlock) -> bool:
+    return isinstance(cTimeBlock, petsird.TimeBlock.EventTimeBlock)
+
+
+def timeBlockStart(cTimeBlock) -> int:
+    value = cTimeBlock.value
+    if hasattr(value, "time_interval"):
+        return value.time_interval.start
+    return value.start
+
+
+def shiftTimeBlock(cTimeBlock, offset: int):
+    """Copy of the time block moved by offset ms. The event lists are shared."""
+    if offset == 0:
+        return cTimeBlock
+
+    value = copy.copy(cTimeBlock.value)
+    if hasattr(value, "time_interval"):
+        value.time_interval = petsird.TimeInterval(
+            start=value.time_interval.start + offset,
+            stop=value.time_interval.stop + offset,
+        )
+    else:
+        value.start += offset
+    return type(cTimeBlock)(value)
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Goal: Write behind the main loop of a tool, so the encoding and the disk I/O of its
+outputs overlap with the reading and processing of its input.
+
+A WriteBehindWriter wraps a PETSIRD writer (petsird.BinaryPETSIRDWriter or the
+ProfiledWriter of telemetry.py): the time blocks given to write_time_blocks are grouped
+until there are at least batchSize of them, and each batch is written with one
+write_time_blocks call of the wrapped writer by an EncoderThread. The encoder thread runs
+the calls in order from a bounded queue (depth batches at most): when it is full, the
+main loop waits (backpressure) so the memory stays bounded. Several writers can share one
+encoder thread, e.g. when they share resources as the gate files of rnd_gating_amplitude.py.
+
+The first exception raised by a write is raised again in the main loop, by the next
+write or by close(), and the following writes are dropped. The wrapped writer is still
+closed (its output file released) before close() raises it. With a depth of 0, no thread
+is started and the batches are written at once (batching only).
+"""
+
+#########################################################################################
+# Modules
+#########################################################################################
+# Basic python module
+import argparse
+import queue
+import threading
+from typing import Iterable
+
+
+#########################################################################################
+# Methods
+#########################################################################################
+def addWriteBehindArguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--writeBatch",
+        action="store",
+        type=int,
+        default=1,
+        dest="writeBatch",
+        help="Number of time blocks of an output written with one call. Two runs with the "
+        "same value write identical files.",
+    )
+    parser.add_argument(
+        "--writeDepth",
+        action="store",
+        type=int,
+        default=0,
+        dest="writeDepth",
+        help="Number of batches of an output waiting to be written by its encoder thread "
+        "(0: written by the main loop).",
+    )
+
+
+class EncoderThread:
+    # Marker put in the queue by close()
+    _END = object()
+
+    def __init__(self, depth: int, name: str = "encoder", telemetry=None):
+        self._failure = None
+        self._telemetry = telemetry if telemetry is not None and telemetry.enabled else None
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+            if self._telemetry is not None:
+                # The encoding is timed on this thread, it overlaps with the main loop
+                self._telemetry.backgroundStages.add("encode")
+        else:
+            self._queue = None
+            self._thread = None
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is EncoderThread._END:
+                return
+            if self._failure is not None:
+                continue
+            try:
+                task[0](*task[1:])
+            except BaseException as exc:
+                self._failure = exc
+
+    def _raiseFailure(self):
+        if self._failure is not None:
+            failure, self._failure = self._failure, None
+            raise failure
+
+    def submit(self, function, *args):
+        """Run function(*args) on the encoder thread, after the tasks submitted before."""
+        self._raiseFailure()
+        if self._queue is None:
+            function(*args)
+            return
+        if self._telemetry is not None:
+            with self._telemetry.stage("encodeWait"):
+                self._put((function,) + args)
+        else:
+            self._put((function,) + args)
+
+    def _put(self, task):
+        # Time out regularly to stop waiting when the encoder thread failed
+        while True:
+            try:
+                self._queue.put(task, timeout=0.1)
+                return
+            except queue.Full:
+                self._raiseFailure()
+
+    def close(self):
+        """Wait for the submitted tasks, and raise their first exception."""
+        if self._thread is not None:
+            self._put(EncoderThread._END)
+            self._thread.join()
+            self._thread = None
+        self._raiseFailure()
+
+    def abort(self):
+        """Drop the tasks not started yet, e.g. when the main loop failed."""
+        if self._thread is not None:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put(EncoderThread._END)
+            self._thread.join()
+            self._thread = None
+        self._failure = None
+
+
+class WriteBehindWriter:
+    """
+    PETSIRD writer whose calls are run by an encoder thread, the time blocks grouped by
+    batchSize. Without encoder, the writer has its own one of the given depth.
+    """
+
+    def __init__(
+        self,
+        writer,
+        batchSize: int = 1,
+        encoder: EncoderThread = None,
+        depth: int = 0,
+        telemetry=None,
+    ):
+        self._writer = writer
+        self._batchSize = max(batchSize, 1)
+        self._ownsEncoder = encoder is None
+        if encoder is None:
+            encoder = EncoderThread(depth, telemetry=telemetry)
+        self._encoder = encoder
+        self._pending = []
+        self._closed = False
+        self._writerClosed = False
+
+    def write_header(self, header):
+        self._encoder.submit(self._writer.write_header, header)
+
+    def write_time_blocks(self, timeBlocks: Iterable):
+        self._pending.extend(timeBlocks)
+        if len(self._pending) >= self._batchSize:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) != 0:
+            self._encoder.submit(self._writer.write_time_blocks, self._pending)
+            self._pending = []
+
+    def _closeWriter(self):
+        self._writerClosed = True
+        self._writer.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+            self._encoder.submit(self._closeWriter)
+            if self._ownsEncoder:
+                self._encoder.close()
+        except BaseException as exc:
+            # A write failed before the wrapped writer was closed: release its output
+            if not self._writerClosed:
+                if self._ownsEncoder:
+                    self._encoder.abort()
+                self._exitWriter(type(exc), exc, exc.__traceback__)
+            raise
+
+    def _exitWriter(self, excType, excValue, traceback):
+        self._writerClosed = True
+        if hasattr(self._writer, "__exit__"):
+            self._writer.__exit__(excType, excValue, traceback)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+            return
+        # A shared encoder is aborted by its owner, before the writers
+        self._closed = True
+        if self._ownsEncoder:
+            self._encoder.abort()
+        self._exitWriter(excType, excValue, traceback)
+
+
+def writeBehind(writer, batchSize: int, depth: int, telemetry=None):
+    """The writer itself when batchSize and depth do not change anything."""
+    if batchSize <= 1 and depth <= 0:
+        return writer
+    return WriteBehindWriter(writer, batchSize, depth=depth, telemetry=telemetry)
+
+
+#########################################################################################
+# Test functions
+#########################################################################################
+class _ListWriter:
+    def __init__(self, failAt: int = -1):
+        self.calls = []
+        self.closed = False
+        self.exited = False
+        self._failAt = failAt
+
+    def write_header(self, header):
+        self.calls.append(("header", header))
+
+    def write_time_blocks(self, timeBlocks):
+        if len(self.calls) == self._failAt:
+            raise IOError("disk full")
+        self.calls.append(list(timeBlocks))
+
+    def close(self):
+        self.closed = True
+
+    def __exit__(self, excType, excValue, traceback):
+        self.exited = True
+
+
+def testWriteBehind():
+    for depth in (0, 2):
+        listWriter = _ListWriter()
+        with WriteBehindWriter(listWriter, 3, depth=depth) as writer:
+            writer.write_header("h")
+            for cBlock in range(7):
+                writer.write_time_blocks((cBlock,))
+        assert listWriter.calls == [("header", "h"), [0, 1, 2], [3, 4, 5], [6]]
+        assert listWriter.closed
+
+    # A failed write is raised in the main loop, at the latest by close(), and the
+    # wrapped writer is released
+    for depth in (0, 2):
+        listWriter = _ListWriter(failAt=2)
+        try:
+            with WriteBehindWriter(listWriter, 1, depth=depth) as writer:
+                for cBlock in range(100):
+                    writer.write_time_blocks((cBlock,))
+        except IOError:
+            pass
+        else:
+            raise AssertionError("the write failure was not raised")
+        assert listWriter.exited
+
+    # The failure is only raised by close(): the writer is still released
+    listWriter = _ListWriter(failAt=0)
+    writer = WriteBehindWriter(listWriter, 5, depth=2)
+    writer.write_time_blocks((0,))
+    try:
+        writer.close()
+    except IOError:
+        pass
+    else:
+        raise AssertionError("the write failure was not raised")
+    assert listWriter.exited
+
+
+#########################################################################################
+# main
+#########################################################################################
+if __name__ == "__main__":
+    testWriteBehind()